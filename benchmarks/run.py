@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+
+# Load-test harness for the three API versions.
+#
+# Each version runs in its own process (they share module names), drives every
+# endpoint at the requested concurrency and prints one JSON report, so results can
+# be saved with --output and diffed across commits.
+#
+#   python benchmarks/run.py                          # all versions, in-process ASGI
+#   python benchmarks/run.py --versions 1 --uvicorn   # real server over HTTP
+#   python benchmarks/run.py --versions 2 3 --database-url postgresql://...
+#   python benchmarks/run.py --versions 3 --temp-postgres   # throwaway local cluster
+#   python benchmarks/run.py --versions 1 --scale 1 2 4 8   # throughput per uvicorn worker count
+#
+# Versions 2 and 3 need Postgres: an existing server via --database-url (or the
+# DATABASE_URL env var), or --temp-postgres, which starts a disposable cluster
+# with the `testing.postgresql` package and the local initdb/postgres binaries.
+# The sightings table is truncated before each run.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERSIONS = {"1": "version-1", "2": "version-2", "3": "version-3"}
+SPECIES = ["Lion", "Elephant", "Zebra", "Giraffe", "Leopard", "Cheetah", "Rhino", "Buffalo"]
+
+def make_sighting(i, rng):
+    # Minute-by-minute timestamps keep every generated sighting unique
+    return {
+        "species": rng.choice(SPECIES),
+        "location": f"Site {i % 97}",
+        "date": (date.today() - timedelta(days=1 + i // 1440)).isoformat(),
+        "time": f"{i // 60 % 24:02d}:{i % 60:02d}",
+    }
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(latencies, statuses, elapsed):
+    ordered = sorted(latencies)
+    report = {
+        "requests": len(ordered),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ordered) / elapsed, 1) if elapsed else None,
+        "statuses": dict(sorted(statuses.items())),
+    }
+    if ordered:
+        report["latency_ms"] = {
+            "p50": round(percentile(ordered, 50), 3),
+            "p90": round(percentile(ordered, 90), 3),
+            "p99": round(percentile(ordered, 99), 3),
+            "max": round(ordered[-1], 3),
+        }
+    return report
+
+async def run_phase(client, requests, concurrency):
+    # `requests` yields (method, url, json body); workers pull from the shared iterator
+    latencies, statuses, responses = [], Counter(), []
+    pending = iter(requests)
+
+    async def worker():
+        for method, url, body in pending:
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(response.status_code)] += 1
+            responses.append(response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - started), responses
+
+async def run_workload(client, args):
+    rng = random.Random(args.seed)
+    report = {}
+
+    sightings = [make_sighting(i, rng) for i in range(args.size)]
+    report["add"], responses = await run_phase(
+        client, (("POST", "/sightings/", sighting) for sighting in sightings), args.concurrency)
+    ids = [response.json()["id"] for response in responses if response.status_code == 200]
+    if not ids:
+        raise RuntimeError("No sightings were added; is the backend reachable?")
+
+    report["view"], _ = await run_phase(client, (
+        ("GET", f"/sightings/?limit={args.page_size}&after={rng.choice(ids) - 1}", None)
+        for _ in range(args.operations)
+    ), args.concurrency)
+
+    report["search"], _ = await run_phase(client, (
+        ("GET", f"/sightings/search/?species={rng.choice(SPECIES)[:3]}&location=Site {rng.randrange(97)}", None)
+        for _ in range(args.operations)
+    ), args.concurrency)
+
+    updates = rng.sample(ids, min(args.operations, len(ids)))
+    report["update"], _ = await run_phase(client, (
+        ("PUT", f"/sightings/{sighting_id}",
+         {**make_sighting(sighting_id, rng), "location": f"Updated Site {sighting_id}"})
+        for sighting_id in updates
+    ), args.concurrency)
+
+    report["delete"], _ = await run_phase(
+        client, (("DELETE", f"/sightings/{sighting_id}", None) for sighting_id in ids), args.concurrency)
+    return report
+
+@asynccontextmanager
+async def lifespan(app):
+    # Runs the app's startup/shutdown handlers, which httpx's ASGI transport skips
+    received, sent = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}, received.get, sent.put))
+    await received.put({"type": "lifespan.startup"})
+    message = await sent.get()
+    if message["type"] == "lifespan.startup.failed":
+        raise RuntimeError(message.get("message", "startup failed"))
+    try:
+        yield
+    finally:
+        await received.put({"type": "lifespan.shutdown"})
+        await sent.get()
+        await task
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@asynccontextmanager
+async def uvicorn_server(args, workers=None, env=None):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers or args.workers),
+         "--log-level", "warning"],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=base_url) as probe:
+            for _ in range(100):
+                try:
+                    await probe.get("/")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not start")
+            # With several workers, wait until they all answer, not just the first
+            await asyncio.sleep(0.5 * ((workers or args.workers) - 1))
+        yield base_url
+    finally:
+        server.terminate()
+        server.wait()
+
+def reset_database():
+    # Fresh tables and indexes for a reproducible run
+    import create_db
+    import psycopg2
+    create_db.create_tables()
+    connection = psycopg2.connect(create_db.DATABASE_URL)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("TRUNCATE sightings RESTART IDENTITY CASCADE;")
+        connection.commit()
+    finally:
+        connection.close()
+
+async def run_single(args):
+    version_dir = os.path.join(ROOT, VERSIONS[args.single])
+    os.chdir(version_dir)
+    sys.path.insert(0, version_dir)
+    if args.single != "1":
+        reset_database()
+
+    if args.scale:
+        print(json.dumps(await run_scaling(args, args.single)))
+        return
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.uvicorn:
+        async with uvicorn_server(args) as base_url:
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+                report = await run_workload(client, args)
+    else:
+        from main import app
+        async with lifespan(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                report = await run_workload(client, args)
+    print(json.dumps(report))
+
+async def generate_load(base_url, seconds, concurrency, seed, size):
+    # Mixed traffic: 10% adds, 50% lookups by id, 40% searches
+    rng = random.Random(seed)
+    completed, added = 0, 0
+    deadline = time.perf_counter() + seconds
+
+    async def worker():
+        nonlocal completed, added
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            if roll < 0.1:
+                added += 1
+                # Index ranges per load process keep the new sightings unique
+                await client.post("/sightings/", json=make_sighting(size + seed * 10_000_000 + added, rng))
+            elif roll < 0.6:
+                await client.get(f"/sightings/{rng.randint(1, size)}")
+            else:
+                await client.get("/sightings/search/", params={"species": rng.choice(SPECIES)[:3], "location": f"Site {rng.randrange(97)}"})
+            completed += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return completed
+
+def load_process(base_url, seconds, concurrency, seed, size):
+    return asyncio.run(generate_load(base_url, seconds, concurrency, seed, size))
+
+async def run_scaling(args, version):
+    # The same mixed workload against each worker count. Load comes from several
+    # processes so the client isn't the bottleneck; near-linear scaling shows up
+    # as an efficiency close to 1.
+    rng = random.Random(args.seed)
+    seed_rows = [make_sighting(i, rng) for i in range(args.size)]
+    report = {}
+    for workers in args.scale:
+        env = dict(os.environ, WEB_CONCURRENCY=str(workers))
+        state_dir = None
+        if version == "1":
+            # Workers share one store through the log in PERSIST_DIR
+            state_dir = tempfile.TemporaryDirectory()
+            env.update(PERSIST_DIR=state_dir.name, SHARED_STORE="1")
+        else:
+            reset_database()
+        try:
+            async with uvicorn_server(args, workers, env) as base_url:
+                async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+                    for start in range(0, len(seed_rows), 5000):
+                        (await client.post("/sightings/bulk", json=seed_rows[start:start + 5000])).raise_for_status()
+                loop = asyncio.get_running_loop()
+                with ProcessPoolExecutor(args.load_processes) as pool:
+                    counts = await asyncio.gather(*(
+                        loop.run_in_executor(pool, load_process, base_url, args.duration,
+                                             max(1, args.concurrency // args.load_processes), seed + 1, args.size)
+                        for seed in range(args.load_processes)
+                    ))
+        finally:
+            if state_dir is not None:
+                state_dir.cleanup()
+        report[str(workers)] = {"throughput_rps": round(sum(counts) / args.duration, 1)}
+
+    base_workers, base_rps = args.scale[0], report[str(args.scale[0])]["throughput_rps"]
+    for workers in args.scale:
+        entry = report[str(workers)]
+        entry["speedup"] = round(entry["throughput_rps"] / base_rps, 2) if base_rps else None
+        entry["efficiency"] = round(entry["speedup"] / (workers / base_workers), 2) if base_rps else None
+    return {"cpus": os.cpu_count(), "workers": report}
+
+def start_temp_postgres():
+    import testing.postgresql  # optional dependency, only for --temp-postgres
+    return testing.postgresql.Postgresql()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every endpoint of the selected API versions.")
+    parser.add_argument("--versions", nargs="+", choices=sorted(VERSIONS), default=sorted(VERSIONS))
+    parser.add_argument("--size", type=int, default=2000, help="Sightings added (and later deleted) per run")
+    parser.add_argument("--operations", type=int, default=1000, help="Requests in each view/search/update phase")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--uvicorn", action="store_true", help="Run a local uvicorn server instead of in-process ASGI")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--scale", type=int, nargs="+", metavar="WORKERS",
+                        help="Measure mixed-load throughput with each of these uvicorn worker counts")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load per worker count with --scale")
+    parser.add_argument("--load-processes", type=int, default=os.cpu_count(),
+                        help="Client processes generating load with --scale")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--temp-postgres", action="store_true")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--single", choices=sorted(VERSIONS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        asyncio.run(run_single(args))
+        return
+
+    temp_postgres = start_temp_postgres() if args.temp_postgres else None
+    env = dict(os.environ)
+    if temp_postgres is not None:
+        env["DATABASE_URL"] = temp_postgres.url()
+    elif args.database_url:
+        env["DATABASE_URL"] = args.database_url
+
+    forwarded = [arg for arg in sys.argv[1:] if arg != "--temp-postgres"]
+    report = {
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                 capture_output=True, text=True).stdout.strip(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("single", "output", "database_url")},
+        "results": {},
+    }
+    try:
+        for version in args.versions:
+            completed = subprocess.run([sys.executable, __file__, *forwarded, "--single", version],
+                                       env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                report["results"][VERSIONS[version]] = {"error": completed.stderr.strip().splitlines()[-1:]}
+            else:
+                report["results"][VERSIONS[version]] = json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        if temp_postgres is not None:
+            temp_postgres.stop()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
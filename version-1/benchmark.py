@@ -0,0 +1,144 @@
+import argparse
+import gc
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from main import Sighting
+from bulk import validate_rows
+from store import SightingStore
+from columnar import ColumnarSightingStore
+
+# Micro-benchmarks for the in-memory store. Each test reports the time taken per
+# chunk of operations, so flat per-chunk numbers mean the cost scales linearly.
+# --memory ROWS instead reports resident memory per sighting for each store layout,
+# and --validation ROWS the rate at which raw upload rows pass model validation.
+
+SPECIES = ["Lion", "Elephant", "Zebra", "Giraffe", "Leopard", "Cheetah", "Rhino", "Buffalo"]
+STORES = {"dict": SightingStore, "columnar": ColumnarSightingStore}
+
+def make_sighting(i):
+    # Skip validation: these fields are known to be valid and only the store is measured
+    return Sighting.construct(
+        species=SPECIES[i % len(SPECIES)],
+        location=f"Site {i // 1440}",
+        date=f"{2000 + i % 20}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        time=f"{i // 60 % 24:02d}:{i % 60:02d}",
+    )
+
+def bench_inserts(store, count, chunk):
+    chunks = []
+    for start in range(0, count, chunk):
+        batch = [make_sighting(i) for i in range(start, min(start + chunk, count))]
+        started = time.perf_counter()
+        for sighting in batch:
+            store.add(sighting)
+        chunks.append(round(time.perf_counter() - started, 4))
+    return {"inserted": len(store), "chunk_size": chunk, "seconds_per_chunk": chunks, "total_seconds": round(sum(chunks), 3)}
+
+def bench_search(store, queries, repeat=100):
+    results = {}
+    gc.disable()  # like timeit: keep collector pauses over millions of objects out of the numbers
+    for species, location in queries:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            found = store.search(species, location)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        results[f"species={species} location={location}"] = {"matches": len(found), "ms_per_query": round(elapsed_ms, 4)}
+    gc.enable()
+    return results
+
+def resident_bytes():
+    # Current RSS on Linux; elsewhere fall back to the peak, which is close enough
+    # when the store is the only thing that grows
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def bench_memory_single(name, rows):
+    # Inserts from a generator, so only what the store keeps stays resident
+    gc.collect()
+    before = resident_bytes()
+    store = STORES[name]()
+    started = time.perf_counter()
+    for i in range(rows):
+        store.add(make_sighting(i))
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    used = resident_bytes() - before
+    return {"rows": len(store), "bytes_per_sighting": round(used / rows, 1), "total_mb": round(used / 1e6, 1),
+            "insert_seconds": round(elapsed, 1)}
+
+def bench_memory(rows):
+    # One process per layout so neither sees the other's heap
+    report = {}
+    for name in STORES:
+        completed = subprocess.run([sys.executable, __file__, "--memory", str(rows), "--store", name, "--single"],
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            report[name] = {"error": completed.stderr.strip().splitlines()[-1:]}
+        else:
+            report[name] = json.loads(completed.stdout)
+    return report
+
+def raw_row(i):
+    # Unnormalized, the way clients send them
+    return {
+        "species": f" {SPECIES[i % len(SPECIES)].lower()} ",
+        "location": f"site {i // 1440}",
+        "date": f"{2000 + i % 20}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "time": f"{i // 60 % 24:02d}:{i % 60:02d}",
+        "latitude": -1.5,
+        "longitude": 35.1,
+    }
+
+def bench_validation(count):
+    rows = [raw_row(i) for i in range(count)]
+    started = time.perf_counter()
+    for row in rows:
+        Sighting(**row)
+    single = time.perf_counter() - started
+    started = time.perf_counter()
+    accepted, rejected = validate_rows(rows, Sighting)
+    bulk = time.perf_counter() - started
+    return {"rows": count,
+            "model_records_per_second": round(count / single),
+            "bulk_records_per_second": round(count / bulk),
+            "bulk_accepted": len(accepted), "bulk_rejected": len(rejected)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory store micro-benchmarks.")
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--chunk", type=int, default=100_000)
+    parser.add_argument("--store", choices=sorted(STORES), default="dict")
+    parser.add_argument("--memory", type=int, metavar="ROWS",
+                        help="Only measure memory per sighting for every store layout (e.g. 10000000)")
+    parser.add_argument("--validation", type=int, metavar="ROWS",
+                        help="Only measure validated records per second for ROWS raw rows (e.g. 1000000)")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.validation:
+        print(json.dumps({"validation": bench_validation(args.validation)}, indent=2))
+        sys.exit()
+
+    if args.memory:
+        if args.single:
+            print(json.dumps(bench_memory_single(args.store, args.memory)))
+        else:
+            print(json.dumps({"memory": bench_memory(args.memory)}, indent=2))
+        sys.exit()
+
+    store = STORES[args.store]()
+    report = {"inserts": bench_inserts(store, args.count, args.chunk)}
+    report["search"] = bench_search(store, [
+        (None, "Site 42"),
+        ("leo", "Site 1234"),
+        ("zz", None),
+    ])
+    print(json.dumps(report, indent=2))
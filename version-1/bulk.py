@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from typing import List, Optional
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+
+MAX_BULK_ROWS = 100_000
+
+class BulkRejection(BaseModel):
+    index: int   # position of the row in the upload, starting at 0
+    detail: str
+
+class BulkSightingResponse(BaseModel):
+    inserted: int
+    rejected: List[BulkRejection]
+
+def parse_rows(body: bytes, content_type: Optional[str]):
+    # JSON array, NDJSON or CSV with a species,location,date,time header
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        text = body.decode("utf-8-sig")
+        if media_type == "text/csv":
+            # Empty CSV cells mean "not given", e.g. for the optional coordinates
+            rows = [{name: value if value != "" else None for name, value in row.items()}
+                    for row in csv.DictReader(io.StringIO(text))]
+        elif media_type in ("application/x-ndjson", "application/jsonl"):
+            rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            rows = json.loads(text)
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse upload: {e}")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of sightings.")
+    if len(rows) > MAX_BULK_ROWS:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {MAX_BULK_ROWS} sightings.")
+    return rows
+
+def validate_rows(rows, model):
+    # Returns (index, sighting) pairs that passed validation and are unique within
+    # the batch, plus a rejection for every other row
+    accepted, rejected, first_index_by_key = [], [], {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            rejected.append(BulkRejection(index=index, detail="Expected an object with species, location, date and time."))
+            continue
+        if None in row:
+            # csv.DictReader files cells past the end of the header under None
+            rejected.append(BulkRejection(index=index, detail="Row has more cells than the header has columns."))
+            continue
+        try:
+            sighting = model(**row)
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors())
+            rejected.append(BulkRejection(index=index, detail=errors))
+            continue
+
+        key = (sighting.species.lower(), sighting.location.lower(), sighting.date, sighting.time)
+        if key in first_index_by_key:
+            rejected.append(BulkRejection(index=index, detail=f"Duplicate of row {first_index_by_key[key]} in this batch."))
+            continue
+        first_index_by_key[key] = index
+        accepted.append((index, sighting))
+    return accepted, rejected
@@ -0,0 +1,461 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from itertools import chain
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from store import (SubstringIndex, haversine_km, pack_date, pack_time, radius_boxes, rollup_keys, unpack_date, unpack_time,
+                   within_boxes)
+
+# Column-oriented alternative to SightingStore (STORE_BACKEND=columnar).
+#
+# Each field is one typed array indexed by row number, and a sighting's id is its
+# row number + 1, so ids need no mapping. Species and location are interned as
+# integer codes, dates are packed as YYYYMMDD and times as minutes after
+# midnight. Deleted rows are marked in a tombstone bitmap and never reused.
+#
+# The indexes are posting arrays of row numbers: per species code, location code,
+# day and grid cell. Updates and deletes only append, so postings can hold stale
+# rows; reads check every candidate against the columns, and the postings are
+# rebuilt once stale entries outnumber live rows.
+
+MISSING = float("nan")
+CELL_DEGREES = 0.1   # same grid as store.GridIndex
+
+class StoredSighting(NamedTuple):
+    """A row materialized from the columns; read-only."""
+
+    species: str
+    location: str
+    date: str
+    time: str
+    latitude: Optional[float]
+    longitude: Optional[float]
+
+    def dict(self):
+        return self._asdict()
+
+def grid_cell(lat, lon):
+    return (math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES))
+
+class Dictionary:
+    """Interns strings as dense integer codes.
+
+    `folded` maps each code to the code of its lowercased form in a table shared
+    by all dictionaries, so case-insensitive comparisons stay integer comparisons.
+    Substring searches run over the distinct values only.
+    """
+
+    def __init__(self, folded_codes: Dict[str, int]):
+        self.values: List[str] = []
+        self.folded = array("I")
+        self._codes: Dict[str, int] = {}
+        self._folded_codes = folded_codes
+        self._index = SubstringIndex()
+
+    def encode(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+            self.folded.append(self._folded_codes.setdefault(value.lower(), len(self._folded_codes)))
+            self._index.add(value, code)
+        return code
+
+    def restore(self, values: List[str], folded: array):
+        self.values = values
+        self.folded = folded
+        self._codes = {value: code for code, value in enumerate(values)}
+        for code, value in enumerate(values):
+            self._index.add(value, code)
+
+    def matching(self, term: str) -> Set[int]:
+        # Codes of the values containing `term`, ignoring case
+        return set().union(*self._index.search(term))
+
+class KeyTable:
+    """Open-addressing hash set of row numbers for the duplicate check.
+
+    Slots hold row numbers only; keys are read back from the columns through
+    `key_of`, so the table costs a few bytes per row.
+    """
+
+    EMPTY, REMOVED = -1, -2
+
+    def __init__(self, key_of):
+        self._key_of = key_of
+        self._slots = array("i", [self.EMPTY]) * 8
+        self._filled = 0   # live and removed slots
+
+    def find(self, key) -> Optional[int]:
+        slots, mask = self._slots, len(self._slots) - 1
+        slot = hash(key) & mask
+        while True:
+            row = slots[slot]
+            if row == self.EMPTY:
+                return None
+            if row >= 0 and self._key_of(row) == key:
+                return row
+            slot = (slot + 1) & mask
+
+    def add(self, key, row: int):
+        # Callers check `find` first; keys are never stored twice
+        if (self._filled + 1) * 2 > len(self._slots):
+            self._resize()
+        slots, mask = self._slots, len(self._slots) - 1
+        slot = hash(key) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        if slots[slot] == self.EMPTY:
+            self._filled += 1
+        slots[slot] = row
+
+    def remove(self, key, row: int):
+        # `key` must still be the row's key, so call this before changing its columns
+        slots, mask = self._slots, len(self._slots) - 1
+        slot = hash(key) & mask
+        while slots[slot] != row:
+            slot = (slot + 1) & mask
+        slots[slot] = self.REMOVED
+
+    def _resize(self):
+        rows = [row for row in self._slots if row >= 0]
+        size = len(self._slots)
+        while len(rows) * 4 > size:
+            size *= 2
+        self._slots = array("i", [self.EMPTY]) * size
+        self._filled = 0
+        for row in rows:
+            self.add(self._key_of(row), row)
+
+class ColumnarSightingStore:
+    """Sightings held in typed columns, with the same interface as SightingStore."""
+
+    COLUMNS = ("species_codes", "location_codes", "dates", "minutes", "latitudes", "longitudes")
+    POSTINGS = ("species", "location", "day", "cell")
+
+    def __init__(self):
+        folded_codes: Dict[str, int] = {}
+        self._species = Dictionary(folded_codes)
+        self._locations = Dictionary(folded_codes)
+        self._species_codes = array("I")
+        self._location_codes = array("I")
+        self._dates = array("I")       # YYYYMMDD
+        self._minutes = array("H")     # minutes after midnight
+        self._latitudes = array("d")   # NaN when missing
+        self._longitudes = array("d")
+        self._deleted = bytearray()    # tombstone bitmap, one bit per row
+        self._live = 0
+        self._folded_codes = folded_codes
+        self._keys = KeyTable(self._key_of)
+
+        self._rows_by_species: Dict[int, array] = {}
+        self._rows_by_location: Dict[int, array] = {}
+        self._rows_by_day: Dict[int, array] = {}
+        self._days: List[int] = []     # distinct days, sorted
+        self._rows_by_cell: Dict[tuple, array] = {}
+        self._stale = 0
+
+        self.species_day_counts: Counter = Counter()
+        self.location_month_counts: Counter = Counter()
+
+    @property
+    def next_id(self) -> int:
+        return len(self._dates) + 1
+
+    def __len__(self):
+        return self._live
+
+    def __contains__(self, sighting_id):
+        return self._is_live(sighting_id - 1)
+
+    def _is_live(self, row: int) -> bool:
+        return 0 <= row < len(self._dates) and not self._deleted[row >> 3] & (1 << (row & 7))
+
+    def _key_of(self, row: int):
+        return (self._species.folded[self._species_codes[row]], self._locations.folded[self._location_codes[row]],
+                self._dates[row], self._minutes[row])
+
+    def _record(self, row: int) -> StoredSighting:
+        latitude, longitude = self._latitudes[row], self._longitudes[row]
+        has_position = not math.isnan(latitude)
+        return StoredSighting(
+            self._species.values[self._species_codes[row]],
+            self._locations.values[self._location_codes[row]],
+            unpack_date(self._dates[row]),
+            unpack_time(self._minutes[row]),
+            latitude if has_position else None,
+            longitude if has_position else None,
+        )
+
+    def get(self, sighting_id):
+        row = sighting_id - 1
+        return self._record(row) if self._is_live(row) else None
+
+    def find_duplicate(self, species, location, date, time) -> Optional[int]:
+        species_code = self._folded_codes.get(species.lower())
+        location_code = self._folded_codes.get(location.lower())
+        if species_code is None or location_code is None:
+            return None
+        row = self._keys.find((species_code, location_code, pack_date(date), pack_time(time)))
+        return None if row is None else row + 1
+
+    def _post(self, rows_by_value, value, row):
+        rows = rows_by_value.get(value)
+        if rows is None:
+            rows = rows_by_value[value] = array("I")
+        rows.append(row)
+
+    def _post_day(self, day, row):
+        if day not in self._rows_by_day:
+            insort(self._days, day)
+        self._post(self._rows_by_day, day, row)
+
+    def _post_position(self, row):
+        latitude = self._latitudes[row]
+        if not math.isnan(latitude):
+            self._post(self._rows_by_cell, grid_cell(latitude, self._longitudes[row]), row)
+
+    def add(self, sighting) -> Optional[int]:
+        # Returns the new id, or None if an identical sighting is already stored
+        species_code = self._species.encode(sighting.species)
+        location_code = self._locations.encode(sighting.location)
+        day, minutes = pack_date(sighting.date), pack_time(sighting.time)
+        key = (self._species.folded[species_code], self._locations.folded[location_code], day, minutes)
+        if self._keys.find(key) is not None:
+            return None
+
+        row = len(self._dates)
+        self._species_codes.append(species_code)
+        self._location_codes.append(location_code)
+        self._dates.append(day)
+        self._minutes.append(minutes)
+        has_position = sighting.latitude is not None and sighting.longitude is not None
+        self._latitudes.append(sighting.latitude if has_position else MISSING)
+        self._longitudes.append(sighting.longitude if has_position else MISSING)
+        if row & 7 == 0:
+            self._deleted.append(0)
+        self._live += 1
+
+        self._keys.add(key, row)
+        self._post(self._rows_by_species, species_code, row)
+        self._post(self._rows_by_location, location_code, row)
+        self._post_day(day, row)
+        self._post_position(row)
+        self._count(sighting, 1)
+        return row + 1
+
+    def add_many(self, sightings) -> List[Optional[int]]:
+        return [self.add(sighting) for sighting in sightings]
+
+    def update(self, sighting_id, location=None, date=None, time=None, latitude=None, longitude=None,
+               clear_position=False) -> bool:
+        # Returns False if the change would turn the sighting into a duplicate of another one
+        row = sighting_id - 1
+        old_key = self._key_of(row)
+        location_code = self._locations.encode(location) if location is not None else self._location_codes[row]
+        day = pack_date(date) if date is not None else self._dates[row]
+        minutes = pack_time(time) if time is not None else self._minutes[row]
+        new_key = (old_key[0], self._locations.folded[location_code], day, minutes)
+        if self._keys.find(new_key) not in (None, row):
+            return False
+
+        self._count(self._record(row), -1)
+        self._keys.remove(old_key, row)
+        if location_code != self._location_codes[row]:
+            self._location_codes[row] = location_code
+            self._post(self._rows_by_location, location_code, row)
+            self._stale += 1
+        if day != self._dates[row]:
+            self._dates[row] = day
+            self._post_day(day, row)
+            self._stale += 1
+        self._minutes[row] = minutes
+        if clear_position or (latitude is not None and longitude is not None):
+            # The old cell keeps a stale posting; lookups re-check the coordinates
+            self._stale += not math.isnan(self._latitudes[row])
+            if clear_position:
+                self._latitudes[row] = self._longitudes[row] = math.nan
+            else:
+                self._latitudes[row], self._longitudes[row] = latitude, longitude
+                self._post_position(row)
+        self._keys.add(new_key, row)
+        self._count(self._record(row), 1)
+        self._compact_if_stale()
+        return True
+
+    def delete(self, sighting_id) -> bool:
+        row = sighting_id - 1
+        if not self._is_live(row):
+            return False
+        self._keys.remove(self._key_of(row), row)
+        self._count(self._record(row), -1)
+        self._deleted[row >> 3] |= 1 << (row & 7)
+        self._live -= 1
+        self._stale += 3 + (not math.isnan(self._latitudes[row]))
+        self._compact_if_stale()
+        return True
+
+    def _compact_if_stale(self):
+        if self._stale <= max(self._live, 1024):
+            return
+        self._rows_by_species, self._rows_by_location, self._rows_by_day, self._rows_by_cell = {}, {}, {}, {}
+        self._days = []
+        for row in range(len(self._dates)):
+            if self._is_live(row):
+                self._post(self._rows_by_species, self._species_codes[row], row)
+                self._post(self._rows_by_location, self._location_codes[row], row)
+                self._post_day(self._dates[row], row)
+                self._post_position(row)
+        self._stale = 0
+
+    def _count(self, sighting, delta):
+        species_day, location_month = rollup_keys(sighting)
+        for counts, key in ((self.species_day_counts, species_day), (self.location_month_counts, location_month)):
+            counts[key] += delta
+            if not counts[key]:
+                del counts[key]
+
+    def rebuild_rollups(self):
+        # Same contract as SightingStore.rebuild_rollups
+        species_day, location_month = Counter(), Counter()
+        for row in range(len(self._dates)):
+            if self._is_live(row):
+                species_key, location_key = rollup_keys(self._record(row))
+                species_day[species_key] += 1
+                location_month[location_key] += 1
+
+        mismatches = {}
+        for maintained, actual in ((self.species_day_counts, species_day), (self.location_month_counts, location_month)):
+            for key in maintained.keys() | actual.keys():
+                if maintained[key] != actual[key]:
+                    mismatches[key] = (maintained[key], actual[key])
+        self.species_day_counts, self.location_month_counts = species_day, location_month
+        return mismatches
+
+    def search(self, species: Optional[str] = None, location: Optional[str] = None,
+               date_from: Optional[str] = None, date_to: Optional[str] = None,
+               time_from: Optional[str] = None, time_to: Optional[str] = None):
+        # Candidates come from the most selective posting lists; every candidate
+        # is then checked against the columns, which also drops stale postings
+        species_codes = self._species.matching(species) if species is not None else None
+        location_codes = self._locations.matching(location) if location is not None else None
+        low = pack_date(date_from) if date_from else 0
+        high = pack_date(date_to) if date_to else 99999999
+
+        postings = []
+        if species_codes is not None:
+            postings.append([self._rows_by_species[code] for code in species_codes if code in self._rows_by_species])
+        if location_codes is not None:
+            postings.append([self._rows_by_location[code] for code in location_codes if code in self._rows_by_location])
+        if date_from or date_to:
+            days = self._days[bisect_left(self._days, low):bisect_right(self._days, high)]
+            postings.append([self._rows_by_day[day] for day in days])
+        if postings:
+            candidates = sorted(set(chain.from_iterable(min(postings, key=lambda lists: sum(map(len, lists))))))
+        else:
+            candidates = range(len(self._dates))
+
+        start = pack_time(time_from) if time_from else 0
+        end = pack_time(time_to) if time_to else 24 * 60
+        wraps = start > end
+        found = []
+        for row in candidates:
+            if not self._is_live(row):
+                continue
+            if species_codes is not None and self._species_codes[row] not in species_codes:
+                continue
+            if location_codes is not None and self._location_codes[row] not in location_codes:
+                continue
+            if not low <= self._dates[row] <= high:
+                continue
+            minutes = self._minutes[row]
+            if (minutes < start and minutes > end) if wraps else not start <= minutes <= end:
+                continue
+            found.append((row + 1, self._record(row)))
+        return found
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        low_row, low_col = grid_cell(min_lat, min_lon)
+        high_row, high_col = grid_cell(max_lat, max_lon)
+        candidates = set()
+        if (high_row - low_row + 1) * (high_col - low_col + 1) > len(self._rows_by_cell):
+            # Huge box: walking the occupied cells is cheaper than walking the range
+            for (cell_row, cell_col), rows in self._rows_by_cell.items():
+                if low_row <= cell_row <= high_row and low_col <= cell_col <= high_col:
+                    candidates.update(rows)
+        else:
+            for cell_row in range(low_row, high_row + 1):
+                for cell_col in range(low_col, high_col + 1):
+                    candidates.update(self._rows_by_cell.get((cell_row, cell_col), ()))
+
+        found = []
+        for row in sorted(candidates):
+            if self._is_live(row) and min_lat <= self._latitudes[row] <= max_lat \
+                    and min_lon <= self._longitudes[row] <= max_lon:
+                found.append((row + 1, self._record(row)))
+        return found
+
+    def within_radius(self, lat, lon, radius_km):
+        return [
+            (sighting_id, sighting) for sighting_id, sighting in within_boxes(self, radius_boxes(lat, lon, radius_km))
+            if haversine_km(lat, lon, sighting.latitude, sighting.longitude) <= radius_km
+        ]
+
+    def snapshot_state(self):
+        # Copies of the arrays (memcpy, so the event loop barely pauses), including
+        # the indexes, so loading a snapshot needs no per-row work
+        arrays = {name: getattr(self, "_" + name)[:] for name in self.COLUMNS}
+        arrays["deleted"] = array("B", self._deleted)
+        arrays["species_folded"] = self._species.folded[:]
+        arrays["location_folded"] = self._locations.folded[:]
+        arrays["key_slots"] = self._keys._slots[:]
+        meta = {
+            "layout": "columnar",
+            "live": self._live,
+            "stale": self._stale,
+            "key_filled": self._keys._filled,
+            "species": list(self._species.values),
+            "locations": list(self._locations.values),
+            "folded": list(self._folded_codes),
+            "species_day_counts": [[*group, count] for group, count in self.species_day_counts.items()],
+            "location_month_counts": [[*group, count] for group, count in self.location_month_counts.items()],
+        }
+        for family in self.POSTINGS:
+            # All posting arrays of a family back to back, with offsets per value
+            postings = getattr(self, f"_rows_by_{family}")
+            rows, offsets = array("I"), array("Q", [0])
+            for value_rows in postings.values():
+                rows.extend(value_rows)
+                offsets.append(len(rows))
+            arrays[f"{family}_rows"], arrays[f"{family}_offsets"] = rows, offsets
+            meta[f"{family}_keys"] = list(postings)
+        return meta, arrays
+
+    def load_state(self, meta, arrays, make_sighting=None):
+        # Inverse of snapshot_state on an empty store
+        if meta["layout"] != "columnar":
+            raise ValueError(f"Snapshot was written by the {meta['layout']} store; set STORE_BACKEND to match.")
+        for name in self.COLUMNS:
+            setattr(self, "_" + name, arrays[name])
+        self._deleted = bytearray(arrays["deleted"])
+        self._live, self._stale = meta["live"], meta["stale"]
+        self._folded_codes.update((value, code) for code, value in enumerate(meta["folded"]))
+        self._species.restore(meta["species"], arrays["species_folded"])
+        self._locations.restore(meta["locations"], arrays["location_folded"])
+        self._keys._slots, self._keys._filled = arrays["key_slots"], meta["key_filled"]
+        self.species_day_counts = Counter({(group, key): count for group, key, count in meta["species_day_counts"]})
+        self.location_month_counts = Counter({(group, key): count for group, key, count in meta["location_month_counts"]})
+        for family in self.POSTINGS:
+            rows, offsets = arrays[f"{family}_rows"], arrays[f"{family}_offsets"]
+            keys = [tuple(key) if isinstance(key, list) else key for key in meta[f"{family}_keys"]]
+            setattr(self, f"_rows_by_{family}", {
+                key: rows[offsets[i]:offsets[i + 1]] for i, key in enumerate(keys)
+            })
+        self._days = sorted(self._rows_by_day)
+
+    def iter_from(self, after: int = 0):
+        for row in range(after, len(self._dates)):
+            if self._is_live(row):
+                yield row + 1, self._record(row)
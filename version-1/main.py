@@ -1,31 +1,51 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel, Field, validator
-from typing import Dict, Optional
-from datetime import datetime, date
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator, model_validator
+from typing import Dict, List, Optional
+from datetime import date, time as dtime
+import json
+from contextlib import asynccontextmanager
+from store import bbox_boxes, create_store, within_boxes
+from persistence import create_persistence
+from bulk import BulkRejection, BulkSightingResponse, parse_rows, validate_rows
+import validation
 
-app = FastAPI()
+async def follow_other_workers():
+    # With SHARED_STORE, applies what other workers wrote before this request reads
+    if persistence is not None:
+        persistence.catch_up()
+
+app = FastAPI(dependencies=[Depends(follow_other_workers)])
+
+MAX_PAGE_SIZE = 1000
 
 class Sighting(BaseModel):
     species: str = Field(..., min_length=1)
     location: str = Field(..., min_length=1)
     date: str = Field(..., pattern=r'^\d{4}-\d{2}-\d{2}$')  # YYYY-MM-DD
     time: str = Field(..., pattern=r'^\d{2}:\d{2}$')       # HH:MM
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
 
-    @validator('date')
+    @field_validator('date')
+    @classmethod
     def validate_date(cls, v):
-        sighting_date = datetime.strptime(v, '%Y-%m-%d').date()
-        if sighting_date > date.today():
-            raise ValueError('Date cannot be in the future.')
-        return v
+        return validation.check_date(v)
 
-    @validator('time')
+    @field_validator('time')
+    @classmethod
     def validate_time(cls, v):
-        datetime.strptime(v, '%H:%M')  # This will raise if invalid
-        return v
+        return validation.check_time(v)
 
-    @validator('species', 'location')
+    @field_validator('species', 'location')
+    @classmethod
     def capitalize(cls, v):
-        return v.strip().title()  # Capitalizes each word and removes extra spaces
+        return validation.normalize_name(v)
+
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
 
 class SightingResponse(BaseModel):
     id: int
@@ -33,45 +53,124 @@ class SightingResponse(BaseModel):
     location: str
     date: str
     time: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class SightingUpdate(BaseModel):
-    location: Optional[str]
-    date: Optional[str]
-    time: Optional[str]
+    location: Optional[str] = Field(..., min_length=1)
+    date: Optional[str] = Field(..., pattern=r'^\d{4}-\d{2}-\d{2}$')
+    time: Optional[str] = Field(..., pattern=r'^\d{2}:\d{2}$')
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    # Same checks as Sighting; None leaves the field unchanged
+    @field_validator('date')
+    @classmethod
+    def validate_date(cls, v):
+        return validation.check_date(v) if v is not None else None
+
+    @field_validator('time')
+    @classmethod
+    def validate_time(cls, v):
+        return validation.check_time(v) if v is not None else None
+
+    @field_validator('location')
+    @classmethod
+    def capitalize(cls, v):
+        return validation.normalize_name(v) if v is not None else None
 
-sightings_dict: Dict[int, Sighting] = {}
-sighting_id_counter = 1
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
+
+    @property
+    def clears_position(self) -> bool:
+        return 'latitude' in self.model_fields_set and self.latitude is None
+
+store = create_store()
+# Write-ahead log and snapshots when PERSIST_DIR is set; None keeps the store memory-only
+persistence = create_persistence(store, Sighting.construct)
+
+@asynccontextmanager
+async def writing():
+    # Change the store inside the block and add a log record per change to the
+    # yielded list. Exiting waits for them to be fsynced; with SHARED_STORE the
+    # block also runs under the lock that keeps workers in step.
+    if persistence is None:
+        yield []
+    else:
+        async with persistence.writing() as records:
+            yield records
 
 @app.post("/sightings/", response_model=SightingResponse)
 async def add_sighting(sighting: Sighting):
-    # Check for existing sightings
-    for existing_id, existing_sighting in sightings_dict.items():
-        if (existing_sighting.species.lower() == sighting.species.lower() and
-            existing_sighting.location.lower() == sighting.location.lower() and
-            existing_sighting.date == sighting.date and
-            existing_sighting.time == sighting.time):
+    # Duplicate check is a hash lookup inside the store
+    async with writing() as records:
+        sighting_id = store.add(sighting)
+        if sighting_id is None:
             raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
+        records.append(("add", sighting_id, sighting.dict()))
+
+    return SightingResponse(id=sighting_id, **sighting.dict())
+
+@app.post("/sightings/bulk", response_model=BulkSightingResponse)
+async def add_sightings_bulk(request: Request):
+    # Accepts a JSON array, NDJSON (application/x-ndjson) or CSV (text/csv)
+    rows = parse_rows(await request.body(), request.headers.get("content-type"))
+    accepted, rejected = validate_rows(rows, Sighting)
 
-    global sighting_id_counter
-    sightings_dict[sighting_id_counter] = sighting
-    response = SightingResponse(id=sighting_id_counter, **sighting.dict())
-    sighting_id_counter += 1
-    return response
+    async with writing() as inserted:
+        ids = store.add_many(sighting for _, sighting in accepted)
+        for (index, sighting), sighting_id in zip(accepted, ids):
+            if sighting_id is None:
+                rejected.append(BulkRejection(index=index, detail="Sighting already exists with the same details."))
+            else:
+                inserted.append(("add", sighting_id, sighting.dict()))
+
+    rejected.sort(key=lambda rejection: rejection.index)
+    return BulkSightingResponse(inserted=len(inserted), rejected=rejected)
+
+def stream_sightings(after: int, limit: Optional[int]):
+    for count, (sighting_id, sighting) in enumerate(store.iter_from(after)):
+        if limit is not None and count >= limit:
+            break
+        yield json.dumps({"id": sighting_id, **sighting.dict()}) + "\n"
 
 @app.get("/sightings/", response_model=Dict[int, str])
-async def view_sightings():
-    if not sightings_dict:
+async def view_sightings(response: Response,
+                         limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                         after: int = Query(0, ge=0),
+                         stream: bool = False):
+    if stream:
+        # One JSON object per line, produced as the rows are walked
+        return StreamingResponse(stream_sightings(after, limit), media_type="application/x-ndjson")
+
+    page = {}
+    for sighting_id, sighting in store.iter_from(after):
+        page[sighting_id] = f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}"
+        if limit is not None and len(page) == limit:
+            # Pass the last id back as `after` to fetch the next page
+            response.headers["X-Next-Cursor"] = str(sighting_id)
+            break
+
+    if not page:
         raise HTTPException(status_code=404, detail="No sightings recorded")
-    return {sighting_id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}"
-            for sighting_id, sighting in sightings_dict.items()}
+    return page
 
 @app.get("/sightings/search/")
-async def search_sightings(species: Optional[str] = None, location: Optional[str] = None):
-    found_sightings = {
-        sighting_id: sighting for sighting_id, sighting in sightings_dict.items()
-        if (species is None or species.lower() in sighting.species.lower()) and
-           (location is None or location.lower() in sighting.location.lower())
-    }
+async def search_sightings(species: Optional[str] = None, location: Optional[str] = None,
+                           date_from: Optional[date] = None, date_to: Optional[date] = None,
+                           time_from: Optional[dtime] = None, time_to: Optional[dtime] = None):
+    # Date bounds are inclusive and bisect the store's date index; a time window
+    # whose start is after its end wraps past midnight
+    found_sightings = dict(store.search(
+        species, location,
+        date_from.isoformat() if date_from else None,
+        date_to.isoformat() if date_to else None,
+        time_from.strftime('%H:%M') if time_from else None,
+        time_to.strftime('%H:%M') if time_to else None,
+    ))
 
     if not found_sightings:
         raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
@@ -79,38 +178,113 @@ async def search_sightings(species: Optional[str] = None, location: Optional[str
     return {sighting_id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}"
             for sighting_id, sighting in found_sightings.items()}
 
+@app.get("/sightings/near", response_model=List[SightingResponse])
+async def sightings_near(lat: Optional[float] = Query(None, ge=-90, le=90),
+                         lon: Optional[float] = Query(None, ge=-180, le=180),
+                         radius_km: Optional[float] = Query(None, gt=0),
+                         min_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         min_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         max_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         max_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Either a radius around lat/lon or a min/max bounding box, answered from the grid index
+    if None not in (lat, lon, radius_km):
+        found_sightings = store.within_radius(lat, lon, radius_km)
+    elif None not in (min_lat, min_lon, max_lat, max_lon):
+        if min_lat > max_lat:
+            raise HTTPException(status_code=400, detail="min_lat must not be greater than max_lat.")
+        # min_lon greater than max_lon is a box across the antimeridian
+        found_sightings = within_boxes(store, bbox_boxes(min_lat, min_lon, max_lat, max_lon))
+    else:
+        raise HTTPException(status_code=400, detail="Give lat, lon and radius_km, or min_lat, min_lon, max_lat and max_lon.")
+
+    if not found_sightings:
+        raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
+
+    return [{"id": sighting_id, **sighting.dict()} for sighting_id, sighting in found_sightings[:limit]]
+
+@app.get("/sightings/stats/species-daily")
+async def species_daily_stats(species: Optional[str] = None, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    # Reads the maintained rollup, so the cost depends on the number of groups, not sightings
+    species = species.strip().title() if species else None
+    date_from = date_from.isoformat() if date_from else None
+    date_to = date_to.isoformat() if date_to else None
+    return [
+        {"species": group_species, "date": day, "count": count}
+        for (group_species, day), count in sorted(store.species_day_counts.items())
+        if (species is None or group_species == species)
+        and (date_from is None or day >= date_from) and (date_to is None or day <= date_to)
+    ]
+
+@app.get("/sightings/stats/location-monthly")
+async def location_monthly_stats(location: Optional[str] = None, month_from: Optional[date] = None, month_to: Optional[date] = None):
+    # Months are identified by their first day, e.g. 2024-03-01
+    location = location.strip().title() if location else None
+    month_from = month_from.replace(day=1).isoformat() if month_from else None
+    month_to = month_to.replace(day=1).isoformat() if month_to else None
+    return [
+        {"location": group_location, "month": month, "count": count}
+        for (group_location, month), count in sorted(store.location_month_counts.items())
+        if (location is None or group_location == location)
+        and (month_from is None or month >= month_from) and (month_to is None or month <= month_to)
+    ]
+
+@app.post("/sightings/stats/rebuild")
+async def rebuild_stats():
+    mismatches = store.rebuild_rollups()
+    return {
+        "detail": "Rollups rebuilt from the stored sightings.",
+        "mismatches": [{"group": list(group), "maintained": maintained, "actual": actual}
+                       for group, (maintained, actual) in mismatches.items()],
+    }
+
+@app.get("/sightings/{sighting_id}", response_model=SightingResponse)
+async def get_sighting(sighting_id: int):
+    # Declared after the fixed /sightings/... paths so they are matched first
+    sighting = store.get(sighting_id)
+    if sighting is None:
+        raise HTTPException(status_code=404, detail="Sighting not found")
+    return SightingResponse(id=sighting_id, **sighting.dict())
+
 @app.put("/sightings/{sighting_id}", response_model=SightingResponse)
 async def update_sighting(sighting_id: int, updated_sighting: SightingUpdate):
-    if sighting_id not in sightings_dict:
+    if sighting_id not in store:
         raise HTTPException(status_code=404, detail="Sighting not found")
 
-    existing_sighting = sightings_dict[sighting_id]
-
-    # Update fields if provided in the request
-    if updated_sighting.location is not None:
-        existing_sighting.location = updated_sighting.location.title()  # Capitalize location
-    if updated_sighting.date is not None:
-        # Validate new date
-        sighting_date = datetime.strptime(updated_sighting.date, '%Y-%m-%d').date()
-        if sighting_date > date.today():
-            raise HTTPException(status_code=400, detail='Date cannot be in the future.')
-        existing_sighting.date = updated_sighting.date
-    if updated_sighting.time is not None:
-        # Validate new time
-        datetime.strptime(updated_sighting.time, '%H:%M')  # This will raise if invalid
-        existing_sighting.time = updated_sighting.time
+    # SightingUpdate has validated every field, so a bad one never reaches the store
+    changes = {"location": updated_sighting.location, "date": updated_sighting.date, "time": updated_sighting.time,
+               "latitude": updated_sighting.latitude, "longitude": updated_sighting.longitude,
+               "clear_position": updated_sighting.clears_position}
+    async with writing() as records:
+        if sighting_id not in store:   # deleted meanwhile
+            raise HTTPException(status_code=404, detail="Sighting not found")
+        if not store.update(sighting_id, **changes):
+            raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
+        records.append(("update", sighting_id, changes))
+        updated = store.get(sighting_id)
 
-    return SightingResponse(id=sighting_id, **existing_sighting.dict())
+    return SightingResponse(id=sighting_id, **updated.dict())
 
 @app.delete("/sightings/{sighting_id}")
 async def delete_sighting(sighting_id: int):
-    if sighting_id not in sightings_dict:
-        raise HTTPException(status_code=404, detail="Sighting not found")
+    async with writing() as records:
+        if not store.delete(sighting_id):
+            raise HTTPException(status_code=404, detail="Sighting not found")
+        records.append(("delete", sighting_id, {}))
 
-    # Delete the sighting
-    del sightings_dict[sighting_id]
     return {"detail": "Sighting deleted successfully"}
 
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Sighting Tracker API! Use /docs for more information."}
+
+@app.on_event("startup")
+async def startup():
+    if persistence is not None:
+        persistence.recover()
+        persistence.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    if persistence is not None:
+        await persistence.close()
@@ -0,0 +1,525 @@
+import asyncio
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from typing import List, Optional, Union
+
+# Durability for the in-memory store: an append-only write-ahead log plus
+# periodic snapshots. Enabled by setting PERSIST_DIR.
+#
+# The log is split into numbered segments (wal-00000001.log, ...). Taking a
+# snapshot starts a new segment N and writes snapshot-N.bin, which holds the
+# state before segment N, so recovery loads the newest snapshot and replays
+# segments N, N+1, ... Older files are removed once the snapshot is on disk.
+#
+# Writers append their records and then wait for the next group commit: one
+# write and fsync every WAL_GROUP_COMMIT_MS covers all the records appended
+# since the previous one.
+#
+# With SHARED_STORE=1 several worker processes (uvicorn --workers N) share one
+# PERSIST_DIR; see SharedPersistence.
+
+PERSIST_DIR = os.getenv("PERSIST_DIR")
+SHARED_STORE = os.getenv("SHARED_STORE", "0") == "1"
+WAL_GROUP_COMMIT_MS = float(os.getenv("WAL_GROUP_COMMIT_MS", "2"))
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "300"))
+SNAPSHOT_WAL_BYTES = int(os.getenv("SNAPSHOT_WAL_BYTES", str(64 * 1024 * 1024)))
+
+RECORD_HEADER = struct.Struct("<II")   # payload length, crc32 of the payload
+SNAPSHOT_MAGIC = b"SIGHTSNP"
+SNAPSHOT_HEADER = struct.Struct("<8sII")   # magic, format version, metadata length
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"wal-{segment:08d}.log")
+
+def snapshot_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"snapshot-{segment:08d}.bin")
+
+def numbered_files(directory: str, prefix: str):
+    # (number, path) pairs, oldest first
+    found = []
+    for path in glob.glob(os.path.join(directory, prefix + "-*")):
+        stem = os.path.basename(path)[len(prefix) + 1:].split(".")[0]
+        if stem.isdigit() and not path.endswith(".tmp"):
+            found.append((int(stem), path))
+    return sorted(found)
+
+def fsync_directory(directory: str):
+    # Makes a rename or a new file itself durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fdatasync(fd: int):
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+def write_all(fd: int, data: bytes):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+def claim_directory(directory: str, shared: bool) -> int:
+    # Held for the life of the process: exclusively by a lone process, shared by
+    # SHARED_STORE workers, so mixing the two fails at startup instead of
+    # interleaving two unrelated logs
+    fd = os.open(os.path.join(directory, "owner.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise RuntimeError(f"{directory} is in use by another process; "
+                           "set SHARED_STORE=1 on every worker to share it") from None
+    return fd
+
+def encode_record(record) -> bytes:
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(path: str):
+    # Yields (record, end offset) up to the first torn or corrupt record
+    with open(path, "rb") as f:
+        yield from parse_records(f.read())
+
+def parse_records(data: bytes):
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        offset = start + length
+        yield json.loads(payload), offset
+
+class WriteAheadLog:
+    """Append-only log with group commit.
+
+    `append` only buffers, so a record's position follows the order in which the
+    store was changed; `commit` waits until everything appended so far is fsynced.
+    A single flusher task does the file I/O in a worker thread.
+
+    `write` and `switch` are the unbuffered variants used by SharedPersistence,
+    whose workers must see each other's records as soon as the lock is released.
+    """
+
+    def __init__(self, directory: str, segment: int, group_commit_seconds: float = WAL_GROUP_COMMIT_MS / 1000):
+        self.directory = directory
+        self.segment = segment
+        self.group_commit_seconds = group_commit_seconds
+        self.bytes_since_rotate = 0
+        self.fd = self._open(segment)
+        fsync_directory(directory)
+        self._pending: List[Union[bytes, int]] = []   # records, or the number of a segment to switch to
+        self._waiters: List[asyncio.Future] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._unsynced = False   # `write` sent records to `fd` that aren't fsynced yet
+        self._retired: List[int] = []   # descriptors of earlier segments, to sync and close
+
+    def _open(self, segment: int) -> int:
+        return os.open(segment_path(self.directory, segment), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def append(self, record):
+        data = encode_record(record)
+        self._pending.append(data)
+        self.bytes_since_rotate += len(data)
+
+    def rotate(self) -> int:
+        # Later records go to a new segment; returns its number
+        self.segment += 1
+        self._pending.append(self.segment)
+        self.bytes_since_rotate = 0
+        return self.segment
+
+    def write(self, record) -> int:
+        # Written at once rather than buffered; `commit` still waits for the fsync.
+        # Returns the number of bytes written.
+        data = encode_record(record)
+        write_all(self.fd, data)
+        self._unsynced = True
+        self.bytes_since_rotate += len(data)
+        return len(data)
+
+    def switch(self, segment: int):
+        # Later `write`s go to `segment`. The old descriptor is closed by the
+        # flusher once its records are synced, unless nothing is pending.
+        if self._unsynced or self._flusher is not None:
+            self._retired.append(self.fd)
+        else:
+            os.close(self.fd)
+        self.fd = self._open(segment)
+        self.segment = segment
+        self._unsynced = False
+        self.bytes_since_rotate = 0
+
+    async def commit(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_batches())
+        await waiter
+
+    async def _flush_batches(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._waiters:
+                # Let concurrent writers join the batch before paying for the fsync
+                await asyncio.sleep(self.group_commit_seconds)
+                batch, waiters = self._pending, self._waiters
+                self._pending, self._waiters = [], []
+                # Descriptors `write` used so far, taken here so a later switch can't race the sync
+                written = self._retired + ([self.fd] if self._unsynced else [])
+                retired, self._retired, self._unsynced = self._retired, [], False
+                try:
+                    await loop.run_in_executor(None, self._write, batch, written, retired)
+                except Exception as exc:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(exc)
+                    continue
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            self._flusher = None
+
+    def _write(self, batch, written=(), retired=()):
+        for fd in written:
+            fdatasync(fd)
+        for fd in retired:
+            os.close(fd)
+        chunk = []
+        for item in batch:
+            if isinstance(item, int):
+                self._write_chunk(chunk)
+                chunk = []
+                os.close(self.fd)
+                self.fd = self._open(item)
+                fsync_directory(self.directory)
+            else:
+                chunk.append(item)
+        self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        if chunk:
+            write_all(self.fd, b"".join(chunk))
+            fdatasync(self.fd)
+
+    def close(self):
+        for fd in self._retired:
+            os.close(fd)
+        os.close(self.fd)
+
+def write_snapshot(path: str, meta, arrays):
+    # Layout: header, JSON metadata, then each array's raw bytes at an 8-byte
+    # aligned offset listed in the metadata, so readers can map the file and
+    # copy each section straight into an array
+    sections, offset = [], 0
+    for name, values in arrays.items():
+        sections.append([name, values.typecode, offset, len(values)])
+        offset += (len(values) * values.itemsize + 7) // 8 * 8
+    body = json.dumps({**meta, "sections": sections}).encode()
+    start = (SNAPSHOT_HEADER.size + len(body) + 7) // 8 * 8
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(body)))
+        f.write(body)
+        for (_, _, section_offset, _), values in zip(sections, arrays.values()):
+            f.seek(start + section_offset)
+            f.write(memoryview(values).cast("B"))
+        f.truncate(start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    fsync_directory(os.path.dirname(path))
+
+def read_snapshot(path: str):
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, meta_length = SNAPSHOT_HEADER.unpack_from(mapped, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} sightings snapshot")
+        meta = json.loads(mapped[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + meta_length])
+        start = (SNAPSHOT_HEADER.size + meta_length + 7) // 8 * 8
+        arrays = {}
+        with memoryview(mapped) as view:
+            for name, typecode, offset, count in meta.pop("sections"):
+                values = array(typecode)
+                values.frombytes(view[start + offset:start + offset + count * values.itemsize])
+                arrays[name] = values
+    finally:
+        mapped.close()
+    return meta, arrays
+
+class Persistence:
+    """Recovers the store on startup, logs every write and takes snapshots."""
+
+    shared = False
+
+    def __init__(self, store, directory: str, make_sighting):
+        self.store = store
+        self.directory = directory
+        self.make_sighting = make_sighting
+        self.wal: Optional[WriteAheadLog] = None
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._last_snapshot = time.monotonic()
+        self._owner_lock: Optional[int] = None
+
+    def recover(self):
+        # Latest snapshot first, then every later log record, in order
+        os.makedirs(self.directory, exist_ok=True)
+        self._owner_lock = claim_directory(self.directory, self.shared)
+        started = time.perf_counter()
+        snapshots = numbered_files(self.directory, "snapshot")
+        first_segment = 1
+        if snapshots:
+            first_segment, path = snapshots[-1]
+            meta, arrays = read_snapshot(path)
+            self.store.load_state(meta, arrays, self.make_sighting)
+
+        segments = [(number, path) for number, path in numbered_files(self.directory, "wal") if number >= first_segment]
+        replayed = 0
+        for position, (number, path) in enumerate(segments):
+            end = 0
+            for record, end in read_records(path):
+                self.apply(record)
+                replayed += 1
+            if end < os.path.getsize(path):
+                if position != len(segments) - 1:
+                    raise RuntimeError(f"{path} is corrupt before its end; later segments can't be replayed")
+                # A crash in the middle of a write leaves a torn tail; drop it
+                logger.warning("Truncating torn tail of %s at byte %d", path, end)
+                os.truncate(path, end)
+
+        # Appends go to a fresh segment, never after a recovered tail
+        last_segment = max([number for number, _ in segments] + [first_segment - 1])
+        self.wal = WriteAheadLog(self.directory, last_segment + 1)
+        logger.info("Recovered %d sightings (%d log records) in %.2fs",
+                    len(self.store), replayed, time.perf_counter() - started)
+
+    def apply(self, record):
+        operation, sighting_id, fields = record
+        if operation == "add":
+            if self.store.add(self.make_sighting(**fields)) != sighting_id:
+                raise RuntimeError(f"Replaying the log gave a different id than {sighting_id}")
+        elif operation == "update":
+            self.store.update(sighting_id, **fields)
+        elif operation == "delete":
+            self.store.delete(sighting_id)
+        # ("segment", N, {}) only marks where a shared log continues
+
+    async def log(self, *records):
+        # Call right after changing the store, before any other await, so log
+        # order matches the order the changes were made in
+        for record in records:
+            self.wal.append(record)
+        await self.wal.commit()
+
+    @contextlib.asynccontextmanager
+    async def writing(self):
+        # Change the store inside the block and add a record per change to the
+        # yielded list; they are logged on the way out
+        records = []
+        try:
+            yield records
+        finally:
+            if records:
+                await self.log(*records)
+
+    def catch_up(self):
+        # Nothing to do: no other process writes to this log
+        pass
+
+    async def snapshot(self):
+        # The state is captured and the log rotated in the same step, so the
+        # snapshot covers exactly the segments before the new one
+        meta, arrays = self.store.snapshot_state()
+        segment = self.wal.rotate()
+        self._last_snapshot = time.monotonic()
+        await self.wal.commit()
+        path = snapshot_path(self.directory, segment)
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, path, meta, arrays)
+        self._remove_before(segment)
+        return path
+
+    def _remove_before(self, segment: int):
+        for number, old_path in numbered_files(self.directory, "snapshot") + numbered_files(self.directory, "wal"):
+            if number < segment:
+                os.remove(old_path)
+
+    def _log_bytes(self) -> int:
+        # Log written since the last snapshot
+        return self.wal.bytes_since_rotate
+
+    async def _snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(1)
+            due = time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL_SECONDS
+            log_bytes = self._log_bytes()
+            if log_bytes and (due or log_bytes >= SNAPSHOT_WAL_BYTES):
+                try:
+                    await self.snapshot()
+                except Exception:
+                    logger.exception("Snapshot failed; the log still has every write")
+
+    def start(self):
+        self._snapshot_task = asyncio.create_task(self._snapshot_periodically())
+
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+        await self.wal.commit()
+        self.wal.close()
+        os.close(self._owner_lock)
+
+class SharedPersistence(Persistence):
+    """Keeps the stores of several worker processes in step through one log.
+
+    Every worker holds the whole store in memory. A write takes an exclusive
+    lock on the directory, applies what other workers logged since it last
+    looked, changes its store and writes its records before letting go, so every
+    write is checked for duplicates against all the data and the log has one
+    global order. Reads only apply the new tail of the log first.
+
+    Ids follow from that order: every worker applies the same records in the
+    same sequence, so they agree on the next id without an allocator of their
+    own. A segment ends with a ("segment", N, {}) record naming the next one,
+    which is how workers follow each other's rotations.
+    """
+
+    shared = True
+
+    def __init__(self, store, directory: str, make_sighting):
+        super().__init__(store, directory, make_sighting)
+        self.position = 0   # bytes of the current segment applied to the store
+        self._write_lock: Optional[int] = None
+        self._local_lock = asyncio.Lock()
+
+    def recover(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_lock = os.open(os.path.join(self.directory, "write.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._write_lock, fcntl.LOCK_EX)
+        try:
+            super().recover()
+            # Running workers are still on the previous segment; send them to the new one
+            previous = segment_path(self.directory, self.wal.segment - 1)
+            if os.path.exists(previous):
+                fd = os.open(previous, os.O_WRONLY | os.O_APPEND)
+                try:
+                    write_all(fd, encode_record(("segment", self.wal.segment, {})))
+                    fdatasync(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            fcntl.flock(self._write_lock, fcntl.LOCK_UN)
+
+    @contextlib.asynccontextmanager
+    async def locked(self):
+        # flock excludes other workers; the asyncio lock excludes other requests
+        # in this one, which flock would let through on the same descriptor
+        async with self._local_lock:
+            try:
+                fcntl.flock(self._write_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                acquired = asyncio.get_running_loop().run_in_executor(
+                    None, fcntl.flock, self._write_lock, fcntl.LOCK_EX)
+                try:
+                    await asyncio.shield(acquired)
+                except asyncio.CancelledError:
+                    # The thread still gets the lock; give it back straight away
+                    acquired.add_done_callback(lambda _: fcntl.flock(self._write_lock, fcntl.LOCK_UN))
+                    raise
+            try:
+                self.catch_up(locked=True)
+                yield
+            finally:
+                fcntl.flock(self._write_lock, fcntl.LOCK_UN)
+
+    def catch_up(self, locked: bool = False):
+        # Applies what other workers logged since the last call. Under the lock an
+        # unreadable tail can only come from a worker that died mid-write, so it
+        # is cut off before anything is appended after it.
+        while True:
+            size = os.fstat(self.wal.fd).st_size
+            if size == self.position:
+                return
+            data = os.pread(self.wal.fd, size - self.position, self.position)
+            start, next_segment = self.position, None
+            for record, end in parse_records(data):
+                self.position = start + end
+                if record[0] == "segment":
+                    next_segment = record[1]
+                    break
+                self.apply(record)
+            if next_segment is None:
+                if locked and self.position < size:
+                    logger.warning("Truncating torn tail of %s at byte %d",
+                                   segment_path(self.directory, self.wal.segment), self.position)
+                    os.ftruncate(self.wal.fd, self.position)
+                return
+            # Another worker rotated the log, for a snapshot or at its start
+            self.wal.switch(next_segment)
+            self.position = 0
+            self._last_snapshot = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def writing(self):
+        records = []
+        try:
+            async with self.locked():
+                try:
+                    yield records
+                finally:
+                    for record in records:
+                        self.position += self.wal.write(record)
+        finally:
+            if records:
+                await self.wal.commit()
+
+    async def snapshot(self):
+        async with self.locked():
+            if self.position == 0:
+                return None   # nothing logged since the last rotation
+            meta, arrays = self.store.snapshot_state()
+            segment = self.wal.segment + 1
+            self.wal.write(("segment", segment, {}))
+            self.wal.switch(segment)
+            fsync_directory(self.directory)
+            self.position = 0
+            self._last_snapshot = time.monotonic()
+        await self.wal.commit()
+        path = snapshot_path(self.directory, segment)
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, path, meta, arrays)
+        async with self.locked():
+            # Under the lock, so a starting worker never picks files that are about to go
+            self._remove_before(segment)
+        return path
+
+    def _log_bytes(self) -> int:
+        self.catch_up()
+        return self.position
+
+    async def close(self):
+        await super().close()
+        os.close(self._write_lock)
+
+def create_persistence(store, make_sighting) -> Optional[Persistence]:
+    if not PERSIST_DIR:
+        if SHARED_STORE:
+            raise RuntimeError("SHARED_STORE=1 needs PERSIST_DIR: the workers share the store through its log")
+        return None
+    return (SharedPersistence if SHARED_STORE else Persistence)(store, PERSIST_DIR, make_sighting)
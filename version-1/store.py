@@ -0,0 +1,409 @@
+import bisect
+from array import array
+import math
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+# "dict" keeps every Sighting model; "columnar" packs the fields into typed arrays (see columnar.py)
+STORE_BACKEND = os.getenv("STORE_BACKEND", "dict")
+
+def duplicate_key(species: str, location: str, date: str, time: str) -> Tuple[str, str, str, str]:
+    # Two sightings are duplicates when these match, ignoring case of the names
+    return (species.lower(), location.lower(), date, time)
+
+# Compact encodings used by the columnar store and by snapshots
+def pack_date(value: str) -> int:
+    return int(value[:4]) * 10000 + int(value[5:7]) * 100 + int(value[8:10])
+
+def unpack_date(packed: int) -> str:
+    return f"{packed // 10000:04d}-{packed // 100 % 100:02d}-{packed % 100:02d}"
+
+def pack_time(value: str) -> int:
+    return int(value[:2]) * 60 + int(value[3:5])
+
+def unpack_time(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def trigrams(value: str) -> Set[str]:
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+class SubstringIndex:
+    """Case-insensitive substring lookup over one text field.
+
+    Ids are grouped by distinct lowercased value, and trigram postings point at
+    those values. A query only checks the distinct values that share all of its
+    trigrams, so the cost depends on the vocabulary, not on the number of sightings.
+    """
+
+    def __init__(self):
+        self._ids_by_value: Dict[str, Set[int]] = {}
+        self._values_by_trigram: Dict[str, Set[str]] = {}
+
+    def add(self, value: str, sighting_id: int):
+        value = value.lower()
+        ids = self._ids_by_value.get(value)
+        if ids is None:
+            ids = self._ids_by_value[value] = set()
+            for gram in trigrams(value):
+                self._values_by_trigram.setdefault(gram, set()).add(value)
+        ids.add(sighting_id)
+
+    def remove(self, value: str, sighting_id: int):
+        value = value.lower()
+        ids = self._ids_by_value[value]
+        ids.discard(sighting_id)
+        if not ids:
+            del self._ids_by_value[value]
+            for gram in trigrams(value):
+                values = self._values_by_trigram[gram]
+                values.discard(value)
+                if not values:
+                    del self._values_by_trigram[gram]
+
+    def search(self, term: str) -> List[Set[int]]:
+        # Returns one id set per matching distinct value; callers union or probe them
+        term = term.lower()
+        grams = trigrams(term)
+        if grams:
+            # Start from the rarest trigram to keep the intersection small
+            postings = sorted((self._values_by_trigram.get(gram, set()) for gram in grams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            # Terms shorter than a trigram fall back to the distinct values
+            candidates = self._ids_by_value.keys()
+
+        return [self._ids_by_value[value] for value in candidates if term in value]
+
+class DateIndex:
+    """Ids grouped by day, with the distinct days kept sorted.
+
+    A date range bisects the sorted days, so it only touches the days inside the
+    range. Days are ISO strings, which sort in date order.
+    """
+
+    def __init__(self):
+        self._days: List[str] = []
+        self._ids_by_day: Dict[str, Set[int]] = {}
+
+    def add(self, day: str, sighting_id: int):
+        ids = self._ids_by_day.get(day)
+        if ids is None:
+            ids = self._ids_by_day[day] = set()
+            bisect.insort(self._days, day)
+        ids.add(sighting_id)
+
+    def remove(self, day: str, sighting_id: int):
+        ids = self._ids_by_day[day]
+        ids.discard(sighting_id)
+        if not ids:
+            del self._ids_by_day[day]
+            del self._days[bisect.bisect_left(self._days, day)]
+
+    def search(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Set[int]]:
+        # One id set per day in [date_from, date_to]; either bound may be open
+        low = bisect.bisect_left(self._days, date_from) if date_from else 0
+        high = bisect.bisect_right(self._days, date_to) if date_to else len(self._days)
+        return [self._ids_by_day[day] for day in self._days[low:high]]
+
+def in_time_window(value: str, time_from: Optional[str], time_to: Optional[str]) -> bool:
+    # A window whose start is after its end wraps past midnight, e.g. 22:00 to 04:00
+    if time_from and time_to and time_from > time_to:
+        return value >= time_from or value <= time_to
+    return (not time_from or value >= time_from) and (not time_to or value <= time_to)
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def radius_boxes(lat, lon, radius_km):
+    # Lat/lon boxes covering the circle, clamped at the poles. A circle over a
+    # pole spans every longitude; one that crosses the antimeridian gets a box
+    # on each side of it.
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, lat - lat_delta), min(90.0, lat + lat_delta)
+    if min_lat == -90.0 or max_lat == 90.0:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    lon_delta = lat_delta / math.cos(math.radians(lat))
+    if lon_delta >= 180.0:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    min_lon, max_lon = lon - lon_delta, lon + lon_delta
+    if min_lon < -180.0:
+        return [(min_lat, min_lon + 360.0, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+    if max_lon > 180.0:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon - 360.0)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+def bbox_boxes(min_lat, min_lon, max_lat, max_lon):
+    # A box whose min_lon is east of its max_lon crosses the antimeridian and is
+    # split in two there
+    if min_lon > max_lon:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+def within_boxes(store, boxes):
+    # Sightings in any of the boxes, by id; the boxes don't overlap
+    found = [item for box in boxes for item in store.within_bbox(*box)]
+    found.sort(key=lambda item: item[0])
+    return found
+
+class GridIndex:
+    """Fixed-size lat/lon grid (like a geohash at one precision) mapping cells to ids."""
+
+    def __init__(self, cell_degrees: float = 0.1):
+        self.cell_degrees = cell_degrees
+        self._ids_by_cell: Dict[Tuple[int, int], Set[int]] = {}
+
+    def _cell(self, lat, lon) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def add(self, lat, lon, sighting_id):
+        self._ids_by_cell.setdefault(self._cell(lat, lon), set()).add(sighting_id)
+
+    def remove(self, lat, lon, sighting_id):
+        cell = self._cell(lat, lon)
+        ids = self._ids_by_cell[cell]
+        ids.discard(sighting_id)
+        if not ids:
+            del self._ids_by_cell[cell]
+
+    def candidates(self, min_lat, min_lon, max_lat, max_lon):
+        # Ids in every cell overlapping the box; callers check exact coordinates
+        low_row, low_col = self._cell(min_lat, min_lon)
+        high_row, high_col = self._cell(max_lat, max_lon)
+        if (high_row - low_row + 1) * (high_col - low_col + 1) > len(self._ids_by_cell):
+            # Huge box: walking the occupied cells is cheaper than walking the range
+            for (row, col), ids in self._ids_by_cell.items():
+                if low_row <= row <= high_row and low_col <= col <= high_col:
+                    yield from ids
+            return
+        for row in range(low_row, high_row + 1):
+            for col in range(low_col, high_col + 1):
+                yield from self._ids_by_cell.get((row, col), ())
+
+def rollup_keys(sighting):
+    # Months are keyed by their first day, like date_trunc('month', ...) in Postgres
+    return (sighting.species, sighting.date), (sighting.location, sighting.date[:7] + "-01")
+
+class SightingStore:
+    """In-memory sightings keyed by id, with a hash index for duplicate checks."""
+
+    def __init__(self):
+        self.sightings: Dict[int, object] = {}
+        self.next_id = 1
+        self._ids_by_key: Dict[Tuple[str, str, str, str], int] = {}
+        self._species_index = SubstringIndex()
+        self._location_index = SubstringIndex()
+        self._grid_index = GridIndex()
+        self._date_index = DateIndex()
+        # Rollups for the stats endpoints, maintained on every write
+        self.species_day_counts: Counter = Counter()      # (species, "YYYY-MM-DD") -> count
+        self.location_month_counts: Counter = Counter()   # (location, "YYYY-MM-01") -> count
+
+    def __len__(self):
+        return len(self.sightings)
+
+    def __contains__(self, sighting_id):
+        return sighting_id in self.sightings
+
+    def get(self, sighting_id):
+        return self.sightings.get(sighting_id)
+
+    def find_duplicate(self, species, location, date, time) -> Optional[int]:
+        return self._ids_by_key.get(duplicate_key(species, location, date, time))
+
+    def add(self, sighting) -> Optional[int]:
+        # Returns the new id, or None if an identical sighting is already stored
+        key = duplicate_key(sighting.species, sighting.location, sighting.date, sighting.time)
+        if key in self._ids_by_key:
+            return None
+
+        sighting_id = self.next_id
+        self.next_id += 1
+        self.sightings[sighting_id] = sighting
+        self._ids_by_key[key] = sighting_id
+        self._species_index.add(sighting.species, sighting_id)
+        self._location_index.add(sighting.location, sighting_id)
+        self._date_index.add(sighting.date, sighting_id)
+        if sighting.latitude is not None and sighting.longitude is not None:
+            self._grid_index.add(sighting.latitude, sighting.longitude, sighting_id)
+        self._count(sighting, 1)
+        return sighting_id
+
+    def add_many(self, sightings) -> List[Optional[int]]:
+        # Batched insert; each entry is the new id, or None for a duplicate
+        return [self.add(sighting) for sighting in sightings]
+
+    def update(self, sighting_id, location=None, date=None, time=None, latitude=None, longitude=None,
+               clear_position=False) -> bool:
+        # Returns False if the change would turn the sighting into a duplicate of another one
+        sighting = self.sightings[sighting_id]
+        old_key = duplicate_key(sighting.species, sighting.location, sighting.date, sighting.time)
+        new_key = duplicate_key(
+            sighting.species,
+            location if location is not None else sighting.location,
+            date if date is not None else sighting.date,
+            time if time is not None else sighting.time,
+        )
+        if self._ids_by_key.get(new_key, sighting_id) != sighting_id:
+            return False
+
+        self._count(sighting, -1)
+        if location is not None:
+            self._location_index.remove(sighting.location, sighting_id)
+            self._location_index.add(location, sighting_id)
+            sighting.location = location
+        if date is not None:
+            self._date_index.remove(sighting.date, sighting_id)
+            self._date_index.add(date, sighting_id)
+            sighting.date = date
+        if time is not None:
+            sighting.time = time
+        if clear_position or (latitude is not None and longitude is not None):
+            if sighting.latitude is not None and sighting.longitude is not None:
+                self._grid_index.remove(sighting.latitude, sighting.longitude, sighting_id)
+            sighting.latitude, sighting.longitude = latitude, longitude
+            if not clear_position:
+                self._grid_index.add(latitude, longitude, sighting_id)
+        self._count(sighting, 1)
+
+        del self._ids_by_key[old_key]
+        self._ids_by_key[new_key] = sighting_id
+        return True
+
+    def delete(self, sighting_id) -> bool:
+        sighting = self.sightings.pop(sighting_id, None)
+        if sighting is None:
+            return False
+        del self._ids_by_key[duplicate_key(sighting.species, sighting.location, sighting.date, sighting.time)]
+        self._species_index.remove(sighting.species, sighting_id)
+        self._location_index.remove(sighting.location, sighting_id)
+        self._date_index.remove(sighting.date, sighting_id)
+        if sighting.latitude is not None and sighting.longitude is not None:
+            self._grid_index.remove(sighting.latitude, sighting.longitude, sighting_id)
+        self._count(sighting, -1)
+        return True
+
+    def _count(self, sighting, delta):
+        species_day, location_month = rollup_keys(sighting)
+        for counts, key in ((self.species_day_counts, species_day), (self.location_month_counts, location_month)):
+            counts[key] += delta
+            if not counts[key]:
+                del counts[key]
+
+    def rebuild_rollups(self):
+        # Recomputes both rollups from the sightings and returns the groups whose
+        # maintained count differed, as {group: (maintained, actual)}
+        species_day, location_month = Counter(), Counter()
+        for sighting in self.sightings.values():
+            species_key, location_key = rollup_keys(sighting)
+            species_day[species_key] += 1
+            location_month[location_key] += 1
+
+        mismatches = {}
+        for maintained, actual in ((self.species_day_counts, species_day), (self.location_month_counts, location_month)):
+            for key in maintained.keys() | actual.keys():
+                if maintained[key] != actual[key]:
+                    mismatches[key] = (maintained[key], actual[key])
+        self.species_day_counts, self.location_month_counts = species_day, location_month
+        return mismatches
+
+    def search(self, species: Optional[str] = None, location: Optional[str] = None,
+               date_from: Optional[str] = None, date_to: Optional[str] = None,
+               time_from: Optional[str] = None, time_to: Optional[str] = None):
+        # Same matching as a case-insensitive `in` check on each text field; dates
+        # and times are inclusive ISO strings
+        matches = []
+        if species is not None:
+            matches.append(self._species_index.search(species))
+        if location is not None:
+            matches.append(self._location_index.search(location))
+        if date_from or date_to:
+            matches.append(self._date_index.search(date_from, date_to))
+
+        if not matches:
+            found = self.sightings.items()
+        else:
+            # Start from the most selective filter, then probe its ids against the
+            # other filters' sets; set intersection walks the smaller side, so the
+            # large id sets of common values are probed rather than copied
+            matches.sort(key=lambda sets: sum(map(len, sets)))
+            ids = set().union(*matches[0])
+            for sets in matches[1:]:
+                ids = set().union(*(ids & other for other in sets))
+            found = [(sighting_id, self.sightings[sighting_id]) for sighting_id in sorted(ids)]
+
+        if time_from or time_to:
+            found = [(sighting_id, sighting) for sighting_id, sighting in found
+                     if in_time_window(sighting.time, time_from, time_to)]
+        return list(found)
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        found = []
+        for sighting_id in self._grid_index.candidates(min_lat, min_lon, max_lat, max_lon):
+            sighting = self.sightings[sighting_id]
+            if min_lat <= sighting.latitude <= max_lat and min_lon <= sighting.longitude <= max_lon:
+                found.append((sighting_id, sighting))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def within_radius(self, lat, lon, radius_km):
+        # Boxes around the circle from the grid, then the exact great-circle distance
+        return [
+            (sighting_id, sighting) for sighting_id, sighting in within_boxes(self, radius_boxes(lat, lon, radius_km))
+            if haversine_km(lat, lon, sighting.latitude, sighting.longitude) <= radius_km
+        ]
+
+    def snapshot_state(self):
+        # Rows as columns for persistence.py. Walks every sighting, so it blocks the
+        # event loop for a moment on large stores; the columnar store copies arrays instead.
+        species, locations = {}, {}
+        arrays = {name: array(typecode) for name, typecode in (
+            ("ids", "I"), ("species_codes", "I"), ("location_codes", "I"), ("dates", "I"), ("minutes", "H"),
+            ("latitudes", "d"), ("longitudes", "d"),
+        )}
+        for sighting_id, sighting in self.sightings.items():
+            has_position = sighting.latitude is not None and sighting.longitude is not None
+            arrays["ids"].append(sighting_id)
+            arrays["species_codes"].append(species.setdefault(sighting.species, len(species)))
+            arrays["location_codes"].append(locations.setdefault(sighting.location, len(locations)))
+            arrays["dates"].append(pack_date(sighting.date))
+            arrays["minutes"].append(pack_time(sighting.time))
+            arrays["latitudes"].append(sighting.latitude if has_position else math.nan)
+            arrays["longitudes"].append(sighting.longitude if has_position else math.nan)
+        meta = {"layout": "rows", "next_id": self.next_id, "species": list(species), "locations": list(locations)}
+        return meta, arrays
+
+    def load_state(self, meta, arrays, make_sighting):
+        # Inverse of snapshot_state on an empty store; `make_sighting` builds the stored objects
+        if meta["layout"] != "rows":
+            raise ValueError(f"Snapshot was written by the {meta['layout']} store; set STORE_BACKEND to match.")
+        species, locations = meta["species"], meta["locations"]
+        for row, sighting_id in enumerate(arrays["ids"]):
+            latitude = arrays["latitudes"][row]
+            self.next_id = sighting_id
+            self.add(make_sighting(
+                species=species[arrays["species_codes"][row]],
+                location=locations[arrays["location_codes"][row]],
+                date=unpack_date(arrays["dates"][row]),
+                time=unpack_time(arrays["minutes"][row]),
+                latitude=None if math.isnan(latitude) else latitude,
+                longitude=None if math.isnan(latitude) else arrays["longitudes"][row],
+            ))
+        self.next_id = meta["next_id"]
+
+    def iter_from(self, after: int = 0):
+        # Ids are handed out in increasing order, so walking the id range from the
+        # cursor visits rows in keyset order without touching earlier entries
+        for sighting_id in range(after + 1, self.next_id):
+            sighting = self.sightings.get(sighting_id)
+            if sighting is not None:
+                yield sighting_id, sighting
+
+def create_store():
+    if STORE_BACKEND == "columnar":
+        from columnar import ColumnarSightingStore
+        return ColumnarSightingStore()
+    return SightingStore()
@@ -0,0 +1,37 @@
+import pytest
+
+import main
+from columnar import ColumnarSightingStore
+from store import SightingStore
+
+def sighting(latitude, longitude):
+    return main.Sighting(species="Whale", location=f"Pacific {longitude}", date="2024-01-01", time="10:00",
+                         latitude=latitude, longitude=longitude)
+
+@pytest.mark.parametrize("store_class", [SightingStore, ColumnarSightingStore])
+def test_radius_search_crosses_antimeridian(store_class):
+    store = store_class()
+    west = store.add(sighting(-17.0, 179.9))
+    east = store.add(sighting(-17.0, -179.9))
+    store.add(sighting(-17.0, 170.0))
+    # Both are about 21 km from either of them, on opposite sides of the antimeridian
+    assert [found for found, _ in store.within_radius(-17.0, 179.95, 50)] == [west, east]
+    assert [found for found, _ in store.within_radius(-17.0, -179.95, 50)] == [west, east]
+
+@pytest.mark.parametrize("store_class", [SightingStore, ColumnarSightingStore])
+def test_radius_search_over_the_pole(store_class):
+    store = store_class()
+    far_side = store.add(sighting(89.5, -90.0))
+    assert [found for found, _ in store.within_radius(89.5, 90.0, 200)] == [far_side]
+
+def test_bounding_box_across_antimeridian(monkeypatch):
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(main, "store", SightingStore())
+    monkeypatch.setattr(main, "persistence", None)
+    client = TestClient(main.app)
+    for longitude in (179.9, -179.9, 0.0):
+        client.post("/sightings/", json={"species": "Whale", "location": f"Pacific {longitude}", "date": "2024-01-01",
+                                         "time": "10:00", "latitude": -17.0, "longitude": longitude})
+    found = client.get("/sightings/near", params={"min_lat": -18, "min_lon": 179, "max_lat": -16, "max_lon": -179}).json()
+    assert [sighting["longitude"] for sighting in found] == [179.9, -179.9]
+    assert client.get("/sightings/near", params={"min_lat": -16, "min_lon": 0, "max_lat": -18, "max_lon": 1}).status_code == 400
@@ -0,0 +1,49 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from columnar import ColumnarSightingStore
+from store import SightingStore
+
+SIGHTING = {"species": "Lion", "location": "Serengeti", "date": "2024-01-01", "time": "10:00",
+            "latitude": -2.3, "longitude": 34.8}
+UNCHANGED = {"location": None, "date": None, "time": None}
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "store", SightingStore())
+    monkeypatch.setattr(main, "persistence", None)
+    return TestClient(main.app)
+
+def test_add_rejects_half_a_position(client):
+    lone = {key: value for key, value in SIGHTING.items() if key != "longitude"}
+    assert client.post("/sightings/", json=lone).status_code == 422
+    assert client.post("/sightings/", json={**SIGHTING, "longitude": None}).status_code == 422
+    assert client.get("/sightings/").status_code == 404
+
+def test_update_rejects_half_a_position(client):
+    sighting_id = client.post("/sightings/", json=SIGHTING).json()["id"]
+    assert client.put(f"/sightings/{sighting_id}", json={**UNCHANGED, "latitude": 1.0}).status_code == 422
+    assert client.put(f"/sightings/{sighting_id}", json={**UNCHANGED, "latitude": 1.0, "longitude": None}).status_code == 422
+    assert client.get(f"/sightings/{sighting_id}").json()["latitude"] == -2.3
+
+def test_update_moves_and_clears_position(client):
+    sighting_id = client.post("/sightings/", json=SIGHTING).json()["id"]
+    moved = client.put(f"/sightings/{sighting_id}", json={**UNCHANGED, "latitude": 1.0, "longitude": 2.0}).json()
+    assert (moved["latitude"], moved["longitude"]) == (1.0, 2.0)
+
+    kept = client.put(f"/sightings/{sighting_id}", json={**UNCHANGED, "time": "11:00"}).json()
+    assert (kept["latitude"], kept["longitude"]) == (1.0, 2.0)
+
+    cleared = client.put(f"/sightings/{sighting_id}", json={**UNCHANGED, "latitude": None, "longitude": None}).json()
+    assert (cleared["latitude"], cleared["longitude"]) == (None, None)
+
+@pytest.mark.parametrize("store_class", [SightingStore, ColumnarSightingStore])
+def test_cleared_position_leaves_radius_search(store_class):
+    store = store_class()
+    sighting_id = store.add(main.Sighting(**SIGHTING))
+    assert [found for found, _ in store.within_radius(-2.3, 34.8, 10)] == [sighting_id]
+
+    store.update(sighting_id, clear_position=True)
+    assert store.get(sighting_id).latitude is None
+    assert list(store.within_radius(-2.3, 34.8, 10)) == []
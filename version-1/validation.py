@@ -0,0 +1,57 @@
+import sys
+import time as clock
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+
+# Field checks behind the Sighting models, run once per record as it comes in.
+# Dates and times stay in their canonical YYYY-MM-DD and HH:MM strings; the
+# native values are parsed here and memoised, so code that needs a `date` or
+# `time` later (e.g. to bind a query parameter) gets it from the same cache.
+#
+# Sightings repeat the same values heavily (ten years of dates is under 4000
+# strings, a day has 1440 minutes), so most records cost a few dict lookups.
+# Names are normalised once per spelling and interned, so every equal species
+# or location shares one string object.
+
+@lru_cache(maxsize=8192)
+def parse_date(value: str) -> date:
+    # The model's pattern has already checked the YYYY-MM-DD shape
+    return date.fromisoformat(value)
+
+@lru_cache(maxsize=2048)
+def parse_time(value: str) -> time:
+    return time.fromisoformat(value)
+
+_today = date.min
+_today_ends = 0.0
+
+def today() -> date:
+    # The local date only changes at midnight, so it is looked up once a day
+    global _today, _today_ends
+    now = clock.time()
+    if now >= _today_ends:
+        _today = date.fromtimestamp(now)
+        _today_ends = datetime.combine(_today + timedelta(days=1), time.min).timestamp()
+    return _today
+
+def check_date(value: str) -> str:
+    if parse_date(value) > today():
+        raise ValueError('Date cannot be in the future.')
+    return value
+
+def check_time(value: str) -> str:
+    try:
+        parse_time(value)
+    except ValueError:
+        raise ValueError('Time must be in HH:MM format.')
+    return value
+
+@lru_cache(maxsize=65536)
+def normalize_name(value: str) -> str:
+    return sys.intern(value.strip().title())  # Capitalizes each word and removes extra spaces
+
+def check_position(latitude, longitude, sent) -> None:
+    # Coordinates come as a pair. `sent` is the model's fields_set: naming only
+    # one of the two, or giving one a value and the other null, is rejected.
+    if len({'latitude', 'longitude'} & sent) == 1 or (latitude is None) != (longitude is None):
+        raise ValueError('Send latitude and longitude together.')
@@ -0,0 +1,308 @@
+import csv
+import io
+import json
+from typing import List, Optional
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+import ingest
+import names
+
+MAX_BULK_ROWS = 100_000
+MAX_BATCH_ITEMS = 1000
+
+class BulkRejection(BaseModel):
+    index: int   # position of the row in the upload, starting at 0
+    detail: str
+
+class BulkSightingResponse(BaseModel):
+    inserted: int
+    rejected: List[BulkRejection]
+
+class BatchResult(BaseModel):
+    index: int                    # position of the item in the request, starting at 0
+    id: Optional[int] = None
+    status: int                   # what the single-sighting endpoint would have answered
+    version: Optional[int] = None # the sighting's version after the change, or its current one on 412
+    detail: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    applied: int
+    results: List[BatchResult]
+
+def parse_rows(body: bytes, content_type: Optional[str]):
+    # JSON array, NDJSON or CSV with a species,location,date,time header
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        text = body.decode("utf-8-sig")
+        if media_type == "text/csv":
+            # Empty CSV cells mean "not given", e.g. for the optional coordinates
+            rows = [{name: value if value != "" else None for name, value in row.items()}
+                    for row in csv.DictReader(io.StringIO(text))]
+        elif media_type in ("application/x-ndjson", "application/jsonl"):
+            rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            rows = json.loads(text)
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse upload: {e}")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of sightings.")
+    if len(rows) > MAX_BULK_ROWS:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {MAX_BULK_ROWS} sightings.")
+    return rows
+
+def error_detail(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in entry['loc'])}: {entry['msg']}" for entry in error.errors())
+
+def validate_rows(rows, model):
+    # Returns (index, sighting) pairs that passed validation and are unique within
+    # the batch, plus a rejection for every other row
+    accepted, rejected, first_index_by_key = [], [], {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            rejected.append(BulkRejection(index=index, detail="Expected an object with species, location, date and time."))
+            continue
+        if None in row:
+            # csv.DictReader files cells past the end of the header under None
+            rejected.append(BulkRejection(index=index, detail="Row has more cells than the header has columns."))
+            continue
+        try:
+            sighting = model(**row)
+        except ValidationError as e:
+            rejected.append(BulkRejection(index=index, detail=error_detail(e)))
+            continue
+
+        key = (sighting.species.lower(), sighting.location.lower(), sighting.date, sighting.time)
+        if key in first_index_by_key:
+            rejected.append(BulkRejection(index=index, detail=f"Duplicate of row {first_index_by_key[key]} in this batch."))
+            continue
+        first_index_by_key[key] = index
+        accepted.append((index, sighting))
+    return accepted, rejected
+
+def parse_items(body: bytes):
+    # JSON array of id-keyed changes for the batch endpoints
+    try:
+        items = json.loads(body.decode("utf-8-sig"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse request: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of changes.")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {MAX_BATCH_ITEMS} changes.")
+    return items
+
+def validate_items(items, model):
+    # Returns (index, item) pairs that passed validation, at most one per id,
+    # plus a result for every other item
+    accepted, rejected, first_index_by_id = [], [], {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            rejected.append(BatchResult(index=index, status=422, detail="Expected an object with an id."))
+            continue
+        try:
+            change = model(**item)
+        except ValidationError as e:
+            raw_id = item.get("id")
+            rejected.append(BatchResult(index=index, id=raw_id if isinstance(raw_id, int) else None,
+                                        status=422, detail=error_detail(e)))
+            continue
+
+        if change.id in first_index_by_id:
+            rejected.append(BatchResult(index=index, id=change.id, status=400,
+                                        detail=f"Same sighting as item {first_index_by_id[change.id]} in this batch."))
+            continue
+        first_index_by_id[change.id] = index
+        accepted.append((index, change))
+    return accepted, rejected
+
+# Staging rows are inserted in upload order; the CTE reports which rows made it
+# past the unique natural-key index so the rest can be reported as duplicates.
+# Two rows can name the same sighting through an alias; only the first is inserted.
+CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE sightings_staging (
+    row_index INTEGER NOT NULL,
+    species_id INTEGER NOT NULL,
+    location_id INTEGER NOT NULL,
+    date DATE NOT NULL,
+    time TIME NOT NULL,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION
+) ON COMMIT DROP;
+"""
+
+INSERT_FROM_STAGING = """
+WITH inserted AS (
+    INSERT INTO sightings (species_id, location_id, date, time, latitude, longitude)
+    SELECT species_id, location_id, date, time, latitude, longitude FROM sightings_staging ORDER BY row_index
+    ON CONFLICT (species_id, location_id, date, time) DO NOTHING
+    RETURNING id, species_id, location_id, date, time
+)
+SELECT min(staging.row_index), inserted.id
+FROM sightings_staging staging
+JOIN inserted USING (species_id, location_id, date, time)
+GROUP BY inserted.id;
+"""
+
+def copy_sightings(db, accepted):
+    # Loads the batch with COPY inside the session's transaction and returns the
+    # new id of each inserted row, by its index; the caller commits
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for index, sighting in accepted:
+        # Resolving may commit, which is why it happens before the staging table exists
+        species_id, _ = names.resolve_name(db, "species", sighting.species)
+        location_id, _ = names.resolve_name(db, "location", sighting.location)
+        writer.writerow((index, species_id, location_id, sighting.date, sighting.time,
+                         sighting.latitude, sighting.longitude))
+    buffer.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(CREATE_STAGING_TABLE)
+        cursor.copy_expert(
+            "COPY sightings_staging (row_index, species_id, location_id, date, time, latitude, longitude) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        cursor.execute(INSERT_FROM_STAGING)
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+# Queued writes' outcomes, shared by every worker; see ingest.py. Expired rows
+# are pruned by the same statement that records a batch.
+SAVE_TICKETS = text("""
+WITH pruned AS (
+    DELETE FROM ingest_tickets WHERE written_at < now() - make_interval(secs => :ttl)
+)
+INSERT INTO ingest_tickets (ticket, status, sighting_id, detail)
+SELECT * FROM unnest(CAST(:tickets AS VARCHAR[]), CAST(:statuses AS VARCHAR[]),
+                     CAST(:ids AS INTEGER[]), CAST(:details AS VARCHAR[]))
+ON CONFLICT (ticket) DO NOTHING;
+""")
+
+LOAD_TICKET = text("""
+SELECT status, sighting_id, detail FROM ingest_tickets
+WHERE ticket = :ticket AND written_at >= now() - make_interval(secs => :ttl);
+""")
+
+def save_ticket_statuses(db, statuses, ttl):
+    # (ticket, status) pairs as the write queue keeps them; the caller commits
+    db.execute(SAVE_TICKETS, {
+        "tickets": [ticket for ticket, _ in statuses], "statuses": [status["status"] for _, status in statuses],
+        "ids": [status.get("id") for _, status in statuses], "details": [status.get("detail") for _, status in statuses],
+        "ttl": ttl,
+    })
+
+def load_ticket_status(db, ticket, ttl):
+    row = db.execute(LOAD_TICKET, {"ticket": ticket, "ttl": ttl}).first()
+    return None if row is None else ingest.ticket_status(row.status, row.sighting_id, row.detail)
+
+def batch_results(accepted, applied, stale, duplicates=()):
+    # The result of each validated item, given the new version of every applied
+    # id (None for deletes), the current version of every stale one and the ids
+    # that collided with another sighting; any other id doesn't exist
+    results = []
+    for index, change in accepted:
+        if change.id in applied:
+            results.append(BatchResult(index=index, id=change.id, status=200, version=applied[change.id]))
+        elif change.id in duplicates:
+            results.append(BatchResult(index=index, id=change.id, status=400,
+                                       detail="Sighting already exists with the same details."))
+        elif change.id in stale:
+            results.append(BatchResult(index=index, id=change.id, status=412, version=stale[change.id],
+                                       detail="Sighting has changed since it was read."))
+        else:
+            results.append(BatchResult(index=index, id=change.id, status=404, detail="Sighting not found"))
+    return results
+
+# Batch changes arrive as one array per column and are joined to sightings by
+# id, through sighting_dates so each id only probes its date's partition (see
+# partitions.py). Fields a change leaves out keep their value; a change that
+# names a version only applies to that version. Every applied change bumps the
+# version, including one whose new date moves the row to another partition.
+PATCH_SIGHTINGS = text("""
+UPDATE sightings SET
+    species_id = coalesce(changes.species_id, sightings.species_id),
+    location_id = coalesce(changes.location_id, sightings.location_id),
+    date = coalesce(changes.date, sightings.date),
+    time = coalesce(changes.time, sightings.time),
+    latitude = CASE WHEN changes.set_latitude THEN changes.latitude ELSE sightings.latitude END,
+    longitude = CASE WHEN changes.set_longitude THEN changes.longitude ELSE sightings.longitude END,
+    version = sightings.version + 1
+FROM unnest(CAST(:ids AS INTEGER[]), CAST(:versions AS INTEGER[]), CAST(:species_ids AS INTEGER[]),
+            CAST(:location_ids AS INTEGER[]), CAST(:dates AS DATE[]), CAST(:times AS TIME[]),
+            CAST(:set_latitudes AS BOOLEAN[]), CAST(:latitudes AS DOUBLE PRECISION[]),
+            CAST(:set_longitudes AS BOOLEAN[]), CAST(:longitudes AS DOUBLE PRECISION[]))
+    AS changes(id, version, species_id, location_id, date, time, set_latitude, latitude, set_longitude, longitude)
+JOIN sighting_dates ON sighting_dates.id = changes.id
+WHERE sightings.id = changes.id AND sightings.date = sighting_dates.date
+  AND (changes.version IS NULL OR sightings.version = changes.version)
+RETURNING sightings.id, sightings.version;
+""")
+PATCH_COLUMNS = ("ids", "versions", "species_ids", "location_ids", "dates", "times",
+                 "set_latitudes", "latitudes", "set_longitudes", "longitudes")
+
+DELETE_SIGHTINGS = text("""
+DELETE FROM sightings USING unnest(CAST(:ids AS INTEGER[]), CAST(:versions AS INTEGER[])) AS targets(id, version)
+JOIN sighting_dates ON sighting_dates.id = targets.id
+WHERE sightings.id = targets.id AND sightings.date = sighting_dates.date
+  AND (targets.version IS NULL OR sightings.version = targets.version)
+RETURNING sightings.id;
+""")
+
+CURRENT_VERSIONS = text("""
+SELECT sightings.id, sightings.version FROM sighting_dates
+JOIN sightings ON sightings.id = sighting_dates.id AND sightings.date = sighting_dates.date
+WHERE sighting_dates.id = ANY(CAST(:ids AS INTEGER[]));
+""")
+
+def current_versions(db, ids):
+    # Of the ids a batch left untouched, those that exist were skipped for a stale version
+    if not ids:
+        return {}
+    return {row.id: row.version for row in db.execute(CURRENT_VERSIONS, {"ids": ids})}
+
+def patch_sightings(db, changes):
+    # Applies id-keyed partial changes inside the session's transaction; the
+    # caller commits. Returns the new version of each changed sighting, the
+    # current version of each one whose expected version was stale, and the ids
+    # whose change collided with another sighting.
+    rows = []
+    for change in changes:
+        # Resolving may commit, which is why it happens before any change is made
+        species_id = names.resolve_name(db, "species", change.species)[0] if change.species is not None else None
+        location_id = names.resolve_name(db, "location", change.location)[0] if change.location is not None else None
+        rows.append((change.id, change.version, species_id, location_id, change.date, change.time,
+                     "latitude" in change.model_fields_set, change.latitude,
+                     "longitude" in change.model_fields_set, change.longitude))
+
+    applied, duplicates = {}, set()
+    try:
+        with db.begin_nested():
+            updated = db.execute(PATCH_SIGHTINGS, dict(zip(PATCH_COLUMNS, (list(column) for column in zip(*rows)))))
+            applied.update((row.id, row.version) for row in updated)
+    except IntegrityError:
+        # Some change collides with another sighting; apply them one at a time,
+        # each in its own savepoint, to find out which
+        for values in rows:
+            try:
+                with db.begin_nested():
+                    updated = db.execute(PATCH_SIGHTINGS, dict(zip(PATCH_COLUMNS, ([value] for value in values))))
+                    applied.update((row.id, row.version) for row in updated)
+            except IntegrityError:
+                duplicates.add(values[0])
+    stale = current_versions(db, [values[0] for values in rows if values[0] not in applied and values[0] not in duplicates])
+    return applied, stale, duplicates
+
+def delete_sightings(db, targets):
+    # Deletes id-keyed targets in one statement; the caller commits. Returns the
+    # deleted ids and the current version of each sighting whose expected
+    # version was stale.
+    ids = [target.id for target in targets]
+    rows = db.execute(DELETE_SIGHTINGS, {"ids": ids, "versions": [target.version for target in targets]})
+    deleted = {row.id for row in rows}
+    return deleted, current_versions(db, [i for i in ids if i not in deleted])
@@ -0,0 +1,53 @@
+import math
+from sqlalchemy import and_, func, or_
+
+EARTH_RADIUS_KM = 6371.0088
+
+def radius_boxes(lat, lon, radius_km):
+    # Lat/lon boxes covering the circle, clamped at the poles. A circle over a
+    # pole spans every longitude; one that crosses the antimeridian gets a box
+    # on each side of it.
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, lat - lat_delta), min(90.0, lat + lat_delta)
+    if min_lat == -90.0 or max_lat == 90.0:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    lon_delta = lat_delta / math.cos(math.radians(lat))
+    if lon_delta >= 180.0:
+        return [(min_lat, -180.0, max_lat, 180.0)]
+    min_lon, max_lon = lon - lon_delta, lon + lon_delta
+    if min_lon < -180.0:
+        return [(min_lat, min_lon + 360.0, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+    if max_lon > 180.0:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon - 360.0)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+def bbox_boxes(min_lat, min_lon, max_lat, max_lon):
+    # A box whose min_lon is east of its max_lon crosses the antimeridian and is
+    # split in two there
+    if min_lon > max_lon:
+        return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+def within_bbox(table, min_lat, min_lon, max_lat, max_lon):
+    # Matches the expression and predicate of the ix_sightings_position GiST index
+    return and_(
+        table.c.latitude.isnot(None),
+        table.c.longitude.isnot(None),
+        func.point(table.c.longitude, table.c.latitude).op("<@")(
+            func.box(func.point(min_lon, min_lat), func.point(max_lon, max_lat))
+        ),
+    )
+
+def within_boxes(table, boxes):
+    return or_(*(within_bbox(table, *box) for box in boxes))
+
+def within_radius(table, lat, lon, radius_km):
+    # Index-backed box around the circle, then the exact great-circle (haversine) distance
+    lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+    row_lat, row_lon = func.radians(table.c.latitude), func.radians(table.c.longitude)
+    a = (func.power(func.sin((row_lat - lat_rad) * 0.5), 2)
+         + math.cos(lat_rad) * func.cos(row_lat) * func.power(func.sin((row_lon - lon_rad) * 0.5), 2))
+    return and_(
+        within_boxes(table, radius_boxes(lat, lon, radius_km)),
+        2 * EARTH_RADIUS_KM * func.asin(func.sqrt(a)) <= radius_km,
+    )
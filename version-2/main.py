@@ -1,13 +1,36 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel, Field, validator
+from fastapi import FastAPI, Header, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator, model_validator
 from sqlalchemy.orm import Session
-from datetime import datetime, date
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy import and_, delete, func, or_, select, true, union, update
+from datetime import date, time as dtime
 from typing import Dict, Optional
-from database import database, SessionLocal
-from models import SightingModel, Base
+from database import (database, engine, reads, ping, pool_stats, warm_up, SessionLocal, HEALTH_CHECK_TIMEOUT_SECONDS,
+                      READ_YOUR_WRITES_SECONDS)
+from models import (SightingModel, SightingDate, SpeciesDayCount, LocationMonthCount, Species, SpeciesAlias, Location,
+                    LocationAlias, SIGHTING_NATURAL_KEY, Base)
+from bulk import (BatchResponse, BulkRejection, BulkSightingResponse, batch_results, copy_sightings, delete_sightings,
+                  load_ticket_status, parse_items, parse_rows, patch_sightings, save_ticket_statuses, validate_items,
+                  validate_rows)
+from responses import ORJSONResponse, etag, if_match_version, sighting_record
+import asyncio
+import geo
+import ingest
+import names
+import validation
+import orjson
+import time
 
 app = FastAPI()
 
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+PRIMARY_UNTIL_COOKIE = "read_primary_until"
+
 # Dependency to get the database session
 def get_db():
     db = SessionLocal()
@@ -16,30 +39,100 @@ def get_db():
     finally:
         db.close()
 
+def wrote_recently(request: Request) -> bool:
+    # Set for READ_YOUR_WRITES_SECONDS after a write, so the client's reads see
+    # its own change even while the replicas lag behind
+    try:
+        return float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+# Session for query endpoints: a replica when any are configured and healthy
+def get_read_db(request: Request):
+    with reads.session(primary_only=wrote_recently(request)) as db:
+        yield db
+
+async def mark_writers(request: Request, call_next):
+    response = await call_next(request)
+    if request.method in WRITE_METHODS and response.status_code < 400:
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, str(time.time() + READ_YOUR_WRITES_SECONDS),
+                            max_age=max(1, round(READ_YOUR_WRITES_SECONDS)), httponly=True)
+    return response
+
+if reads.replicas:
+    app.middleware("http")(mark_writers)
+
+@app.exception_handler(OperationalError)
+@app.exception_handler(PoolTimeoutError)
+async def database_unavailable(request: Request, exc: Exception):
+    # The database is down or every connection is busy: 503, which clients and
+    # load balancers retry, instead of a 500
+    return ORJSONResponse({"detail": "Database unavailable"}, status_code=503, headers={"Retry-After": "1"})
+
 class Sighting(BaseModel):
     species: str = Field(..., min_length=1)
     location: str = Field(..., min_length=1)
     date: str = Field(..., pattern=r'^\d{4}-\d{2}-\d{2}$')  # YYYY-MM-DD
     time: str = Field(..., pattern=r'^\d{2}:\d{2}$')       # HH:MM
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
 
-    @validator('date')
+    @field_validator('date')
+    @classmethod
     def validate_date(cls, v):
-        sighting_date = datetime.strptime(v, '%Y-%m-%d').date()
-        if sighting_date > date.today():
-            raise ValueError('Date cannot be in the future.')
-        return v
+        return validation.check_date(v)
 
-    @validator('time')
+    @field_validator('time')
+    @classmethod
     def validate_time(cls, v):
-        try:
-            datetime.strptime(v, '%H:%M')
-        except ValueError:
-            raise ValueError('Time must be in HH:MM format.')
-        return v
+        return validation.check_time(v)
 
-    @validator('species', 'location')
+    @field_validator('species', 'location')
+    @classmethod
     def capitalize(cls, v):
-        return v.strip().title()  # Capitalizes each word and removes extra spaces
+        return validation.normalize_name(v)
+
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
+
+class SightingPatch(BaseModel):
+    # One item of PATCH /sightings/batch; fields left out keep their value
+    id: int
+    version: Optional[int] = None   # like If-Match: apply only to this version
+    species: Optional[str] = Field(None, min_length=1)
+    location: Optional[str] = Field(None, min_length=1)
+    date: Optional[str] = Field(None, pattern=r'^\d{4}-\d{2}-\d{2}$')
+    time: Optional[str] = Field(None, pattern=r'^\d{2}:\d{2}$')
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    # Same checks as Sighting; None leaves the field unchanged
+    @field_validator('date')
+    @classmethod
+    def validate_date(cls, v):
+        return validation.check_date(v) if v is not None else None
+
+    @field_validator('time')
+    @classmethod
+    def validate_time(cls, v):
+        return validation.check_time(v) if v is not None else None
+
+    @field_validator('species', 'location')
+    @classmethod
+    def capitalize(cls, v):
+        return validation.normalize_name(v) if v is not None else None
+
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
+
+class SightingRef(BaseModel):
+    # One item of DELETE /sightings/batch
+    id: int
+    version: Optional[int] = None
 
 class SightingResponse(BaseModel):
     id: int
@@ -47,86 +140,359 @@ class SightingResponse(BaseModel):
     location: str
     date: str
     time: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    version: int
+
+# kind -> (lookup table, alias table, alias id column); see names.py
+LOOKUPS = {
+    "species": (Species, SpeciesAlias, SpeciesAlias.species_id),
+    "location": (Location, LocationAlias, LocationAlias.location_id),
+}
+
+def matching_ids(kind: str, term: str):
+    # Ids whose name or one of its aliases contains `term`; the trigram index on
+    # the small lookup table answers it instead of a scan over every sighting
+    table, aliases, alias_id = LOOKUPS[kind]
+    # correlate(None): the outer query may join the same lookup table
+    return union(select(table.id).where(table.name.ilike(f"%{term}%")).correlate(None),
+                 select(alias_id).where(aliases.alias.ilike(f"%{term}%")).correlate(None))
+
+def named_id(kind: str, name: str):
+    # Id of the entry `name` stands for, alias first, as a scalar subquery
+    table, aliases, alias_id = LOOKUPS[kind]
+    return func.coalesce(select(alias_id).where(aliases.alias == name.lower()).correlate(None).scalar_subquery(),
+                         select(table.id).where(func.lower(table.name) == name.lower()).correlate(None).scalar_subquery())
+
+def stored_values(db: Session, sighting: Sighting):
+    # Column values with the names replaced by lookup-table ids, and the sighting
+    # as stored, i.e. with canonical names. Resolving may commit, so call it first.
+    species_id, species = names.resolve_name(db, "species", sighting.species)
+    location_id, location = names.resolve_name(db, "location", sighting.location)
+    values = {"species_id": species_id, "location_id": location_id, "date": sighting.date, "time": sighting.time,
+              "latitude": sighting.latitude, "longitude": sighting.longitude}
+    return values, {**sighting.dict(), "species": species, "location": location}
+
+def insert_batch(accepted):
+    # One transaction per batch of queued sightings; see ingest.py
+    with SessionLocal() as db:
+        inserted = copy_sightings(db, accepted)
+        db.commit()
+    return inserted
+
+async def write_batch(accepted):
+    # The session is synchronous, so the batch is written off the event loop
+    return await asyncio.to_thread(insert_batch, accepted)
+
+def record_tickets(statuses):
+    with SessionLocal() as db:
+        save_ticket_statuses(db, statuses, ingest.WRITE_TICKET_TTL_SECONDS)
+        db.commit()
+
+def read_ticket(ticket):
+    with SessionLocal() as db:
+        return load_ticket_status(db, ticket, ingest.WRITE_TICKET_TTL_SECONDS)
+
+async def save_tickets(statuses):
+    await asyncio.to_thread(record_tickets, statuses)
+
+async def load_ticket(ticket):
+    return await asyncio.to_thread(read_ticket, ticket)
+
+write_queue = ingest.WriteQueue(write_batch, save_tickets, load_ticket) if ingest.WRITE_QUEUE_ENABLED else None
+
+async def queue_sighting(sighting: Sighting):
+    try:
+        ticket = await write_queue.submit(sighting)
+    except ingest.QueueUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "1"})
+    return ORJSONResponse({"ticket": ticket, "status": "queued"}, status_code=202,
+                          headers={"Location": f"/sightings/tickets/{ticket}"})
 
 @app.post("/sightings/", response_model=SightingResponse)
-async def add_sighting(sighting: Sighting, db: Session = Depends(get_db)):
-    db_sighting = SightingModel(**sighting.dict())
-    
-    # Check for existing sightings
-    existing = db.query(SightingModel).filter(
-        SightingModel.species.ilike(sighting.species),
-        SightingModel.location.ilike(sighting.location),
-        SightingModel.date == sighting.date,
-        SightingModel.time == sighting.time,
-    ).first()
-
-    if existing:
+async def add_sighting(sighting: Sighting, response: Response, db: Session = Depends(get_db)):
+    if write_queue is not None:
+        # Answered with 202 and a ticket; the sighting is written with the next batch
+        return await queue_sighting(sighting)
+
+    # The unique natural-key index does the duplicate check in the same statement
+    values, stored = stored_values(db, sighting)
+    statement = (
+        insert(SightingModel)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=SIGHTING_NATURAL_KEY)
+        .returning(SightingModel.id, SightingModel.version)
+    )
+    created = db.execute(statement).first()
+    db.commit()
+
+    if created is None:
         raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
 
-    db.add(db_sighting)
+    response.headers["ETag"] = etag(created.version)
+    return SightingResponse(id=created.id, version=created.version, **stored)
+
+@app.post("/sightings/bulk", response_model=BulkSightingResponse)
+async def add_sightings_bulk(request: Request, db: Session = Depends(get_db)):
+    # Accepts a JSON array, NDJSON (application/x-ndjson) or CSV (text/csv)
+    rows = parse_rows(await request.body(), request.headers.get("content-type"))
+    accepted, rejected = validate_rows(rows, Sighting)
+
+    inserted = copy_sightings(db, accepted) if accepted else {}
     db.commit()
-    db.refresh(db_sighting)
-    return SightingResponse(id=db_sighting.id, **sighting.dict())
+    for index, _ in accepted:
+        if index not in inserted:
+            rejected.append(BulkRejection(index=index, detail="Sighting already exists with the same details."))
+
+    rejected.sort(key=lambda rejection: rejection.index)
+    return BulkSightingResponse(inserted=len(inserted), rejected=rejected)
+
+@app.get("/sightings/tickets/{ticket}")
+async def ticket_status(ticket: str):
+    # queued, inserted (with the new id), duplicate or failed, from whichever worker issued it
+    status = await write_queue.status(ticket) if write_queue is not None else None
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired ticket")
+    return ORJSONResponse({"ticket": ticket, **status})
+
+@app.patch("/sightings/batch", response_model=BatchResponse)
+async def patch_sightings_batch(request: Request, db: Session = Depends(get_db)):
+    # A JSON array of {"id", "version"?, ...fields to change}, applied in one
+    # transaction; each item gets the status PUT would have answered
+    accepted, results = validate_items(parse_items(await request.body()), SightingPatch)
+    applied, stale, duplicates = patch_sightings(db, [change for _, change in accepted]) if accepted else ({}, {}, set())
+    db.commit()
+
+    results.extend(batch_results(accepted, applied, stale, duplicates))
+    results.sort(key=lambda result: result.index)
+    return BatchResponse(applied=len(applied), results=results)
+
+@app.delete("/sightings/batch", response_model=BatchResponse)
+async def delete_sightings_batch(request: Request, db: Session = Depends(get_db)):
+    # A JSON array of {"id", "version"?}, deleted in one statement
+    accepted, results = validate_items(parse_items(await request.body()), SightingRef)
+    deleted, stale = delete_sightings(db, [target for _, target in accepted]) if accepted else (set(), {})
+    db.commit()
+
+    results.extend(batch_results(accepted, dict.fromkeys(deleted), stale))
+    results.sort(key=lambda result: result.index)
+    return BatchResponse(applied=len(deleted), results=results)
+
+def stream_sightings(after: int, limit: Optional[int], primary_only: bool):
+    # Uses its own session: the request-scoped one is closed before the body is sent.
+    # yield_per makes psycopg2 use a server-side cursor, so rows arrive in batches.
+    with reads.session(primary_only) as db:
+        query = db.query(SightingModel).filter(SightingModel.id > after).order_by(SightingModel.id)
+        if limit is not None:
+            query = query.limit(limit)
+        for sighting in query.yield_per(STREAM_BATCH_SIZE):
+            yield orjson.dumps(sighting_record(sighting)) + b"\n"
 
 @app.get("/sightings/", response_model=Dict[int, str])
-async def view_sightings(db: Session = Depends(get_db)):
-    sightings = db.query(SightingModel).all()
+async def view_sightings(request: Request, response: Response,
+                         limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                         after: int = Query(0, ge=0),
+                         stream: bool = False,
+                         structured: bool = False,
+                         db: Session = Depends(get_read_db)):
+    if stream:
+        return StreamingResponse(stream_sightings(after, limit, wrote_recently(request)), media_type="application/x-ndjson")
+
+    # Keyset pagination: seek past the last id the client has seen
+    query = db.query(SightingModel).filter(SightingModel.id > after).order_by(SightingModel.id)
+    if limit is not None:
+        query = query.limit(limit)
+    sightings = query.all()
     if not sightings:
         raise HTTPException(status_code=404, detail="No sightings recorded")
-    
+
+    headers = {}
+    if limit is not None and len(sightings) == limit:
+        # Pass the last id back as `after` to fetch the next page
+        headers["X-Next-Cursor"] = str(sightings[-1].id)
+
+    if structured:
+        # List of typed records, written by orjson without per-row model validation
+        return ORJSONResponse([sighting_record(sighting) for sighting in sightings], headers=headers)
+
+    response.headers.update(headers)
     return {sighting.id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}" for sighting in sightings}
 
 @app.get("/sightings/search/")
-async def search_sightings(species: Optional[str] = None, location: Optional[str] = None, db: Session = Depends(get_db)):
+async def search_sightings(species: Optional[str] = None, location: Optional[str] = None,
+                           date_from: Optional[date] = None, date_to: Optional[date] = None,
+                           time_from: Optional[dtime] = None, time_to: Optional[dtime] = None,
+                           structured: bool = False, db: Session = Depends(get_read_db)):
+    # Date bounds are inclusive and prune the monthly partitions; a time window
+    # whose start is after its end wraps past midnight
+    if time_from and time_to and time_from > time_to:
+        time_window = or_(SightingModel.time >= time_from, SightingModel.time <= time_to)
+    else:
+        time_window = and_(SightingModel.time >= time_from if time_from else true(),
+                           SightingModel.time <= time_to if time_to else true())
     found_sightings = db.query(SightingModel).filter(
-        (SightingModel.species.ilike(f"%{species}%") if species else True),
-        (SightingModel.location.ilike(f"%{location}%") if location else True)
-    ).all()
+        (SightingModel.species_id.in_(matching_ids("species", species)) if species else True),
+        (SightingModel.location_id.in_(matching_ids("location", location)) if location else True),
+        (SightingModel.date >= date_from if date_from else True),
+        (SightingModel.date <= date_to if date_to else True),
+        time_window,
+    ).order_by(SightingModel.id).all()
 
     if not found_sightings:
         raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
+
+    if structured:
+        return ORJSONResponse([sighting_record(sighting) for sighting in found_sightings])
     
     return {sighting.id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}" for sighting in found_sightings}
 
-@app.put("/sightings/{sighting_id}", response_model=SightingResponse)
-async def update_sighting(sighting_id: int, updated_sighting: Sighting, db: Session = Depends(get_db)):
-    sighting_to_update = db.query(SightingModel).filter(SightingModel.id == sighting_id).first()
+@app.get("/sightings/near")
+async def sightings_near(lat: Optional[float] = Query(None, ge=-90, le=90),
+                         lon: Optional[float] = Query(None, ge=-180, le=180),
+                         radius_km: Optional[float] = Query(None, gt=0),
+                         min_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         min_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         max_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         max_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         db: Session = Depends(get_read_db)):
+    # Either a radius around lat/lon or a min/max bounding box, served by the GiST index
+    table = SightingModel.__table__
+    if None not in (lat, lon, radius_km):
+        area = geo.within_radius(table, lat, lon, radius_km)
+    elif None not in (min_lat, min_lon, max_lat, max_lon):
+        if min_lat > max_lat:
+            raise HTTPException(status_code=400, detail="min_lat must not be greater than max_lat.")
+        # min_lon greater than max_lon is a box across the antimeridian
+        area = geo.within_boxes(table, geo.bbox_boxes(min_lat, min_lon, max_lat, max_lon))
+    else:
+        raise HTTPException(status_code=400, detail="Give lat, lon and radius_km, or min_lat, min_lon, max_lat and max_lon.")
+
+    found_sightings = db.query(SightingModel).filter(area).order_by(SightingModel.id).limit(limit).all()
+    if not found_sightings:
+        raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
+
+    return ORJSONResponse([sighting_record(sighting) for sighting in found_sightings])
 
-    if not sighting_to_update:
+@app.get("/sightings/stats/species-daily")
+async def species_daily_stats(species: Optional[str] = None, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                              db: Session = Depends(get_read_db)):
+    # Reads the trigger-maintained rollup instead of aggregating the sightings table
+    query = (db.query(Species.name, SpeciesDayCount.day, SpeciesDayCount.count)
+             .join(Species, Species.id == SpeciesDayCount.species_id)
+             .filter(SpeciesDayCount.count > 0))
+    if species:
+        query = query.filter(SpeciesDayCount.species_id == named_id("species", species.strip()))
+    if date_from:
+        query = query.filter(SpeciesDayCount.day >= date_from)
+    if date_to:
+        query = query.filter(SpeciesDayCount.day <= date_to)
+    groups = query.order_by(Species.name, SpeciesDayCount.day).all()
+    return ORJSONResponse([{"species": group.name, "date": group.day, "count": group.count} for group in groups])
+
+@app.get("/sightings/stats/location-monthly")
+async def location_monthly_stats(location: Optional[str] = None, month_from: Optional[date] = None, month_to: Optional[date] = None,
+                                 db: Session = Depends(get_read_db)):
+    # Months are identified by their first day, e.g. 2024-03-01
+    query = (db.query(Location.name, LocationMonthCount.month, LocationMonthCount.count)
+             .join(Location, Location.id == LocationMonthCount.location_id)
+             .filter(LocationMonthCount.count > 0))
+    if location:
+        query = query.filter(LocationMonthCount.location_id == named_id("location", location.strip()))
+    if month_from:
+        query = query.filter(LocationMonthCount.month >= month_from.replace(day=1))
+    if month_to:
+        query = query.filter(LocationMonthCount.month <= month_to.replace(day=1))
+    groups = query.order_by(Location.name, LocationMonthCount.month).all()
+    return ORJSONResponse([{"location": group.name, "month": group.month, "count": group.count} for group in groups])
+
+def by_id(sighting_id: int):
+    # The date comes from sighting_dates, so only that date's partition is searched
+    date = select(SightingDate.date).where(SightingDate.id == sighting_id).scalar_subquery()
+    return and_(SightingModel.id == sighting_id, SightingModel.date == date)
+
+@app.get("/sightings/{sighting_id}")
+async def get_sighting(sighting_id: int, db: Session = Depends(get_read_db)):
+    # Declared after the fixed /sightings/... paths so they are matched first
+    sighting = db.query(SightingModel).filter(by_id(sighting_id)).first()
+    if sighting is None:
         raise HTTPException(status_code=404, detail="Sighting not found")
+    return ORJSONResponse(sighting_record(sighting), headers={"ETag": etag(sighting.version)})
+
+def not_written(db: Session, sighting_id: int, expected_version: Optional[int]):
+    # The error for a single-row write that matched no row: 412 if the sighting
+    # is still there at another version, 404 otherwise
+    if expected_version is not None:
+        version = db.execute(select(SightingModel.version).where(by_id(sighting_id))).scalar()
+        if version is not None:
+            return HTTPException(status_code=412, detail="Sighting has changed since it was read.",
+                                 headers={"ETag": etag(version)})
+    return HTTPException(status_code=404, detail="Sighting not found")
+
+@app.put("/sightings/{sighting_id}", response_model=SightingResponse)
+async def update_sighting(sighting_id: int, updated_sighting: Sighting, response: Response,
+                          if_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    # One UPDATE ... RETURNING; with If-Match it only applies to that version
+    expected_version = if_match_version(if_match)
+    values, stored = stored_values(db, updated_sighting)
+    statement = update(SightingModel).where(by_id(sighting_id))
+    if expected_version is not None:
+        statement = statement.where(SightingModel.version == expected_version)
+    statement = statement.values(**values, version=SightingModel.version + 1).returning(SightingModel.version)
 
-    # Update fields
-    sighting_to_update.species = updated_sighting.species.title()
-    sighting_to_update.location = updated_sighting.location.title()
-    
-    # Validate new date
-    sighting_date = datetime.strptime(updated_sighting.date, '%Y-%m-%d').date()
-    if sighting_date > date.today():
-        raise HTTPException(status_code=400, detail='Date cannot be in the future.')
-    sighting_to_update.date = updated_sighting.date
-    
-    # Validate new time
     try:
-        datetime.strptime(updated_sighting.time, '%H:%M')
-    except ValueError:
-        raise HTTPException(status_code=400, detail='Invalid time format.')
-    sighting_to_update.time = updated_sighting.time
+        version = db.execute(statement).scalar()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
 
-    db.commit()
-    db.refresh(sighting_to_update)
-    
-    return SightingResponse(id=sighting_id, **sighting_to_update.__dict__)
+    if version is None:
+        raise not_written(db, sighting_id, expected_version)
+    response.headers["ETag"] = etag(version)
+    return SightingResponse(id=sighting_id, version=version, **stored)
 
 @app.delete("/sightings/{sighting_id}")
-async def delete_sighting(sighting_id: int, db: Session = Depends(get_db)):
-    sighting_to_delete = db.query(SightingModel).filter(SightingModel.id == sighting_id).first()
-    if not sighting_to_delete:
-        raise HTTPException(status_code=404, detail="Sighting not found")
-
-    db.delete(sighting_to_delete)
+async def delete_sighting(sighting_id: int, if_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    expected_version = if_match_version(if_match)
+    statement = delete(SightingModel).where(by_id(sighting_id))
+    if expected_version is not None:
+        statement = statement.where(SightingModel.version == expected_version)
+    deleted = db.execute(statement.returning(SightingModel.id)).scalar()
     db.commit()
+
+    if deleted is None:
+        raise not_written(db, sighting_id, expected_version)
     return {"detail": "Sighting deleted successfully"}
 
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and serving requests; the database isn't checked
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: the primary answers within HEALTH_CHECK_TIMEOUT_SECONDS. Replicas
+    # are probed and reported, but one being down doesn't make the API unready,
+    # because reads then go to the primary.
+    try:
+        await asyncio.wait_for(asyncio.to_thread(ping, engine), HEALTH_CHECK_TIMEOUT_SECONDS)
+        ready = True
+    except (OperationalError, PoolTimeoutError, asyncio.TimeoutError):
+        ready = False
+
+    body = {"status": "ready" if ready else "unavailable", "database": "up" if ready else "down",
+            "pool": pool_stats(engine)}
+    if reads.replicas:
+        body["replicas"] = await asyncio.to_thread(reads.check)
+    if write_queue is not None:
+        body["write_queue"] = {"depth": write_queue.depth}
+    return ORJSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/pool/stats")
+async def database_pool_stats():
+    return {"primary": pool_stats(engine), "replicas": [pool_stats(replica) for replica in reads.replicas]}
+
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Sighting Tracker API! Use /docs for more information."}
@@ -135,7 +501,14 @@ async def read_root():
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    # Open the session pool's connections before the first request needs one
+    await asyncio.to_thread(warm_up, engine)
+    if write_queue is not None:
+        write_queue.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    if write_queue is not None:
+        # Write out what is still queued before the connections close
+        await write_queue.stop()
     await database.disconnect()
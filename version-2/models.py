@@ -1,11 +1,100 @@
-from sqlalchemy import Column, Integer, String, Date, Time
+from sqlalchemy import BigInteger, Column, ForeignKey, Integer, String, Date, Time, Float, Index, func
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import relationship
 from database import Base
 
+# Lookup tables from names.py; sightings refer to them by id
+class Species(Base):
+    __tablename__ = "species"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ux_species_name", func.lower(name), unique=True),
+        Index("ix_species_name_trgm", name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+    )
+
+class SpeciesAlias(Base):
+    __tablename__ = "species_aliases"
+
+    alias = Column(String, primary_key=True)   # lowercased
+    species_id = Column(Integer, ForeignKey("species.id"), nullable=False)
+
+class Location(Base):
+    __tablename__ = "locations"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ux_locations_name", func.lower(name), unique=True),
+        Index("ix_locations_name_trgm", name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+    )
+
+class LocationAlias(Base):
+    __tablename__ = "location_aliases"
+
+    alias = Column(String, primary_key=True)   # lowercased
+    location_id = Column(Integer, ForeignKey("locations.id"), nullable=False)
+
 class SightingModel(Base):
     __tablename__ = "sightings"
 
-    id = Column(Integer, primary_key=True, index=True)
-    species = Column(String, index=True)
-    location = Column(String)
-    date = Column(Date)
+    id = Column(Integer, primary_key=True, autoincrement=True)   # from sightings_id_seq
+    species_id = Column(Integer, ForeignKey("species.id"), nullable=False)
+    location_id = Column(Integer, ForeignKey("locations.id"), nullable=False)
+    date = Column(Date, primary_key=True)
     time = Column(Time)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    version = Column(Integer, nullable=False, server_default="1")   # bumped by every update; sent as the ETag
+
+    # The names are loaded with each sighting, joined from the lookup tables
+    species_entry = relationship(Species, lazy="joined", innerjoin=True)
+    location_entry = relationship(Location, lazy="joined", innerjoin=True)
+    species = association_proxy("species_entry", "name")
+    location = association_proxy("location_entry", "name")
+
+    # Mirrors the indexes created in create_db.py. The table is range-partitioned by
+    # month on date, hence the (id, date) primary key; SightingDate keeps ids
+    # unique across partitions.
+    __table_args__ = (
+        Index("ux_sightings_natural_key", species_id, location_id, date, time, unique=True),
+        Index("ix_sightings_location_id", location_id),
+        Index("ix_sightings_position", func.point(longitude, latitude), postgresql_using="gist",
+              postgresql_where=latitude.isnot(None) & longitude.isnot(None)),
+        Index("ix_sightings_date_time", date, time),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+
+# id -> date of every sighting, kept by the triggers in partitions.py; id lookups
+# read the date here so they only touch that date's partition
+class SightingDate(Base):
+    __tablename__ = "sighting_dates"
+
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, nullable=False)
+
+# Conflict target for INSERT ... ON CONFLICT; must match ux_sightings_natural_key
+SIGHTING_NATURAL_KEY = [
+    SightingModel.species_id,
+    SightingModel.location_id,
+    SightingModel.date,
+    SightingModel.time,
+]
+
+# Rollup tables maintained by the triggers in rollups.py
+class SpeciesDayCount(Base):
+    __tablename__ = "sighting_counts_species_day"
+
+    species_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+class LocationMonthCount(Base):
+    __tablename__ = "sighting_counts_location_month"
+
+    location_id = Column(Integer, primary_key=True)
+    month = Column(Date, primary_key=True)
+    count = Column(BigInteger, nullable=False)
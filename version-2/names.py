@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import psycopg2
+from psycopg2 import sql
+from sqlalchemy import text
+
+from database import DATABASE_URL
+
+# Lookup tables for species and location names.
+#
+# sightings stores species_id and location_id instead of repeating the names in
+# every row. Each name is stored once, in the spelling it was first written
+# with; lookups fold case, so "lion" and "Lion" share an id. The alias tables
+# map other names for the same thing (e.g. "African Lion") to a canonical
+# entry. Writes resolve names through an in-process LRU cache, so a name costs a
+# query only the first time a worker sees it.
+#
+#   python names.py migrate                             # move the names of an existing sightings table here
+#   python names.py alias species|location ALIAS NAME   # resolve ALIAS to NAME from now on
+#   python names.py aliases                             # list the aliases
+#
+# A new alias reaches running workers once their cached entry for it expires,
+# after at most NAME_CACHE_TTL_SECONDS. Sightings a worker writes under the
+# alias's old entry until then are moved by running the alias command again.
+
+NAME_CACHE_MAX_ENTRIES = int(os.getenv("NAME_CACHE_MAX_ENTRIES", "10000"))
+NAME_CACHE_TTL_SECONDS = float(os.getenv("NAME_CACHE_TTL_SECONDS", "300"))
+
+# kind -> (lookup table, alias table, id column in sightings and the alias table)
+KINDS = {
+    "species": ("species", "species_aliases", "species_id"),
+    "location": ("locations", "location_aliases", "location_id"),
+}
+
+# Aliases are stored lowercased. The trigram index serves the searches, which
+# now scan a table of distinct names instead of every sighting.
+CREATE_NAME_TABLES = [
+    "CREATE TABLE IF NOT EXISTS {table} (id SERIAL PRIMARY KEY, name VARCHAR NOT NULL);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_name ON {table} (lower(name));",
+    "CREATE INDEX IF NOT EXISTS ix_{table}_name_trgm ON {table} USING gin (name gin_trgm_ops);",
+    """
+    CREATE TABLE IF NOT EXISTS {alias_table} (
+        alias VARCHAR PRIMARY KEY,
+        {id_column} INTEGER NOT NULL REFERENCES {table} (id)
+    );
+    """,
+]
+
+# (id, name) of the entry `name` stands for: an alias first, then the name
+# itself, and otherwise a new entry. Empty when a concurrent transaction added
+# the same name after this statement's snapshot; running it again finds that row.
+RESOLVE = """
+WITH aliased AS (
+    SELECT named.id, named.name FROM {alias_table} aliases
+    JOIN {table} named ON named.id = aliases.{id_column}
+    WHERE aliases.alias = lower(CAST(:name AS VARCHAR))
+),
+existing AS (
+    SELECT id, name FROM {table} WHERE lower(name) = lower(CAST(:name AS VARCHAR))
+),
+inserted AS (
+    INSERT INTO {table} (name)
+    SELECT CAST(:name AS VARCHAR) WHERE NOT EXISTS (SELECT 1 FROM aliased) AND NOT EXISTS (SELECT 1 FROM existing)
+    ON CONFLICT (lower(name)) DO NOTHING
+    RETURNING id, name
+)
+SELECT id, name FROM aliased
+UNION ALL SELECT id, name FROM existing WHERE NOT EXISTS (SELECT 1 FROM aliased)
+UNION ALL SELECT id, name FROM inserted
+"""
+RESOLVE_QUERIES = {kind: RESOLVE.format(table=table, alias_table=alias_table, id_column=id_column)
+                   for kind, (table, alias_table, id_column) in KINDS.items()}
+RESOLVE_ATTEMPTS = 3
+
+class NameCache:
+    """(id, canonical name) per case-folded name, bounded by entry count with a TTL per entry."""
+
+    def __init__(self, max_entries=NAME_CACHE_MAX_ENTRIES, ttl=NAME_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, kind: str, name: str) -> Optional[Tuple[int, str]]:
+        key = (kind, name.lower())
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, kind: str, name: str, value: Tuple[int, str]):
+        key = (kind, name.lower())
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+name_cache = NameCache()
+
+def resolve_name(db, kind: str, name: str) -> Tuple[int, str]:
+    # (id, canonical name) for `name`, adding it to the lookup table the first
+    # time. A miss commits the session, so that no cached id can be rolled back
+    # later; call it before the request makes changes of its own.
+    value = name_cache.get(kind, name)
+    if value is None:
+        for _ in range(RESOLVE_ATTEMPTS):
+            row = db.execute(text(RESOLVE_QUERIES[kind]), {"name": name}).first()
+            db.commit()
+            if row is not None:
+                break
+        else:
+            raise RuntimeError(f"Could not resolve {kind} {name!r}")
+        value = (row.id, row.name)
+        name_cache.set(kind, name, value)
+    return value
+
+def create_name_tables(cursor):
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    for table, alias_table, id_column in KINDS.values():
+        for statement in CREATE_NAME_TABLES:
+            cursor.execute(statement.format(table=table, alias_table=alias_table, id_column=id_column))
+
+def uses_lookup_tables(cursor) -> bool:
+    # False for a sightings table that still keeps the names as text
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'sightings' AND column_name = 'species';
+    """)
+    return cursor.fetchone() is None
+
+def add_alias(cursor, kind: str, alias: str, name: str):
+    # The alias's own entry, if it has one, stays in place: workers may still
+    # have its id cached and write sightings with it. Its sightings move to the
+    # target in this transaction, and the rollup triggers move their counts.
+    # A sighting already recorded under the target is the same sighting, so the
+    # copy under the alias is dropped rather than moved.
+    table, alias_table, id_column = KINDS[kind]
+    other_column = next(column for _, _, column in KINDS.values() if column != id_column)
+    cursor.execute(sql.SQL("SELECT id FROM {} WHERE lower(name) = lower(%s);").format(sql.Identifier(table)), (name,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"No {kind} is named {name!r}.")
+    cursor.execute(sql.SQL("SELECT id FROM {} WHERE lower(name) = lower(%s) AND id <> %s;")
+                   .format(sql.Identifier(table)), (alias, row[0]))
+    aliased = cursor.fetchone()
+    if aliased is not None:
+        params = {"alias_id": aliased[0], "target_id": row[0]}
+        cursor.execute(sql.SQL("""
+            DELETE FROM sightings copy USING sightings kept
+            WHERE copy.{id_column} = %(alias_id)s AND kept.{id_column} = %(target_id)s
+              AND kept.{other_column} = copy.{other_column} AND kept.date = copy.date AND kept.time = copy.time;
+        """).format(id_column=sql.Identifier(id_column), other_column=sql.Identifier(other_column)), params)
+        cursor.execute(sql.SQL("""
+            UPDATE sightings SET {id_column} = %(target_id)s, version = version + 1 WHERE {id_column} = %(alias_id)s;
+        """).format(id_column=sql.Identifier(id_column)), params)
+    cursor.execute(sql.SQL("""
+        INSERT INTO {alias_table} (alias, {id_column}) VALUES (lower(%s), %s)
+        ON CONFLICT (alias) DO UPDATE SET {id_column} = EXCLUDED.{id_column};
+    """).format(alias_table=sql.Identifier(alias_table), id_column=sql.Identifier(id_column)), (alias, row[0]))
+
+def list_aliases(cursor):
+    rows = []
+    for kind, (table, alias_table, id_column) in KINDS.items():
+        cursor.execute(sql.SQL("""
+            SELECT aliases.alias, named.name FROM {alias_table} aliases
+            JOIN {table} named ON named.id = aliases.{id_column} ORDER BY aliases.alias;
+        """).format(alias_table=sql.Identifier(alias_table), table=sql.Identifier(table),
+                    id_column=sql.Identifier(id_column)))
+        rows.extend((kind, alias, name) for alias, name in cursor.fetchall())
+    return rows
+
+def migrate(connection):
+    # One-off move of the species and location text columns into the lookup
+    # tables. Runs in one transaction and rewrites every row while holding an
+    # exclusive lock, so plan a maintenance window on large tables.
+    from rollups import create_rollups, rebuild
+
+    with connection.cursor() as cursor:
+        if uses_lookup_tables(cursor):
+            print("sightings already uses the lookup tables.")
+            return
+        cursor.execute("LOCK TABLE sightings IN ACCESS EXCLUSIVE MODE;")
+        create_name_tables(cursor)
+        # The old triggers read the text columns; they are recreated below
+        for operation in ("insert", "update", "delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS sightings_rollup_{operation} ON sightings;")
+
+        for kind, (table, _, id_column) in KINDS.items():
+            # kind is also the old column's name
+            cursor.execute(sql.SQL("""
+                INSERT INTO {table} (name)
+                SELECT DISTINCT ON (lower({column})) {column} FROM sightings ORDER BY lower({column}), {column}
+                ON CONFLICT (lower(name)) DO NOTHING;
+            """).format(table=sql.Identifier(table), column=sql.Identifier(kind)))
+        cursor.execute("""
+            ALTER TABLE sightings ADD COLUMN species_id INTEGER, ADD COLUMN location_id INTEGER;
+            UPDATE sightings SET species_id = species.id, location_id = locations.id
+            FROM species, locations
+            WHERE lower(species.name) = lower(sightings.species) AND lower(locations.name) = lower(sightings.location);
+            ALTER TABLE sightings
+                ALTER COLUMN species_id SET NOT NULL,
+                ALTER COLUMN location_id SET NOT NULL,
+                ADD FOREIGN KEY (species_id) REFERENCES species (id),
+                ADD FOREIGN KEY (location_id) REFERENCES locations (id);
+            ALTER TABLE sightings DROP COLUMN species, DROP COLUMN location;
+        """)
+
+        # The rollups are keyed by id now
+        cursor.execute("DROP TABLE IF EXISTS sighting_counts_species_day, sighting_counts_location_month;")
+        create_rollups(cursor)
+        rebuild(cursor)
+    connection.commit()
+    print("Moved the names to the lookup tables; run create_db.py to recreate the sightings indexes.")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "aliases"
+    if command == "alias" and (len(sys.argv) != 5 or sys.argv[2] not in KINDS):
+        sys.exit("usage: python names.py alias species|location ALIAS NAME")
+
+    connection = psycopg2.connect(DATABASE_URL)
+    try:
+        if command == "migrate":
+            migrate(connection)
+        elif command == "alias":
+            with connection.cursor() as cursor:
+                try:
+                    add_alias(cursor, sys.argv[2], sys.argv[3], sys.argv[4])
+                except ValueError as e:
+                    sys.exit(str(e))
+            connection.commit()
+        elif command == "aliases":
+            with connection.cursor() as cursor:
+                for kind, alias, name in list_aliases(cursor):
+                    print(f"{kind:9} {alias:30} -> {name}")
+        else:
+            sys.exit(f"Unknown command {command!r}; use migrate, alias or aliases.")
+    finally:
+        connection.close()
@@ -0,0 +1,262 @@
+import os
+import sys
+from datetime import date
+from typing import Optional
+
+import psycopg2
+from psycopg2 import sql
+
+from database import DATABASE_URL
+
+# Monthly range partitions of the sightings table on `date`.
+#
+# Every month has its own partition, named sightings_yYYYYmMM, and a
+# sightings_history partition holds everything before the first month. There is
+# deliberately no DEFAULT partition, because a default partition would rule out
+# DETACH ... CONCURRENTLY. The API rejects future dates, so the only upkeep is
+# creating partitions ahead of time; `create` is idempotent and safe to run
+# from cron.
+#
+#   python partitions.py create [MONTHS_AHEAD]   # add missing partitions (default 12 months ahead)
+#   python partitions.py list                    # partitions with their bounds and row estimates
+#   python partitions.py detach YYYY-MM          # detach a month without blocking the live table
+#   python partitions.py migrate                 # convert an unpartitioned sightings table
+#
+# A detached month moves to the `archive` schema. It keeps its rows, which can
+# be dumped or dropped from there, but it no longer counts towards the
+# sightings table or the stats rollups.
+#
+# The table's primary key has to include `date`, so on its own it would neither
+# keep ids unique across partitions nor let a lookup by id skip the partitions
+# that don't hold it. sighting_dates maps every id to its date; its primary key
+# keeps ids unique, and id-keyed reads and writes look the date up there first
+# so they touch a single partition. Statement-level triggers keep it current,
+# at the cost of one more index entry per inserted sighting and one more row
+# update when a sighting's date changes. A new date in another month moves the
+# row to that month's partition, as an update that bumps its version like any other.
+
+ARCHIVE_SCHEMA = "archive"
+# Months before this one are kept in sightings_history
+FIRST_MONTH = date.fromisoformat(os.getenv("PARTITION_FIRST_MONTH", "2020-01-01"))
+MONTHS_AHEAD = 12
+
+CREATE_PARTITIONED_TABLE = """
+CREATE TABLE IF NOT EXISTS sightings (
+    id INTEGER NOT NULL DEFAULT nextval('sightings_id_seq'),
+    species_id INTEGER NOT NULL REFERENCES species (id),
+    location_id INTEGER NOT NULL REFERENCES locations (id),
+    date DATE NOT NULL,
+    time TIME NOT NULL,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    version INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (id, date)
+) PARTITION BY RANGE (date);
+"""
+
+CREATE_DATE_TABLE = "CREATE TABLE IF NOT EXISTS sighting_dates (id INTEGER PRIMARY KEY, date DATE NOT NULL);"
+
+# What each trigger does to sighting_dates; ids never change, dates may
+DATE_CHANGES = {
+    "insert": "INSERT INTO sighting_dates (id, date) SELECT id, date FROM new_rows",
+    "update": "UPDATE sighting_dates SET date = new_rows.date FROM new_rows "
+              "WHERE sighting_dates.id = new_rows.id AND sighting_dates.date <> new_rows.date",
+    "delete": "DELETE FROM sighting_dates USING old_rows WHERE sighting_dates.id = old_rows.id",
+}
+
+DATE_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION sightings_dates_{operation}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    {change};
+    RETURN NULL;
+END;
+$$;
+"""
+
+DATE_TRIGGER = """
+DROP TRIGGER IF EXISTS sightings_dates_{operation} ON sightings;
+CREATE TRIGGER sightings_dates_{operation} AFTER {event} ON sightings
+REFERENCING {transition_tables}
+FOR EACH STATEMENT EXECUTE FUNCTION sightings_dates_{operation}();
+"""
+
+DATE_TRANSITION_TABLES = {
+    "insert": "NEW TABLE AS new_rows",
+    "delete": "OLD TABLE AS old_rows",
+    "update": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+}
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f"sightings_y{month.year:04d}m{month.month:02d}"
+
+def is_partitioned(cursor) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('sightings');")
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+def create_table(cursor):
+    # The sequence is created separately (rather than through SERIAL) so that
+    # `migrate` can hand the existing one over to the partitioned table
+    cursor.execute("CREATE SEQUENCE IF NOT EXISTS sightings_id_seq AS INTEGER;")
+    cursor.execute(CREATE_PARTITIONED_TABLE)
+    cursor.execute("ALTER SEQUENCE sightings_id_seq OWNED BY sightings.id;")
+
+def create_date_lookup(cursor):
+    # Creating the triggers locks out writers until the caller commits, so the
+    # backfill below can't miss a row. It fails if two partitions share an id.
+    cursor.execute(CREATE_DATE_TABLE)
+    for operation, change in DATE_CHANGES.items():
+        cursor.execute(DATE_TRIGGER_FUNCTION.format(operation=operation, change=change))
+        cursor.execute(DATE_TRIGGER.format(operation=operation, event=operation.upper(),
+                                           transition_tables=DATE_TRANSITION_TABLES[operation]))
+    cursor.execute("INSERT INTO sighting_dates (id, date) SELECT id, date FROM sightings ON CONFLICT (id) DO NOTHING;")
+
+def create_partitions(cursor, first_month: date = FIRST_MONTH, months_ahead: int = MONTHS_AHEAD):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS sightings_history PARTITION OF sightings FOR VALUES FROM (MINVALUE) TO (%s);",
+        (first_month,),
+    )
+    last_month = add_months(date.today().replace(day=1), months_ahead)
+    month = first_month
+    while month <= last_month:
+        cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF sightings FOR VALUES FROM (%s) TO (%s);")
+            .format(sql.Identifier(partition_name(month))),
+            (month, add_months(month, 1)),
+        )
+        month = add_months(month, 1)
+
+def list_partitions(cursor):
+    cursor.execute("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid), child.reltuples::bigint
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'sightings'::regclass
+        ORDER BY child.relname;
+    """)
+    return cursor.fetchall()
+
+def partition_state(cursor, name: str) -> Optional[str]:
+    # "attached", "pending" (a DETACH ... CONCURRENTLY that was interrupted),
+    # "detached" (no longer attached, not yet archived), "archived" or None
+    cursor.execute("""
+        SELECT namespace.nspname = %s, inherits.inhrelid IS NOT NULL, coalesce(inherits.inhdetachpending, false)
+        FROM pg_class child
+        JOIN pg_namespace namespace ON namespace.oid = child.relnamespace
+        LEFT JOIN pg_inherits inherits ON inherits.inhrelid = child.oid AND inherits.inhparent = 'sightings'::regclass
+        WHERE child.relname = %s AND namespace.nspname IN (current_schema(), %s);
+    """, (ARCHIVE_SCHEMA, name, ARCHIVE_SCHEMA))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    archived, attached, pending = row
+    return "archived" if archived else "pending" if pending else "attached" if attached else "detached"
+
+def detach(connection, month: date) -> bool:
+    # DETACH ... CONCURRENTLY (PostgreSQL 14+) only takes a SHARE UPDATE EXCLUSIVE
+    # lock on the parent, so reads and writes on other months carry on. It can't
+    # run inside a transaction block, hence autocommit for that step. Everything
+    # after it happens in one transaction, so if that fails, running detach
+    # again picks up where it stopped. Returns False if the month was already archived.
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        state = partition_state(cursor, name)
+    connection.rollback()
+    if state is None:
+        raise ValueError(f"There is no partition {name}.")
+    if state == "archived":
+        return False
+    if state != "detached":
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            step = "FINALIZE" if state == "pending" else "CONCURRENTLY"
+            cursor.execute(sql.SQL("ALTER TABLE sightings DETACH PARTITION {} {};")
+                           .format(sql.Identifier(name), sql.SQL(step)))
+        connection.autocommit = False
+
+    # Detaching fires no triggers, so this transaction does their work before it
+    # moves the table to the archive schema. No partition holds the month any
+    # more, so its rollup counts are now zero; setting them to zero (rather
+    # than subtracting the month's rows) comes out the same however often it runs.
+    next_month = add_months(month, 1)
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(ARCHIVE_SCHEMA)))
+        cursor.execute("UPDATE sighting_counts_species_day SET count = 0 WHERE day >= %s AND day < %s AND count <> 0;",
+                       (month, next_month))
+        cursor.execute("UPDATE sighting_counts_location_month SET count = 0 WHERE month = %s AND count <> 0;", (month,))
+        cursor.execute(sql.SQL("DELETE FROM sighting_dates USING {table} WHERE sighting_dates.id = {table}.id;")
+                       .format(table=sql.Identifier(name)))
+        cursor.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {};").format(sql.Identifier(name), sql.Identifier(ARCHIVE_SCHEMA)))
+    connection.commit()
+    return True
+
+def migrate(connection):
+    # One-off conversion of a plain sightings table. Runs in one transaction and
+    # holds an exclusive lock on the old table while rows are copied, so plan
+    # a maintenance window on large tables.
+    from rollups import create_rollups
+    from names import uses_lookup_tables
+
+    with connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            print("sightings is already partitioned.")
+            return
+        if not uses_lookup_tables(cursor):
+            print("Run `python names.py migrate` first; the new table refers to the lookup tables.")
+            return
+        cursor.execute("LOCK TABLE sightings IN ACCESS EXCLUSIVE MODE;")
+        cursor.execute("SELECT min(date) FROM sightings;")
+        oldest = cursor.fetchone()[0]
+        cursor.execute("ALTER TABLE sightings RENAME TO sightings_unpartitioned;")
+        # Index names are schema-wide, so free them for the new table
+        cursor.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = 'sightings_unpartitioned' AND indexname LIKE '%sightings%';
+        """)
+        for (index_name,) in cursor.fetchall():
+            cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {};").format(
+                sql.Identifier(index_name), sql.Identifier(index_name + "_unpartitioned")))
+
+        create_table(cursor)
+        first_month = min(FIRST_MONTH, oldest.replace(day=1)) if oldest else FIRST_MONTH
+        create_partitions(cursor, first_month)
+        # No rollup triggers exist on the new table yet, so the copy leaves the rollups alone
+        cursor.execute("""
+            INSERT INTO sightings (id, species_id, location_id, date, time, latitude, longitude)
+            SELECT id, species_id, location_id, date, time, latitude, longitude FROM sightings_unpartitioned;
+        """)
+        cursor.execute("DROP TABLE sightings_unpartitioned;")
+        create_date_lookup(cursor)
+        create_rollups(cursor)
+    connection.commit()
+    print("Migrated sightings to a partitioned table; run create_db.py to recreate its indexes.")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    connection = psycopg2.connect(DATABASE_URL)
+    try:
+        if command == "create":
+            with connection.cursor() as cursor:
+                create_partitions(cursor, months_ahead=int(sys.argv[2]) if len(sys.argv) > 2 else MONTHS_AHEAD)
+            connection.commit()
+        elif command == "list":
+            with connection.cursor() as cursor:
+                for name, bounds, rows in list_partitions(cursor):
+                    print(f"{name:24} {bounds:60} ~{max(rows, 0)} rows")
+        elif command == "detach":
+            month = date.fromisoformat(sys.argv[2] + "-01")
+            try:
+                if not detach(connection, month):
+                    print(f"{partition_name(month)} is already in the {ARCHIVE_SCHEMA} schema.")
+            except ValueError as e:
+                sys.exit(str(e))
+        elif command == "migrate":
+            migrate(connection)
+        else:
+            sys.exit(f"Unknown command {command!r}; use create, list, detach or migrate.")
+    finally:
+        connection.close()
@@ -0,0 +1,129 @@
+import sys
+import psycopg2
+
+from database import DATABASE_URL
+
+# Pre-aggregated sighting counts for the stats endpoints.
+#
+# Statement-level triggers with transition tables keep the rollups current for
+# every write path (single inserts, bulk COPY loads, updates and deletes) and
+# fold a whole statement into one upsert per group. Groups are keyed by the
+# species and location ids from names.py. Groups that drop to zero keep their
+# row with count 0; readers filter on count > 0.
+#
+#   python rollups.py rebuild   # recompute both rollups from the sightings table
+#   python rollups.py verify    # compare the rollups with the table, exit 1 on mismatch
+
+
+CREATE_ROLLUP_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS sighting_counts_species_day (
+        species_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (species_id, day)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sighting_counts_location_month (
+        location_id INTEGER NOT NULL,
+        month DATE NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (location_id, month)
+    );
+    """,
+]
+
+# Rows each trigger contributes: +1 per new row, -1 per old row
+ROLLUP_DELTAS = {
+    "insert": "SELECT species_id, location_id, date, 1 AS delta FROM new_rows",
+    "delete": "SELECT species_id, location_id, date, -1 AS delta FROM old_rows",
+    "update": "SELECT species_id, location_id, date, 1 AS delta FROM new_rows "
+              "UNION ALL SELECT species_id, location_id, date, -1 FROM old_rows",
+}
+
+TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION sightings_rollup_{operation}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    WITH delta AS ({deltas}),
+    species_day AS (
+        INSERT INTO sighting_counts_species_day AS counts (species_id, day, count)
+        SELECT species_id, date, sum(delta) FROM delta GROUP BY species_id, date HAVING sum(delta) <> 0
+        ON CONFLICT (species_id, day) DO UPDATE SET count = counts.count + EXCLUDED.count
+    )
+    INSERT INTO sighting_counts_location_month AS counts (location_id, month, count)
+    SELECT location_id, date_trunc('month', date)::date, sum(delta) FROM delta GROUP BY 1, 2 HAVING sum(delta) <> 0
+    ON CONFLICT (location_id, month) DO UPDATE SET count = counts.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$;
+"""
+
+TRIGGER = """
+DROP TRIGGER IF EXISTS sightings_rollup_{operation} ON sightings;
+CREATE TRIGGER sightings_rollup_{operation} AFTER {event} ON sightings
+REFERENCING {transition_tables}
+FOR EACH STATEMENT EXECUTE FUNCTION sightings_rollup_{operation}();
+"""
+
+TRANSITION_TABLES = {
+    "insert": "NEW TABLE AS new_rows",
+    "delete": "OLD TABLE AS old_rows",
+    "update": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+}
+
+ACTUAL_COUNTS = {
+    "sighting_counts_species_day": "SELECT species_id, date, count(*) FROM sightings GROUP BY species_id, date",
+    "sighting_counts_location_month": "SELECT location_id, date_trunc('month', date)::date, count(*) FROM sightings GROUP BY 1, 2",
+}
+
+def create_rollups(cursor):
+    for statement in CREATE_ROLLUP_TABLES:
+        cursor.execute(statement)
+    for operation, deltas in ROLLUP_DELTAS.items():
+        cursor.execute(TRIGGER_FUNCTION.format(operation=operation, deltas=deltas))
+        cursor.execute(TRIGGER.format(operation=operation, event=operation.upper(),
+                                      transition_tables=TRANSITION_TABLES[operation]))
+
+def rebuild(cursor):
+    # SHARE mode blocks writers (and so the triggers) until the rebuild commits
+    cursor.execute("LOCK TABLE sightings IN SHARE MODE;")
+    for table, query in ACTUAL_COUNTS.items():
+        cursor.execute(f"TRUNCATE {table};")
+        cursor.execute(f"INSERT INTO {table} {query};")
+
+def verify(cursor):
+    # Returns (table, group, rollup count, actual count) for every group that differs
+    mismatches = []
+    cursor.execute("LOCK TABLE sightings IN SHARE MODE;")
+    for table, query in ACTUAL_COUNTS.items():
+        cursor.execute(f"""
+            SELECT coalesce(actual.name_id, rollup.name_id), coalesce(actual.period, rollup.period),
+                   coalesce(rollup.count, 0), coalesce(actual.count, 0)
+            FROM ({query}) AS actual (name_id, period, count)
+            FULL OUTER JOIN (SELECT * FROM {table} WHERE count <> 0) AS rollup (name_id, period, count)
+                ON rollup.name_id = actual.name_id AND rollup.period = actual.period
+            WHERE coalesce(rollup.count, 0) <> coalesce(actual.count, 0);
+        """)
+        mismatches.extend((table, (name_id, str(period)), rollup, actual) for name_id, period, rollup, actual in cursor.fetchall())
+    return mismatches
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    if command not in ("rebuild", "verify"):
+        sys.exit("usage: python rollups.py [rebuild|verify]")
+
+    connection = psycopg2.connect(DATABASE_URL)
+    try:
+        with connection.cursor() as cursor:
+            if command == "rebuild":
+                rebuild(cursor)
+            mismatches = verify(cursor)
+        connection.commit()
+    finally:
+        connection.close()
+
+    for table, group, rollup, actual in mismatches:
+        print(f"{table} {group}: rollup {rollup}, actual {actual}")
+    print(f"{command}: {'OK' if not mismatches else f'{len(mismatches)} mismatched groups'}")
+    sys.exit(1 if mismatches else 0)
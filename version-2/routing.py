@@ -0,0 +1,72 @@
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+# Read routing across a primary and its streaming replicas.
+#
+# Read sessions rotate over the replicas; writes always use the primary. A
+# replica whose connection check fails is skipped for REPLICA_RETRY_SECONDS and
+# the session goes to the primary instead. The check happens when the session is
+# opened (pool_pre_ping), so a replica that dies in the middle of a request
+# still fails that request.
+
+logger = logging.getLogger(__name__)
+
+class ReadRouter:
+    """Opens read sessions on a replica, or on the primary when none is healthy."""
+
+    def __init__(self, primary_sessions, replica_engines=(), retry_seconds: float = 5):
+        self.primary_sessions = primary_sessions
+        self.replicas = list(replica_engines)
+        self.retry_seconds = retry_seconds
+        self._down_until = [0.0] * len(self.replicas)
+        self._rotation = itertools.cycle(range(len(self.replicas)))
+
+    def _failed(self, index, exc):
+        self._down_until[index] = time.monotonic() + self.retry_seconds
+        logger.warning("Replica %d failed (%s); reading from the primary for %gs", index, exc.orig, self.retry_seconds)
+
+    def _replica_connection(self):
+        now = time.monotonic()
+        for _ in self.replicas:
+            index = next(self._rotation)
+            if self._down_until[index] > now:
+                continue
+            try:
+                return self.replicas[index].connect()
+            except OperationalError as exc:
+                self._failed(index, exc)
+        return None
+
+    def check(self):
+        # Probes every replica, as the readiness check does. One that fails is
+        # skipped as if a read had failed; one that answers is used again right
+        # away. Returns "up" or "down" per replica.
+        states = []
+        for index, replica in enumerate(self.replicas):
+            try:
+                with replica.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except OperationalError as exc:
+                self._failed(index, exc)
+                states.append("down")
+            else:
+                self._down_until[index] = 0.0
+                states.append("up")
+        return states
+
+    @contextmanager
+    def session(self, primary_only: bool = False):
+        connection = None if primary_only else self._replica_connection()
+        db = Session(bind=connection, autoflush=False) if connection is not None else self.primary_sessions()
+        try:
+            yield db
+        finally:
+            db.close()
+            if connection is not None:
+                connection.close()
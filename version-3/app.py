@@ -1,76 +1,128 @@
 import streamlit as st
+import pandas as pd
 import requests
-from datetime import datetime
+import json
+from datetime import datetime, time as dtime
+from requests.adapters import HTTPAdapter
 
 API_URL = "http://localhost:8000"
+PAGE_SIZE = 1000            # sightings per request when loading the full listing
+CACHE_TTL_SECONDS = 30      # lifetime of cached lookups and listings
+TABLE_PAGE_SIZES = [25, 50, 100, 500]
+
+@st.cache_resource
+def http_session():
+    # One pooled session for the whole Streamlit server, so reruns reuse open connections
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def invalidate_cached_reads():
+    # Called after every successful write so no screen shows what was just changed
+    fetch_all_sightings.clear()
+    search_sightings.clear()
+    get_sighting.clear()
 
 def add_sighting(species, location, date, time):
-    response = requests.post(f"{API_URL}/sightings/", json={
+    response = http_session().post(f"{API_URL}/sightings/", json={
         "species": species,
         "location": location,
         "date": date,
         "time": time
     })
+    if response.status_code in (200, 202):   # 202: queued by the write queue, written within moments
+        invalidate_cached_reads()
     return response
 
+@st.cache_data(ttl=CACHE_TTL_SECONDS)
+def fetch_all_sightings():
+    # Full listing, page by page, with the X-Change-Seq of the first page: applying
+    # the change feed from there brings the copy up to date. Shared by all sessions.
+    sightings, seq, after = {}, 0, 0
+    while True:
+        response = http_session().get(f"{API_URL}/sightings/", params={"structured": "true", "limit": PAGE_SIZE, "after": after})
+        if after == 0:
+            seq = int(response.headers.get("X-Change-Seq", 0))
+        if response.status_code != 200:
+            break
+        for sighting in response.json():
+            sightings[sighting["id"]] = sighting
+        if "X-Next-Cursor" not in response.headers:
+            break
+        after = response.headers["X-Next-Cursor"]
+    return seq, sightings
+
+def load_sightings():
+    st.session_state.change_seq, st.session_state.sightings = fetch_all_sightings()
+
+def read_changes(since):
+    # (event, data) pairs from the change feed, up to the present
+    response = http_session().get(f"{API_URL}/sightings/changes", params={"since": since, "follow": "false"}, stream=True)
+    event, data = None, None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = json.loads(line[len("data: "):])
+        elif not line and event:
+            yield event, data
+            event, data = None, None
+
 def view_sightings():
-    response = requests.get(f"{API_URL}/sightings/")
-    if response.status_code == 200:
-        sightings_dict = response.json()
-        sightings = []
-
-        for sighting_id, sighting_str in sightings_dict.items():
-            st.write(f"Processing sighting: {sighting_id}: {sighting_str}")
-
-            # Split the string correctly based on expected format
-            parts = sighting_str.split(' on ')
-            if len(parts) < 2:
-                st.warning("Unexpected format for sighting. Skipping...")
-                continue
-            
-            # Extract species and location
-            species_location = parts[0].rsplit(' at ', 1)  # Split only once from the right
-            if len(species_location) != 2:
-                st.warning("Unexpected format for species and location. Skipping...")
-                continue
-            
-            species = species_location[0].strip()
-            location = species_location[1].strip()
-            
-            # Extract date and time
-            date_time = parts[1].strip()  # This is now "Date at Time"
-            date_part, time_part = date_time.split(' at ')  # This should correctly split
-            date_part = date_part.strip()
-            time_part = time_part.strip()
-
-            sightings.append({
-                'species': species,
-                'location': location,
-                'date': date_part,
-                'time': time_part,
-                'id': int(sighting_id)  # Use the actual sighting ID
-            })
-        
-        return sightings
-    return []
+    # The local copy is loaded once per session, then kept current from the change feed
+    if "sightings" not in st.session_state:
+        load_sightings()
+    else:
+        for event, change in read_changes(st.session_state.change_seq):
+            if event == "reset":
+                load_sightings()
+                break
+            if event == "delete":
+                st.session_state.sightings.pop(change["id"], None)
+            else:
+                st.session_state.sightings[change["id"]] = change["sighting"]
+            st.session_state.change_seq = change["seq"]
+    return sorted(st.session_state.sightings.values(), key=lambda sighting: sighting["id"])
 
+@st.cache_data(ttl=CACHE_TTL_SECONDS)
 def search_sightings(species):
-    response = requests.get(f"{API_URL}/sightings/search/", params={"species": species})
-    return response.json() if response.status_code == 200 else {}
+    response = http_session().get(f"{API_URL}/sightings/search/", params={"species": species, "structured": "true"})
+    return response.json() if response.status_code == 200 else []
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS)
+def get_sighting(sighting_id):
+    response = http_session().get(f"{API_URL}/sightings/{sighting_id}")
+    return response.json() if response.status_code == 200 else None
 
 def update_sighting(sighting_id, species, location, date, time):
-    response = requests.put(f"{API_URL}/sightings/{sighting_id}", json={
+    response = http_session().put(f"{API_URL}/sightings/{sighting_id}", json={
         "species": species,
         "location": location,
         "date": date,
         "time": time
     })
+    if response.status_code == 200:
+        invalidate_cached_reads()
     return response
 
 def delete_sighting(sighting_id):
-    response = requests.delete(f"{API_URL}/sightings/{sighting_id}")
+    response = http_session().delete(f"{API_URL}/sightings/{sighting_id}")
+    if response.status_code == 200:
+        invalidate_cached_reads()
     return response
 
+def show_sightings_table(sightings, key):
+    # One page of a dataframe at a time rather than a st.write per sighting
+    page_size = st.selectbox("Rows per page", TABLE_PAGE_SIZES, key=f"{key}_page_size")
+    pages = max(1, -(-len(sightings) // page_size))
+    page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1, key=f"{key}_page")
+    start = (page - 1) * page_size
+    columns = ["id", "species", "location", "date", "time", "latitude", "longitude"]
+    st.dataframe(pd.DataFrame(sightings[start:start + page_size], columns=columns), hide_index=True, use_container_width=True)
+    st.caption(f"{len(sightings)} sightings")
+
 # Set page config
 st.set_page_config(page_title="Wildlife Tracking System", layout="wide")
 
@@ -113,6 +165,8 @@ if choice == "Add a new sighting":
         result = add_sighting(species, location, date.isoformat(), time.strftime("%H:%M"))
         if result.status_code == 200:
             st.success("✅ Sighting added successfully!")
+        elif result.status_code == 202:
+            st.success("✅ Sighting accepted; it will show up in a moment.")
         else:
             st.error("❌ Error adding sighting: " + result.json().get('detail', 'Unknown error'))
 
@@ -120,32 +174,26 @@ elif choice == "View all sightings":
     st.subheader("All Sightings")
     sightings = view_sightings()
     if sightings:
-        for sighting_id, details in sightings.items():
-            st.write(f"**{sighting_id}**: {details}")
+        show_sightings_table(sightings, "all")
     else:
         st.write("🚫 No sightings recorded.")
 
 elif choice == "Search sightings by species":
     st.subheader("Search Sightings")
     search_species = st.text_input("Enter species name to search")
-    if st.button("Search"):
+    if search_species:
         results = search_sightings(search_species)
         if results:
-            for sighting_id, details in results.items():
-                st.write(f"**{sighting_id}**: {details}")
+            show_sightings_table(results, "search")
         else:
             st.write("🚫 No sightings found for the given species.")
 
 elif choice == "Update a sighting":
     st.subheader("Update Sighting")
     sighting_id = st.number_input("Enter the sighting ID to update", min_value=0, step=1)
-    sightings = view_sightings()
-
-    # Assuming sightings is a list of dictionaries
-    sighting_map = {sighting['id']: sighting for sighting in sightings}
+    current_details = get_sighting(int(sighting_id))
 
-    if sighting_id in sighting_map:
-        current_details = sighting_map[sighting_id]
+    if current_details is not None:
         st.write(f"Current details: {current_details}")
 
         # Accessing structured details directly
@@ -157,7 +205,7 @@ elif choice == "Update a sighting":
         new_species = st.text_input("New Species", value=species)
         new_location = st.text_input("New Location", value=location)
         new_date = st.date_input("New Date", value=datetime.strptime(date, '%Y-%m-%d'))
-        new_time = st.time_input("New Time", value=datetime.strptime(time, '%H:%M:%S'))
+        new_time = st.time_input("New Time", value=dtime.fromisoformat(time))
 
         if st.button("Update"):
             result = update_sighting(sighting_id, new_species, new_location, new_date.isoformat(), new_time.strftime("%H:%M"))
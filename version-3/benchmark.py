@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import date, timedelta, time as dtime
+
+import httpx
+
+# Concurrency benchmark for the sightings API.
+# Point --url at a running uvicorn to compare two builds (e.g. this commit and the
+# previous one), or leave it out to drive the app in-process through ASGI.
+
+SPECIES = ["Lion", "Elephant", "Zebra", "Giraffe", "Leopard", "Cheetah", "Rhino", "Buffalo"]
+LOCATIONS = ["Serengeti", "Masai Mara", "Kruger Park", "Etosha", "Okavango Delta", "Amboseli"]
+
+def random_sighting(rng):
+    return {
+        "species": rng.choice(SPECIES),
+        "location": rng.choice(LOCATIONS),
+        "date": (date.today() - timedelta(days=rng.randrange(3650))).isoformat(),
+        "time": f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+    }
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def client_worker(client, rng, requests_per_client, latencies):
+    for _ in range(requests_per_client):
+        roll = rng.random()
+        start = time.perf_counter()
+        if roll < 0.3:
+            endpoint = "add"
+            await client.post("/sightings/", json=random_sighting(rng))
+        else:
+            endpoint = "search"
+            await client.get("/sightings/search/", params={"species": rng.choice(SPECIES)[:3]})
+        latencies.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+
+async def run(args):
+    if args.url:
+        limits = httpx.Limits(max_connections=args.clients)
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60)
+    else:
+        from main import app
+        from database import database
+        await database.connect()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60)
+
+    latencies = {}
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*(
+            client_worker(client, random.Random(rng.random()), args.requests, latencies)
+            for _ in range(args.clients)
+        ))
+    elapsed = time.perf_counter() - started
+
+    if not args.url:
+        await database.disconnect()
+
+    total = sum(len(samples) for samples in latencies.values())
+    report = {
+        "clients": args.clients,
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1),
+        "latency_ms": {
+            endpoint: {
+                "p50": round(percentile(samples, 50), 2),
+                "p99": round(percentile(samples, 99), 2),
+            }
+            for endpoint, samples in latencies.items()
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+def synthetic_rows(count):
+    # Rows shaped like database records, for benchmarks that don't need Postgres
+    rng = random.Random(0)
+    return [
+        {
+            "id": i,
+            "species": rng.choice(SPECIES),
+            "location": rng.choice(LOCATIONS),
+            "date": date.today() - timedelta(days=rng.randrange(3650)),
+            "time": dtime(rng.randrange(24), rng.randrange(60)),
+            "latitude": None,
+            "longitude": None,
+        }
+        for i in range(1, count + 1)
+    ]
+
+def bench_serialization(count):
+    # Compares the formatted-string dict (validated and encoded by FastAPI's default
+    # JSON path) with structured records written by ORJSONResponse. No database needed.
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from responses import ORJSONResponse, sighting_record
+
+    rows = synthetic_rows(count)
+
+    def formatted():
+        body = {row["id"]: f"{row['species']} at {row['location']} on {row['date']} at {row['time']}" for row in rows}
+        return JSONResponse(jsonable_encoder(body)).body
+
+    def structured():
+        return ORJSONResponse([sighting_record(row) for row in rows]).body
+
+    report = {}
+    for name, render in (("formatted", formatted), ("structured", structured)):
+        started = time.perf_counter()
+        body = render()
+        elapsed = time.perf_counter() - started
+        report[name] = {
+            "rows_per_second": round(count / elapsed),
+            "mb_per_second": round(len(body) / elapsed / 1e6, 1),
+            "bytes": len(body),
+        }
+    print(json.dumps({"rows": count, "serialization": report}, indent=2))
+
+def bench_validation(count):
+    # Validated records per second through the Sighting model, one at a time and
+    # through the bulk upload path. No database needed.
+    from main import Sighting
+    from bulk import validate_rows
+
+    rng = random.Random(0)
+    rows = []
+    for _ in range(count):
+        row = random_sighting(rng)
+        row["species"] = f" {row['species'].lower()} "   # as clients send it, before normalization
+        rows.append(row)
+
+    started = time.perf_counter()
+    for row in rows:
+        Sighting(**row)
+    single = time.perf_counter() - started
+    started = time.perf_counter()
+    accepted, rejected = validate_rows(rows, Sighting)
+    bulk = time.perf_counter() - started
+    print(json.dumps({"rows": count, "validation": {
+        "model_records_per_second": round(count / single),
+        "bulk_records_per_second": round(count / bulk),
+        "bulk_accepted": len(accepted),
+        "bulk_rejected": len(rejected),   # in-batch duplicates of the random rows
+    }}, indent=2))
+
+EXPORT_VARIANTS = [(export_format, compression) for export_format in ("csv", "arrow", "parquet")
+                   for compression in (None, "gzip", "zstd")]
+
+async def bench_export(count, url=None):
+    # Throughput of each export format and compression. Offline it times the
+    # encoders on synthetic rows; with --url it downloads /sightings/export from a
+    # running server, so the database cursor and the network are included.
+    import export
+
+    async def offline(export_format, compression):
+        async def rows():
+            for row in synthetic:
+                yield row
+        size = 0
+        async for chunk in export.encode_rows(rows(), export_format, compression):
+            size += len(chunk)
+        return size
+
+    async def download(export_format, compression):
+        params = {"format": export_format, **({"compression": compression} if compression else {})}
+        size = 0
+        async with client.stream("GET", "/sightings/export", params=params) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        return size
+
+    synthetic = synthetic_rows(count) if url is None else None
+    client = httpx.AsyncClient(base_url=url, timeout=None) if url else None
+    report = {}
+    for export_format, compression in EXPORT_VARIANTS:
+        name = f"{export_format}+{compression}" if compression else export_format
+        try:
+            export.check_available(export_format, compression)
+        except export.ExportUnavailable as exc:
+            report[name] = {"skipped": str(exc)}
+            continue
+        started = time.perf_counter()
+        size = await (download if url else offline)(export_format, compression)
+        elapsed = time.perf_counter() - started
+        report[name] = {"mb_per_second": round(size / elapsed / 1e6, 1), "bytes": size, "seconds": round(elapsed, 3)}
+        if url is None:
+            report[name]["rows_per_second"] = round(count / elapsed)
+    if client is not None:
+        await client.aclose()
+    print(json.dumps({"rows": count if url is None else None, "source": url or "synthetic", "export": report}, indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure p50/p99 latency under parallel clients.")
+    parser.add_argument("--url", help="Base URL of a running server, e.g. http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=50, help="Requests issued by each client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--serialization", type=int, metavar="ROWS",
+                        help="Only benchmark response serialization for ROWS rows (e.g. 100000)")
+    parser.add_argument("--validation", type=int, metavar="ROWS",
+                        help="Only benchmark Sighting validation for ROWS raw rows (e.g. 1000000)")
+    parser.add_argument("--export", type=int, metavar="ROWS", nargs="?", const=0,
+                        help="Only benchmark export formats: encode ROWS synthetic rows, or with --url download "
+                             "the server's full export")
+    args = parser.parse_args()
+    if args.serialization:
+        bench_serialization(args.serialization)
+    elif args.validation:
+        bench_validation(args.validation)
+    elif args.export is not None:
+        asyncio.run(bench_export(args.export or 100000, args.url))
+    else:
+        asyncio.run(run(args))
@@ -0,0 +1,133 @@
+import csv
+import io
+import json
+from typing import List, Optional
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+
+MAX_BULK_ROWS = 100_000
+MAX_BATCH_ITEMS = 1000
+
+class BulkRejection(BaseModel):
+    index: int   # position of the row in the upload, starting at 0
+    detail: str
+
+class BulkSightingResponse(BaseModel):
+    inserted: int
+    rejected: List[BulkRejection]
+
+class BatchResult(BaseModel):
+    index: int                    # position of the item in the request, starting at 0
+    id: Optional[int] = None
+    status: int                   # what the single-sighting endpoint would have answered
+    version: Optional[int] = None # the sighting's version after the change, or its current one on 412
+    detail: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    applied: int
+    results: List[BatchResult]
+
+def parse_rows(body: bytes, content_type: Optional[str]):
+    # JSON array, NDJSON or CSV with a species,location,date,time header
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        text = body.decode("utf-8-sig")
+        if media_type == "text/csv":
+            # Empty CSV cells mean "not given", e.g. for the optional coordinates
+            rows = [{name: value if value != "" else None for name, value in row.items()}
+                    for row in csv.DictReader(io.StringIO(text))]
+        elif media_type in ("application/x-ndjson", "application/jsonl"):
+            rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            rows = json.loads(text)
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse upload: {e}")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of sightings.")
+    if len(rows) > MAX_BULK_ROWS:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {MAX_BULK_ROWS} sightings.")
+    return rows
+
+def error_detail(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in entry['loc'])}: {entry['msg']}" for entry in error.errors())
+
+def validate_rows(rows, model):
+    # Returns (index, sighting) pairs that passed validation and are unique within
+    # the batch, plus a rejection for every other row
+    accepted, rejected, first_index_by_key = [], [], {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            rejected.append(BulkRejection(index=index, detail="Expected an object with species, location, date and time."))
+            continue
+        if None in row:
+            # csv.DictReader files cells past the end of the header under None
+            rejected.append(BulkRejection(index=index, detail="Row has more cells than the header has columns."))
+            continue
+        try:
+            sighting = model(**row)
+        except ValidationError as e:
+            rejected.append(BulkRejection(index=index, detail=error_detail(e)))
+            continue
+
+        key = (sighting.species.lower(), sighting.location.lower(), sighting.date, sighting.time)
+        if key in first_index_by_key:
+            rejected.append(BulkRejection(index=index, detail=f"Duplicate of row {first_index_by_key[key]} in this batch."))
+            continue
+        first_index_by_key[key] = index
+        accepted.append((index, sighting))
+    return accepted, rejected
+
+def parse_items(body: bytes):
+    # JSON array of id-keyed changes for the batch endpoints
+    try:
+        items = json.loads(body.decode("utf-8-sig"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse request: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of changes.")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {MAX_BATCH_ITEMS} changes.")
+    return items
+
+def validate_items(items, model):
+    # Returns (index, item) pairs that passed validation, at most one per id,
+    # plus a result for every other item
+    accepted, rejected, first_index_by_id = [], [], {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            rejected.append(BatchResult(index=index, status=422, detail="Expected an object with an id."))
+            continue
+        try:
+            change = model(**item)
+        except ValidationError as e:
+            raw_id = item.get("id")
+            rejected.append(BatchResult(index=index, id=raw_id if isinstance(raw_id, int) else None,
+                                        status=422, detail=error_detail(e)))
+            continue
+
+        if change.id in first_index_by_id:
+            rejected.append(BatchResult(index=index, id=change.id, status=400,
+                                        detail=f"Same sighting as item {first_index_by_id[change.id]} in this batch."))
+            continue
+        first_index_by_id[change.id] = index
+        accepted.append((index, change))
+    return accepted, rejected
+
+def batch_results(accepted, applied, stale, duplicates=()):
+    # The result of each validated item, given the new version of every applied
+    # id (None for deletes), the current version of every stale one and the ids
+    # that collided with another sighting; any other id doesn't exist
+    results = []
+    for index, change in accepted:
+        if change.id in applied:
+            results.append(BatchResult(index=index, id=change.id, status=200, version=applied[change.id]))
+        elif change.id in duplicates:
+            results.append(BatchResult(index=index, id=change.id, status=400,
+                                       detail="Sighting already exists with the same details."))
+        elif change.id in stale:
+            results.append(BatchResult(index=index, id=change.id, status=412, version=stale[change.id],
+                                       detail="Sighting has changed since it was read."))
+        else:
+            results.append(BatchResult(index=index, id=change.id, status=404, detail="Sighting not found"))
+    return results
@@ -0,0 +1,156 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+import orjson
+
+# Response cache for the read endpoints. Every entry key carries the current
+# generation number; writes bump the generation, so older entries stop matching
+# and simply age out. The in-process cache of each worker also bumps its
+# generation on every change the change feed announces, so writes made by
+# other workers (or by the scripts) invalidate it too.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")   # memory, redis or none
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    headers: Dict[str, str]
+
+def normalize_params(**params) -> str:
+    # Drop unset parameters, fold case on the search terms (matching is
+    # case-insensitive) and sort, so equivalent requests share one entry.
+    # Whitespace is kept: the terms are matched as sent, spaces included.
+    parts = []
+    for name, value in sorted(params.items()):
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.lower()
+        parts.append(f"{name}={value}")
+    return "&".join(parts)
+
+class LRUCache:
+    """In-process cache bounded by entry count, with a TTL per entry."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    async def key(self, route: str, **params) -> str:
+        return f"{self.generation}:{route}?{normalize_params(**params)}"
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key: str, value: CachedResponse):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def changed(self):
+        # Synchronous form of invalidate, for the change feed's notifications
+        self.generation += 1
+
+    async def invalidate(self):
+        self.changed()
+
+    async def stats(self):
+        return {
+            "backend": "memory",
+            "generation": self.generation,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+class RedisCache:
+    """Cache shared by all workers. The generation lives in Redis too, so a write
+    in one worker invalidates every worker. Redis handles TTL and eviction;
+    `client` can be any redis.asyncio-compatible client, e.g. fakeredis for local runs.
+    """
+
+    GENERATION_KEY = "sightings:cache:generation"
+
+    def __init__(self, client=None, url=CACHE_URL, ttl=CACHE_TTL_SECONDS):
+        if client is None:
+            import redis.asyncio as redis  # optional dependency, only needed for this backend
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.hits = self.misses = 0
+
+    async def key(self, route: str, **params) -> str:
+        generation = int(await self.client.get(self.GENERATION_KEY) or 0)
+        return f"sightings:cache:{generation}:{route}?{normalize_params(**params)}"
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        raw = await self.client.get(key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        headers, body = raw.split(b"\n", 1)
+        return CachedResponse(body, orjson.loads(headers))
+
+    async def set(self, key: str, value: CachedResponse):
+        await self.client.set(key, orjson.dumps(value.headers) + b"\n" + value.body, px=int(self.ttl * 1000))
+
+    async def invalidate(self):
+        await self.client.incr(self.GENERATION_KEY)
+
+    async def stats(self):
+        return {
+            "backend": "redis",
+            "generation": int(await self.client.get(self.GENERATION_KEY) or 0),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class NullCache:
+    """Disables caching while keeping the same interface."""
+
+    async def key(self, route: str, **params) -> str:
+        return ""
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        return None
+
+    async def set(self, key: str, value: CachedResponse):
+        pass
+
+    async def invalidate(self):
+        pass
+
+    async def stats(self):
+        return {"backend": "none"}
+
+def create_cache():
+    if CACHE_BACKEND == "redis":
+        return RedisCache()
+    if CACHE_BACKEND == "none":
+        return NullCache()
+    return LRUCache()
+
+response_cache = create_cache()
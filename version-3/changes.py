@@ -0,0 +1,165 @@
+import asyncio
+import sys
+
+from database import DATABASE_URL
+
+# Change feed for the sightings table, served by GET /sightings/changes.
+#
+# Statement-level triggers append one row per inserted, updated or deleted
+# sighting to sighting_changes and NOTIFY listeners when the transaction commits.
+# Each trigger first takes a transaction-scoped advisory lock, so writers record
+# their changes one transaction at a time and sequence numbers become visible
+# in order. A reader that has seen seq N never later finds an N-1.
+#
+#   python changes.py prune DAYS   # drop changes older than DAYS (the newest is always kept)
+
+CHANNEL = "sighting_changes"
+
+CREATE_CHANGES_TABLE = [
+    """
+    CREATE TABLE IF NOT EXISTS sighting_changes (
+        seq BIGSERIAL PRIMARY KEY,
+        op VARCHAR(6) NOT NULL,
+        sighting_id INTEGER NOT NULL,
+        sighting JSONB,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_sighting_changes_changed_at ON sighting_changes (changed_at);",
+]
+
+# Rows each trigger records; deletes carry only the id. Sightings are recorded
+# with their names from the lookup tables in place of the ids.
+NAMED_ROW = ("(to_jsonb(new_rows) - 'species_id' - 'location_id') "
+             "|| jsonb_build_object('species', species.name, 'location', locations.name)")
+NAMED_ROWS = ("new_rows JOIN species ON species.id = new_rows.species_id "
+              "JOIN locations ON locations.id = new_rows.location_id")
+CHANGED_ROWS = {
+    "insert": f"SELECT 'insert', new_rows.id, {NAMED_ROW} FROM {NAMED_ROWS} ORDER BY new_rows.id",
+    "update": f"SELECT 'update', new_rows.id, {NAMED_ROW} FROM {NAMED_ROWS} ORDER BY new_rows.id",
+    "delete": "SELECT 'delete', id, NULL::jsonb FROM old_rows ORDER BY id",
+}
+
+TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION sightings_changes_{operation}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM {transition_table}) THEN
+        PERFORM pg_advisory_xact_lock(hashtext('sighting_changes'));
+        INSERT INTO sighting_changes (op, sighting_id, sighting) {rows};
+        PERFORM pg_notify('{channel}', '');
+    END IF;
+    RETURN NULL;
+END;
+$$;
+"""
+
+TRIGGER = """
+DROP TRIGGER IF EXISTS sightings_changes_{operation} ON sightings;
+CREATE TRIGGER sightings_changes_{operation} AFTER {event} ON sightings
+REFERENCING {transition_tables}
+FOR EACH STATEMENT EXECUTE FUNCTION sightings_changes_{operation}();
+"""
+
+TRANSITION_TABLES = {
+    "insert": "NEW TABLE AS new_rows",
+    "delete": "OLD TABLE AS old_rows",
+    "update": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+}
+
+def create_change_feed(cursor):
+    for statement in CREATE_CHANGES_TABLE:
+        cursor.execute(statement)
+    for operation, rows in CHANGED_ROWS.items():
+        transition_table = "old_rows" if operation == "delete" else "new_rows"
+        cursor.execute(TRIGGER_FUNCTION.format(operation=operation, transition_table=transition_table,
+                                               rows=rows, channel=CHANNEL))
+        cursor.execute(TRIGGER.format(operation=operation, event=operation.upper(),
+                                      transition_tables=TRANSITION_TABLES[operation]))
+
+def record_deletes(cursor, table):
+    # Delete events for every row of `table` (an sql.Identifier), for removals
+    # that fire no trigger, such as detaching a partition. Takes the triggers'
+    # lock so the sequence numbers stay in commit order.
+    from psycopg2 import sql
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('sighting_changes'));")
+    cursor.execute(sql.SQL("""
+        INSERT INTO sighting_changes (op, sighting_id, sighting) SELECT 'delete', id, NULL FROM {} ORDER BY id;
+    """).format(table))
+    cursor.execute(f"NOTIFY {CHANNEL};")
+
+def prune(cursor, days: int) -> int:
+    # Keeps the newest change so readers can still tell how far the feed has gone
+    cursor.execute("""
+        DELETE FROM sighting_changes
+        WHERE changed_at < now() - make_interval(days => %s)
+          AND seq < (SELECT max(seq) FROM sighting_changes);
+    """, (days,))
+    return cursor.rowcount
+
+class ChangeNotifier:
+    """Wakes feed readers when Postgres announces new changes.
+
+    One LISTEN connection per process; every waiting stream shares it. Readers
+    note `generation` before querying and pass it to `wait`, so an announcement
+    that lands between the query and the wait isn't lost.
+    """
+
+    def __init__(self, url: str = DATABASE_URL):
+        self.url = url
+        self.generation = 0
+        self._connection = None
+        self._changed = asyncio.Event()
+        self._subscribers = []
+        self._listeners = {}
+
+    def subscribe(self, callback):
+        # callback() runs on the event loop for every announcement, whichever
+        # worker or script made the change
+        self._subscribers.append(callback)
+
+    def listen(self, channel: str, callback):
+        # callback() runs for every NOTIFY on another channel, over the same connection
+        self._listeners[channel] = callback
+
+    async def start(self):
+        import asyncpg
+        self._connection = await asyncpg.connect(self.url)
+        await self._connection.add_listener(CHANNEL, self._notified)
+        for channel, callback in self._listeners.items():
+            await self._connection.add_listener(channel, lambda *args, callback=callback: callback())
+
+    def _notified(self, *args):
+        # Wake everyone waiting on the current event and start a fresh one
+        self.generation += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+        for callback in self._subscribers:
+            callback()
+
+    async def wait(self, generation: int, timeout: float) -> bool:
+        # True if a change was announced after `generation` and before the timeout
+        if self.generation != generation:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "prune" or not sys.argv[2].isdigit():
+        sys.exit("usage: python changes.py prune DAYS")
+
+    import psycopg2
+    connection = psycopg2.connect(DATABASE_URL)
+    try:
+        with connection.cursor() as cursor:
+            removed = prune(cursor, int(sys.argv[2]))
+        connection.commit()
+    finally:
+        connection.close()
+    print(f"Removed {removed} changes.")
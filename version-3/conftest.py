@@ -0,0 +1,7 @@
+import os
+
+# Set before any test imports database.py. The replica lets the routing tests
+# run with read routing on; reads that would reach it are stubbed, so nothing
+# connects to it.
+os.environ.setdefault("DATABASE_REPLICA_URLS", "postgresql://postgres@localhost:5432/replica")
+os.environ["CACHE_BACKEND"] = "memory"
@@ -0,0 +1,453 @@
+import asyncio
+from contextlib import contextmanager
+
+from asyncpg.exceptions import (CannotConnectNowError, PostgresConnectionError, TooManyConnectionsError,
+                                UniqueViolationError)
+from sqlalchemy import and_, or_, select, text, update, delete, func, true, union
+from sqlalchemy.dialects.postgresql import insert
+from database import database, reads
+from models import (SightingModel, SightingDate, SpeciesDayCount, LocationMonthCount, SightingChange, Species,
+                    SpeciesAlias, Location, LocationAlias, SIGHTING_NATURAL_KEY)
+from metrics import query_timer
+import geo
+import ingest
+import names
+import validation
+
+# All queries run on the async `databases` connection so handlers never block the event loop
+sightings_table = SightingModel.__table__
+dates_table = SightingDate.__table__
+species_day_table = SpeciesDayCount.__table__
+location_month_table = LocationMonthCount.__table__
+changes_table = SightingChange.__table__
+species_table = Species.__table__
+locations_table = Location.__table__
+
+# kind -> (lookup table, alias table, alias id column); see names.py
+LOOKUPS = {
+    "species": (species_table, SpeciesAlias.__table__, SpeciesAlias.__table__.c.species_id),
+    "location": (locations_table, LocationAlias.__table__, LocationAlias.__table__.c.location_id),
+}
+
+# Sightings with their names joined back in from the lookup tables, in the
+# shape the API returns
+named_sightings = select(
+    sightings_table.c.id,
+    species_table.c.name.label("species"),
+    locations_table.c.name.label("location"),
+    sightings_table.c.date,
+    sightings_table.c.time,
+    sightings_table.c.latitude,
+    sightings_table.c.longitude,
+).select_from(
+    sightings_table
+    .join(species_table, species_table.c.id == sightings_table.c.species_id)
+    .join(locations_table, locations_table.c.id == sightings_table.c.location_id)
+)
+
+# The database can't be reached, is starting up or out of connections, or a
+# query ran past DB_COMMAND_TIMEOUT
+UNAVAILABLE_ERRORS = (OSError, asyncio.TimeoutError, PostgresConnectionError, CannotConnectNowError,
+                      TooManyConnectionsError)
+
+class DatabaseUnavailable(Exception):
+    """A query failed because the database is unavailable, not because of the query."""
+
+@contextmanager
+def timed_query(operation: str):
+    # Times the query, and reports the errors above as DatabaseUnavailable, so
+    # they can be told apart from I/O errors and timeouts elsewhere in the app
+    with query_timer(operation):
+        try:
+            yield
+        except UNAVAILABLE_ERRORS as exc:
+            raise DatabaseUnavailable(f"{operation}: {exc!r}") from exc
+
+async def resolve_name(kind, name):
+    # (id, canonical name), from the cache or else the primary, which adds the
+    # name the first time it is seen. Runs outside any transaction, so a cached
+    # id is always committed.
+    value = names.name_cache.get(kind, name)
+    if value is None:
+        query = text(names.RESOLVE_QUERIES[kind]).bindparams(name=name)
+        with timed_query("resolve_name"):
+            for _ in range(names.RESOLVE_ATTEMPTS):
+                row = await database.fetch_one(query)
+                if row is not None:
+                    break
+            else:
+                raise RuntimeError(f"Could not resolve {kind} {name!r}")
+        value = (row["id"], row["name"])
+        names.name_cache.set(kind, name, value)
+    return value
+
+async def _db_values(sighting):
+    # Column values, and the sighting as stored (with canonical names).
+    # asyncpg expects real date/time objects rather than strings; validation has
+    # already parsed these, so they come from its cache
+    species_id, species = await resolve_name("species", sighting.species)
+    location_id, location = await resolve_name("location", sighting.location)
+    values = {
+        "species_id": species_id,
+        "location_id": location_id,
+        "date": validation.parse_date(sighting.date),
+        "time": validation.parse_time(sighting.time),
+        "latitude": sighting.latitude,
+        "longitude": sighting.longitude,
+    }
+    return values, {**sighting.dict(), "species": species, "location": location}
+
+def _matching_ids(kind, term):
+    # Ids whose name or one of its aliases contains `term`; the trigram index on
+    # the small lookup table answers it instead of a scan over every sighting
+    table, aliases, alias_id = LOOKUPS[kind]
+    # correlate(None): the outer query joins the same lookup table
+    return union(select(table.c.id).where(table.c.name.ilike(f"%{term}%")).correlate(None),
+                 select(alias_id).where(aliases.c.alias.ilike(f"%{term}%")).correlate(None))
+
+def _named_id(kind, name):
+    # Id of the entry `name` stands for, alias first, as a scalar subquery
+    table, aliases, alias_id = LOOKUPS[kind]
+    return func.coalesce(select(alias_id).where(aliases.c.alias == name.lower()).correlate(None).scalar_subquery(),
+                         select(table.c.id).where(func.lower(table.c.name) == name.lower()).correlate(None).scalar_subquery())
+
+async def create_sighting(sighting):
+    # Returns the sighting as stored, with its new id, or None when the unique
+    # natural-key index reports a duplicate
+    values, stored = await _db_values(sighting)
+    query = (
+        insert(sightings_table)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=SIGHTING_NATURAL_KEY)
+        .returning(sightings_table.c.id, sightings_table.c.version)
+    )
+    with timed_query("create_sighting"):
+        row = await database.fetch_one(query)
+    return {"id": row["id"], **stored, "version": row["version"]} if row is not None else None
+
+def _page_query(after=0, limit=None):
+    # Keyset pagination on the primary key, so every page is an index seek
+    query = named_sightings.where(sightings_table.c.id > after).order_by(sightings_table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+async def get_sightings(after=0, limit=None):
+    with timed_query("get_sightings"):
+        return await reads.fetch_all(_page_query(after, limit))
+
+def _with_id(sighting_id):
+    # The date comes from sighting_dates, so only that date's partition is searched
+    date = select(dates_table.c.date).where(dates_table.c.id == sighting_id).scalar_subquery()
+    return and_(sightings_table.c.id == sighting_id, sightings_table.c.date == date)
+
+async def get_sighting(sighting_id):
+    query = named_sightings.add_columns(sightings_table.c.version).where(_with_id(sighting_id))
+    with timed_query("get_sighting"):
+        return await reads.fetch_one(query)
+
+async def iterate_sightings(after=0, limit=None):
+    # Rows come from a server-side cursor as they are fetched
+    with timed_query("iterate_sightings"):
+        async for row in reads.iterate(_page_query(after, limit)):
+            yield row
+
+def _time_window(time_from=None, time_to=None):
+    # A window whose start is after its end wraps past midnight, e.g. 22:00 to 04:00
+    column = sightings_table.c.time
+    if time_from and time_to and time_from > time_to:
+        return or_(column >= time_from, column <= time_to)
+    return and_(column >= time_from if time_from else true(), column <= time_to if time_to else true())
+
+def _search_query(species=None, location=None, date_from=None, date_to=None, time_from=None, time_to=None):
+    # Inclusive date bounds let the planner prune the monthly partitions
+    return named_sightings.where(
+        sightings_table.c.species_id.in_(_matching_ids("species", species)) if species else true(),
+        sightings_table.c.location_id.in_(_matching_ids("location", location)) if location else true(),
+        sightings_table.c.date >= date_from if date_from else true(),
+        sightings_table.c.date <= date_to if date_to else true(),
+        _time_window(time_from, time_to),
+    ).order_by(sightings_table.c.id)
+
+async def search_sightings(species=None, location=None, date_from=None, date_to=None, time_from=None, time_to=None):
+    query = _search_query(species, location, date_from, date_to, time_from, time_to)
+    with timed_query("search_sightings"):
+        return await reads.fetch_all(query)
+
+async def iterate_search(species=None, location=None, date_from=None, date_to=None, time_from=None, time_to=None):
+    # Same filters as search_sightings, read through a server-side cursor
+    query = _search_query(species, location, date_from, date_to, time_from, time_to)
+    with timed_query("iterate_search"):
+        async for row in reads.iterate(query):
+            yield row
+
+async def sightings_in_area(area, limit):
+    query = named_sightings.where(area).order_by(sightings_table.c.id).limit(limit)
+    with timed_query("sightings_in_area"):
+        return await reads.fetch_all(query)
+
+async def sightings_within_radius(lat, lon, radius_km, limit):
+    return await sightings_in_area(geo.within_radius(sightings_table, lat, lon, radius_km), limit)
+
+async def sightings_within_bbox(min_lat, min_lon, max_lat, max_lon, limit):
+    boxes = geo.bbox_boxes(min_lat, min_lon, max_lat, max_lon)
+    return await sightings_in_area(geo.within_boxes(sightings_table, boxes), limit)
+
+async def species_daily_counts(species=None, date_from=None, date_to=None):
+    # Groups that dropped to zero keep a row with count 0, so filter them out
+    table = species_day_table
+    query = select(species_table.c.name.label("species"), table.c.day, table.c.count).join_from(
+        table, species_table, species_table.c.id == table.c.species_id,
+    ).where(
+        table.c.count > 0,
+        table.c.species_id == _named_id("species", species) if species else true(),
+        table.c.day >= date_from if date_from else true(),
+        table.c.day <= date_to if date_to else true(),
+    ).order_by(species_table.c.name, table.c.day)
+    with timed_query("species_daily_counts"):
+        return await reads.fetch_all(query)
+
+async def location_monthly_counts(location=None, month_from=None, month_to=None):
+    table = location_month_table
+    query = select(locations_table.c.name.label("location"), table.c.month, table.c.count).join_from(
+        table, locations_table, locations_table.c.id == table.c.location_id,
+    ).where(
+        table.c.count > 0,
+        table.c.location_id == _named_id("location", location) if location else true(),
+        table.c.month >= month_from if month_from else true(),
+        table.c.month <= month_to if month_to else true(),
+    ).order_by(locations_table.c.name, table.c.month)
+    with timed_query("location_monthly_counts"):
+        return await reads.fetch_all(query)
+
+async def change_seq_bounds():
+    # (oldest retained, newest) sequence numbers, or (None, None) before the first change
+    query = select(func.min(changes_table.c.seq), func.max(changes_table.c.seq))
+    with timed_query("change_seq_bounds"):
+        row = await reads.fetch_one(query)
+    return row[0], row[1]
+
+async def get_changes(after, limit):
+    # Always the primary: feed readers wake on its NOTIFY, which replicas may not have replayed yet
+    query = (
+        select(changes_table.c.seq, changes_table.c.op, changes_table.c.sighting_id, changes_table.c.sighting)
+        .where(changes_table.c.seq > after)
+        .order_by(changes_table.c.seq)
+        .limit(limit)
+    )
+    with timed_query("get_changes"):
+        return await database.fetch_all(query)
+
+class VersionMismatch(Exception):
+    """The sighting exists, but not in the version the caller expected."""
+
+    def __init__(self, version):
+        super().__init__(f"Sighting is at version {version}")
+        self.version = version
+
+async def _check_version(sighting_id, expected_version):
+    # Called after a versioned write matched no row: tells a stale version
+    # apart from a missing sighting, which is left to the caller
+    if expected_version is not None:
+        version = await database.fetch_val(select(sightings_table.c.version).where(_with_id(sighting_id)))
+        if version is not None:
+            raise VersionMismatch(version)
+
+async def update_sighting(sighting_id, sighting, expected_version=None):
+    # Returns the sighting as stored with its new version, or None if there is no
+    # such sighting. With expected_version, only that version is overwritten.
+    values, stored = await _db_values(sighting)
+    query = update(sightings_table).where(_with_id(sighting_id))
+    if expected_version is not None:
+        query = query.where(sightings_table.c.version == expected_version)
+    query = query.values(**values, version=sightings_table.c.version + 1).returning(sightings_table.c.version)
+    with timed_query("update_sighting"):
+        version = await database.fetch_val(query)
+        if version is None:
+            await _check_version(sighting_id, expected_version)
+            return None
+    return {"id": sighting_id, **stored, "version": version}
+
+async def delete_sighting(sighting_id, expected_version=None):
+    query = delete(sightings_table).where(_with_id(sighting_id))
+    if expected_version is not None:
+        query = query.where(sightings_table.c.version == expected_version)
+    with timed_query("delete_sighting"):
+        deleted = await database.fetch_one(query.returning(sightings_table.c.id))
+        if deleted is None:
+            await _check_version(sighting_id, expected_version)
+    return deleted
+
+# Staging rows are inserted in upload order; the CTE reports which rows made it
+# past the unique natural-key index so the rest can be reported as duplicates.
+# Two rows can name the same sighting through an alias; only the first is inserted.
+CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE sightings_staging (
+    row_index INTEGER NOT NULL,
+    species_id INTEGER NOT NULL,
+    location_id INTEGER NOT NULL,
+    date DATE NOT NULL,
+    time TIME NOT NULL,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION
+) ON COMMIT DROP;
+"""
+
+INSERT_FROM_STAGING = """
+WITH inserted AS (
+    INSERT INTO sightings (species_id, location_id, date, time, latitude, longitude)
+    SELECT species_id, location_id, date, time, latitude, longitude FROM sightings_staging ORDER BY row_index
+    ON CONFLICT (species_id, location_id, date, time) DO NOTHING
+    RETURNING id, species_id, location_id, date, time
+)
+SELECT min(staging.row_index) AS row_index, inserted.id
+FROM sightings_staging staging
+JOIN inserted USING (species_id, location_id, date, time)
+GROUP BY inserted.id;
+"""
+
+async def bulk_insert_sightings(accepted):
+    # COPYs the batch into a temp table and inserts it in one transaction.
+    # Returns the new id of each inserted row, by its index.
+    records = []
+    for index, sighting in accepted:
+        values, _ = await _db_values(sighting)
+        records.append((index, values["species_id"], values["location_id"], values["date"], values["time"],
+                        values["latitude"], values["longitude"]))
+
+    with timed_query("bulk_insert_sightings"):
+        async with database.connection() as connection:
+            async with connection.transaction():
+                raw_connection = connection.raw_connection
+                await raw_connection.execute(CREATE_STAGING_TABLE)
+                await raw_connection.copy_records_to_table(
+                    "sightings_staging",
+                    records=records,
+                    columns=["row_index", "species_id", "location_id", "date", "time", "latitude", "longitude"],
+                )
+                rows = await raw_connection.fetch(INSERT_FROM_STAGING)
+    return {row["row_index"]: row["id"] for row in rows}
+
+# Queued writes' outcomes, shared by every worker; see ingest.py. Expired rows
+# are pruned by the same statement that records a batch.
+SAVE_TICKETS = """
+WITH pruned AS (
+    DELETE FROM ingest_tickets WHERE written_at < now() - make_interval(secs => $5)
+)
+INSERT INTO ingest_tickets (ticket, status, sighting_id, detail)
+SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::integer[], $4::varchar[])
+ON CONFLICT (ticket) DO NOTHING;
+"""
+
+LOAD_TICKET = """
+SELECT status, sighting_id, detail FROM ingest_tickets
+WHERE ticket = $1 AND written_at >= now() - make_interval(secs => $2);
+"""
+
+async def save_tickets(statuses, ttl):
+    # (ticket, status) pairs as the write queue keeps them
+    columns = ([ticket for ticket, _ in statuses], [status["status"] for _, status in statuses],
+               [status.get("id") for _, status in statuses], [status.get("detail") for _, status in statuses])
+    with timed_query("save_tickets"):
+        async with database.connection() as connection:
+            await connection.raw_connection.execute(SAVE_TICKETS, *columns, ttl)
+
+async def load_ticket(ticket, ttl):
+    # Always the primary: a replica may not have the batch's row yet
+    with timed_query("load_ticket"):
+        async with database.connection() as connection:
+            row = await connection.raw_connection.fetchrow(LOAD_TICKET, ticket, ttl)
+    return None if row is None else ingest.ticket_status(row["status"], row["sighting_id"], row["detail"])
+
+# Batch changes arrive as one array per column and are joined to sightings by
+# id, through sighting_dates so each id only probes its date's partition (see
+# partitions.py). Fields a change leaves out keep their value; a change that
+# names a version only applies to that version. Every applied change bumps the
+# version, including one whose new date moves the row to another partition.
+PATCH_SIGHTINGS = """
+UPDATE sightings SET
+    species_id = coalesce(changes.species_id, sightings.species_id),
+    location_id = coalesce(changes.location_id, sightings.location_id),
+    date = coalesce(changes.date, sightings.date),
+    time = coalesce(changes.time, sightings.time),
+    latitude = CASE WHEN changes.set_latitude THEN changes.latitude ELSE sightings.latitude END,
+    longitude = CASE WHEN changes.set_longitude THEN changes.longitude ELSE sightings.longitude END,
+    version = sightings.version + 1
+FROM unnest($1::integer[], $2::integer[], $3::integer[], $4::integer[], $5::date[], $6::time[],
+            $7::boolean[], $8::double precision[], $9::boolean[], $10::double precision[])
+    AS changes(id, version, species_id, location_id, date, time, set_latitude, latitude, set_longitude, longitude)
+JOIN sighting_dates ON sighting_dates.id = changes.id
+WHERE sightings.id = changes.id AND sightings.date = sighting_dates.date
+  AND (changes.version IS NULL OR sightings.version = changes.version)
+RETURNING sightings.id, sightings.version;
+"""
+
+DELETE_SIGHTINGS = """
+DELETE FROM sightings USING unnest($1::integer[], $2::integer[]) AS targets(id, version)
+JOIN sighting_dates ON sighting_dates.id = targets.id
+WHERE sightings.id = targets.id AND sightings.date = sighting_dates.date
+  AND (targets.version IS NULL OR sightings.version = targets.version)
+RETURNING sightings.id;
+"""
+
+CURRENT_VERSIONS = """
+SELECT sightings.id, sightings.version FROM sighting_dates
+JOIN sightings ON sightings.id = sighting_dates.id AND sightings.date = sighting_dates.date
+WHERE sighting_dates.id = ANY($1::integer[]);
+"""
+
+async def _current_versions(raw_connection, ids):
+    # Of the ids a batch left untouched, those that exist were skipped for a stale version
+    if not ids:
+        return {}
+    return {row["id"]: row["version"] for row in await raw_connection.fetch(CURRENT_VERSIONS, ids)}
+
+async def patch_sightings(changes):
+    # Applies id-keyed partial changes in one transaction. Returns the new version
+    # of each changed sighting, the current version of each one whose expected
+    # version was stale, and the ids whose change collided with another sighting.
+    rows = []
+    for change in changes:
+        species_id = (await resolve_name("species", change.species))[0] if change.species is not None else None
+        location_id = (await resolve_name("location", change.location))[0] if change.location is not None else None
+        rows.append((change.id, change.version, species_id, location_id,
+                     validation.parse_date(change.date) if change.date is not None else None,
+                     validation.parse_time(change.time) if change.time is not None else None,
+                     "latitude" in change.model_fields_set, change.latitude,
+                     "longitude" in change.model_fields_set, change.longitude))
+
+    applied, duplicates = {}, set()
+    with timed_query("patch_sightings"):
+        async with database.connection() as connection:
+            async with connection.transaction():
+                raw_connection = connection.raw_connection
+                try:
+                    async with raw_connection.transaction():
+                        updated = await raw_connection.fetch(PATCH_SIGHTINGS, *[list(column) for column in zip(*rows)])
+                    applied.update((row["id"], row["version"]) for row in updated)
+                except UniqueViolationError:
+                    # Some change collides with another sighting; apply them one at a
+                    # time, each in its own savepoint, to find out which
+                    for values in rows:
+                        try:
+                            async with raw_connection.transaction():
+                                updated = await raw_connection.fetch(PATCH_SIGHTINGS, *[[value] for value in values])
+                            applied.update((row["id"], row["version"]) for row in updated)
+                        except UniqueViolationError:
+                            duplicates.add(values[0])
+                stale = await _current_versions(
+                    raw_connection, [row[0] for row in rows if row[0] not in applied and row[0] not in duplicates])
+    return applied, stale, duplicates
+
+async def delete_sightings(targets):
+    # Deletes id-keyed targets in one statement. Returns the deleted ids and the
+    # current version of each sighting whose expected version was stale.
+    ids = [target.id for target in targets]
+    with timed_query("delete_sightings"):
+        async with database.connection() as connection:
+            async with connection.transaction():
+                raw_connection = connection.raw_connection
+                rows = await raw_connection.fetch(DELETE_SIGHTINGS, ids, [target.version for target in targets])
+                deleted = {row["id"] for row in rows}
+                stale = await _current_versions(raw_connection, [i for i in ids if i not in deleted])
+    return deleted, stale
@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import io
+import os
+import zlib
+from typing import AsyncIterator, Optional
+
+# Streaming exports for analysis tools, served by GET /sightings/export.
+#
+# Rows come from a server-side cursor and are encoded EXPORT_BATCH_ROWS at a
+# time in a worker thread, so memory use is bounded by one batch however large
+# the result is.
+#
+#   csv      header row, then one line per sighting
+#   arrow    Arrow IPC stream, one record batch per batch (pyarrow.ipc.open_stream)
+#   parquet  one row group per batch
+#
+# Arrow and Parquet need the optional pyarrow package, zstd needs zstandard.
+# gzip and zstd compress csv and arrow output as a whole; parquet compresses
+# its column chunks with that codec instead (snappy when none is given).
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+
+COLUMNS = ["id", "species", "location", "date", "time", "latitude", "longitude"]
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+COMPRESSIONS = {
+    "gzip": ("application/gzip", "gz"),
+    "zstd": ("application/zstd", "zst"),
+}
+
+class ExportUnavailable(Exception):
+    """The format or compression needs a package that isn't installed."""
+
+class _Sink(io.RawIOBase):
+    # File object for pyarrow writers; `take` hands over what was written so far
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+class CSVEncoder:
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(COLUMNS)
+
+    def encode(self, batch) -> bytes:
+        self.writer.writerows([row[column] for column in COLUMNS] for row in batch)
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def finish(self) -> bytes:
+        return self.buffer.getvalue().encode()
+
+def _arrow_schema(pa):
+    return pa.schema([
+        ("id", pa.int64()),
+        ("species", pa.string()),
+        ("location", pa.string()),
+        ("date", pa.date32()),
+        ("time", pa.time64("us")),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+    ])
+
+class ArrowEncoder:
+    def __init__(self):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = _arrow_schema(pa)
+        self.sink = _Sink()
+        self.writer = self.open_writer()
+
+    def open_writer(self):
+        return self.pa.ipc.new_stream(self.sink, self.schema)
+
+    def encode(self, batch) -> bytes:
+        columns = {column: [row[column] for row in batch] for column in COLUMNS}
+        self.writer.write_batch(self.pa.RecordBatch.from_pydict(columns, schema=self.schema))
+        return self.sink.take()
+
+    def finish(self) -> bytes:
+        self.writer.close()
+        return self.sink.take()
+
+class ParquetEncoder(ArrowEncoder):
+    def __init__(self, compression: Optional[str] = None):
+        self.compression = compression or "snappy"
+        super().__init__()
+
+    def open_writer(self):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(self.sink, self.schema, compression=self.compression)
+
+def _compressor(compression: Optional[str]):
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits 31: gzip header and trailer
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return None
+
+def check_available(export_format: str, compression: Optional[str]):
+    # Raised before the response starts, so the client gets a clear error status
+    try:
+        if export_format in ("arrow", "parquet"):
+            import pyarrow  # noqa: F401
+            import pyarrow.parquet  # noqa: F401
+        if compression == "zstd":
+            import zstandard  # noqa: F401
+    except ImportError as exc:
+        raise ExportUnavailable(f"{export_format} export with {compression or 'no'} compression needs the {exc.name} package") from exc
+
+def content_type(export_format: str, compression: Optional[str]) -> str:
+    if compression and export_format != "parquet":
+        return COMPRESSIONS[compression][0]
+    return FORMATS[export_format][0]
+
+def filename(export_format: str, compression: Optional[str]) -> str:
+    name = f"sightings.{FORMATS[export_format][1]}"
+    if compression and export_format != "parquet":
+        name += f".{COMPRESSIONS[compression][1]}"
+    return name
+
+def _encoder(export_format: str, compression: Optional[str]):
+    if export_format == "csv":
+        return CSVEncoder()
+    if export_format == "arrow":
+        return ArrowEncoder()
+    return ParquetEncoder(compression)
+
+async def _batches(rows: AsyncIterator, size: int):
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def encode_rows(rows: AsyncIterator, export_format: str, compression: Optional[str] = None,
+                      batch_rows: int = EXPORT_BATCH_ROWS):
+    """Yields the encoded (and compressed) export of `rows`, one chunk per batch."""
+    loop = asyncio.get_running_loop()
+    encoder = _encoder(export_format, compression)
+    compressor = _compressor(compression) if export_format != "parquet" else None
+
+    def encode(batch):
+        data = encoder.encode(batch) if batch is not None else encoder.finish()
+        if compressor is not None:
+            data = compressor.compress(data)
+            if batch is None:
+                data += compressor.flush()
+        return data
+
+    async for batch in _batches(rows, batch_rows):
+        data = await loop.run_in_executor(None, encode, batch)
+        if data:
+            yield data
+    data = await loop.run_in_executor(None, encode, None)
+    if data:
+        yield data
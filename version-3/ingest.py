@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+
+# Queued writes for high-rate feeds (GPS collars, acoustic sensors).
+#
+# With WRITE_QUEUE_ENABLED=1, POST /sightings/ validates the sighting, puts it
+# on a bounded in-process queue and answers 202 with a ticket. A background
+# writer takes up to WRITE_BATCH_SIZE queued sightings at a time, waiting at
+# most WRITE_BATCH_WAIT_SECONDS for a batch to fill, and inserts each batch in
+# one transaction through the bulk insert path. Many requests then share one
+# commit instead of paying for their own.
+#
+# When the queue is full, a request waits up to WRITE_QUEUE_TIMEOUT_SECONDS for
+# room and is then turned away with 503, so a burst slows its senders down
+# instead of growing memory without bound.
+#
+# Each batch's outcome is also recorded in the ingest_tickets table, one
+# statement per batch, so any worker can answer for any ticket. Rows are kept
+# for WRITE_TICKET_TTL_SECONDS. A ticket carries its issue time; one that no
+# worker has recorded yet is still queued in the worker that issued it (or was
+# lost with that worker, in which case it reads as queued until it expires).
+
+WRITE_QUEUE_ENABLED = os.getenv("WRITE_QUEUE_ENABLED") == "1"
+WRITE_QUEUE_MAX_SIZE = int(os.getenv("WRITE_QUEUE_MAX_SIZE", "10000"))
+WRITE_QUEUE_TIMEOUT_SECONDS = float(os.getenv("WRITE_QUEUE_TIMEOUT_SECONDS", "1"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_BATCH_WAIT_SECONDS = float(os.getenv("WRITE_BATCH_WAIT_SECONDS", "0.05"))
+WRITE_TICKET_MAX_ENTRIES = int(os.getenv("WRITE_TICKET_MAX_ENTRIES", "100000"))
+WRITE_TICKET_TTL_SECONDS = float(os.getenv("WRITE_TICKET_TTL_SECONDS", "600"))
+
+# Unlogged: statuses are short-lived, and losing them in a crash only costs lookups
+CREATE_TICKET_TABLE = """
+CREATE UNLOGGED TABLE IF NOT EXISTS ingest_tickets (
+    ticket VARCHAR PRIMARY KEY,
+    status VARCHAR(10) NOT NULL,
+    sighting_id INTEGER,
+    detail VARCHAR,
+    written_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_ingest_tickets_written_at ON ingest_tickets (written_at);
+"""
+
+logger = logging.getLogger(__name__)
+
+def create_ticket_table(cursor):
+    cursor.execute(CREATE_TICKET_TABLE)
+
+def new_ticket() -> str:
+    return f"{int(time.time()):x}-{uuid.uuid4().hex}"
+
+def issued_at(ticket: str) -> Optional[float]:
+    # None for anything this module didn't issue
+    issued, _, rest = ticket.partition("-")
+    try:
+        return float(int(issued, 16)) if len(rest) == 32 else None
+    except ValueError:
+        return None
+
+def ticket_status(status: str, sighting_id: Optional[int], detail: Optional[str]) -> dict:
+    # A status as returned by GET /sightings/tickets/{ticket}, from a row of ingest_tickets
+    if status == "inserted":
+        return {"status": status, "id": sighting_id}
+    return {"status": status, "detail": detail}
+
+class QueueUnavailable(Exception):
+    """The queue is full, or shutting down, and takes no more writes for now."""
+
+class TicketStore:
+    """Status per ticket, bounded by entry count with a TTL per entry."""
+
+    def __init__(self, max_entries=WRITE_TICKET_MAX_ENTRIES, ttl=WRITE_TICKET_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, ticket: str) -> Optional[dict]:
+        entry = self._entries.get(ticket)
+        if entry is None:
+            return None
+        expires_at, status = entry
+        if expires_at < time.monotonic():
+            del self._entries[ticket]
+            return None
+        return status
+
+    def set(self, ticket: str, status: dict):
+        self._entries[ticket] = (time.monotonic() + self.ttl, status)
+        self._entries.move_to_end(ticket)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, ticket: str):
+        self._entries.pop(ticket, None)
+
+class WriteQueue:
+    """Bounded queue of validated sightings, drained in batches by one writer task.
+
+    `write_batch` takes (index, sighting) pairs and returns the new id of each
+    inserted one by its index; the others were duplicates. `save_tickets` takes
+    (ticket, status) pairs and records them in the shared table; `load_ticket`
+    reads one back, or returns None.
+    """
+
+    def __init__(self, write_batch, save_tickets=None, load_ticket=None, max_size=WRITE_QUEUE_MAX_SIZE,
+                 batch_size=WRITE_BATCH_SIZE, batch_wait=WRITE_BATCH_WAIT_SECONDS,
+                 put_timeout=WRITE_QUEUE_TIMEOUT_SECONDS):
+        self.write_batch = write_batch
+        self.save_tickets = save_tickets
+        self.load_ticket = load_ticket
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.put_timeout = put_timeout
+        self.tickets = TicketStore()
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        # The queue belongs to the running event loop, so it is made here rather than at import
+        self._queue = asyncio.Queue(self.max_size)
+        self._closing = False
+        self._writer = asyncio.create_task(self._run())
+
+    async def submit(self, sighting) -> str:
+        if self._writer is None or self._closing:
+            raise QueueUnavailable("The write queue is not accepting sightings.")
+        ticket = new_ticket()
+        # Set first: the writer may finish the ticket before put() returns
+        self.tickets.set(ticket, {"status": "queued"})
+        try:
+            await asyncio.wait_for(self._queue.put((ticket, sighting)), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.tickets.discard(ticket)
+            metrics.WRITE_QUEUE_REJECTED.inc()
+            raise QueueUnavailable("The write queue is full; retry shortly.")
+        metrics.WRITE_QUEUE_DEPTH.set(self._queue.qsize())
+        return ticket
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            # Take what is already queued without waiting, then wait out the rest of the window
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            remaining = deadline - loop.time()
+            if len(batch) >= self.batch_size or remaining <= 0 or self._closing:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                metrics.WRITE_QUEUE_DEPTH.set(self._queue.qsize())
+
+    async def _write(self, batch):
+        metrics.WRITE_BATCH_ROWS.observe(len(batch))
+        try:
+            inserted = await self.write_batch([(index, sighting) for index, (_, sighting) in enumerate(batch)])
+        except Exception:
+            # The batch's transaction rolled back, so none of it was written
+            metrics.ERRORS.labels("write_queue").inc()
+            logger.exception("Writing a batch of %d queued sightings failed", len(batch))
+            statuses = [(ticket, {"status": "failed", "detail": "The sighting could not be written; send it again."})
+                        for ticket, _ in batch]
+        else:
+            statuses = [
+                (ticket, {"status": "inserted", "id": inserted[index]} if index in inserted
+                 else {"status": "duplicate", "detail": "Sighting already exists with the same details."})
+                for index, (ticket, _) in enumerate(batch)
+            ]
+
+        for ticket, status in statuses:
+            self.tickets.set(ticket, status)
+        if self.save_tickets is not None:
+            try:
+                await self.save_tickets(statuses)
+            except Exception:
+                # Other workers see these tickets as queued until they expire
+                logger.exception("Recording %d ticket statuses failed", len(statuses))
+
+    async def status(self, ticket: str) -> Optional[dict]:
+        # This worker's own tickets, then the shared table, then a ticket that
+        # another worker issued recently and hasn't written yet
+        status = self.tickets.get(ticket)
+        if status is None and self.load_ticket is not None:
+            status = await self.load_ticket(ticket)
+        if status is None:
+            issued = issued_at(ticket)
+            if issued is not None and 0 <= time.time() - issued < self.tickets.ttl:
+                status = {"status": "queued"}
+        return status
+
+    async def stop(self):
+        # Stop taking writes and write out everything already queued
+        if self._writer is None:
+            return
+        self._closing = True
+        await self._queue.join()
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
@@ -1,45 +1,187 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel, Field, validator
-from sqlalchemy.orm import Session
-from datetime import datetime, date
-from typing import Dict, Optional
-from database import database, SessionLocal
-from models import SightingModel, Base
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel, Field, field_validator, model_validator
+from datetime import date, time as dtime
+from typing import Dict, Literal, Optional
+from asyncpg.exceptions import (CannotConnectNowError, PostgresConnectionError, TooManyConnectionsError,
+                                UniqueViolationError)
+from database import database, reads, DATABASE_URL, HEALTH_CHECK_TIMEOUT_SECONDS, READ_YOUR_WRITES_SECONDS
+from bulk import (BatchResponse, BulkRejection, BulkSightingResponse, batch_results, parse_items, parse_rows,
+                  validate_items, validate_rows)
+from responses import ORJSONResponse, etag, if_match_version, sighting_record
+from cache import CachedResponse, LRUCache, response_cache
+from changes import ChangeNotifier
+import export
+import ingest
+import metrics
+import names
+import validation
+import crud
+import orjson
+import asyncio
+import logging
+import time
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+metrics.instrument_pool(database)
+
+MAX_PAGE_SIZE = 1000
+CHANGE_BATCH_SIZE = 500
+CHANGE_HEARTBEAT_SECONDS = 15   # keep-alive comment, and re-check, on an idle feed
+
+change_notifier = ChangeNotifier(DATABASE_URL)
+if isinstance(response_cache, LRUCache):
+    # Other workers' writes reach this worker's cache through the change feed
+    change_notifier.subscribe(response_cache.changed)
+# A new alias empties every worker's name cache; see names.py
+change_notifier.listen(names.ALIAS_CHANNEL, names.name_cache.clear)
+
+async def write_batch(accepted):
+    # One transaction per batch of queued sightings; see ingest.py
+    inserted = await crud.bulk_insert_sightings(accepted)
+    if inserted:
+        await response_cache.invalidate()
+    return inserted
+
+async def save_tickets(statuses):
+    await crud.save_tickets(statuses, ingest.WRITE_TICKET_TTL_SECONDS)
+
+async def load_ticket(ticket):
+    return await crud.load_ticket(ticket, ingest.WRITE_TICKET_TTL_SECONDS)
+
+write_queue = ingest.WriteQueue(write_batch, save_tickets, load_ticket) if ingest.WRITE_QUEUE_ENABLED else None
 
 class Sighting(BaseModel):
     species: str = Field(..., min_length=1)
     location: str = Field(..., min_length=1)
     date: str = Field(..., pattern=r'^\d{4}-\d{2}-\d{2}$')  # YYYY-MM-DD
     time: str = Field(..., pattern=r'^\d{2}:\d{2}$')       # HH:MM
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    @model_validator(mode='wrap')
+    @classmethod
+    def timed(cls, data, handler):
+        # One observation per record rather than per field keeps the timer cheap next to the checks
+        with metrics.VALIDATOR_SECONDS.time():
+            return handler(data)
 
-    @validator('date')
+    @field_validator('date')
+    @classmethod
     def validate_date(cls, v):
-        sighting_date = datetime.strptime(v, '%Y-%m-%d').date()
-        if sighting_date > date.today():
-            raise ValueError('Date cannot be in the future.')
-        return v
+        return validation.check_date(v)
 
-    @validator('time')
+    @field_validator('time')
+    @classmethod
     def validate_time(cls, v):
-        try:
-            datetime.strptime(v, '%H:%M')
-        except ValueError:
-            raise ValueError('Time must be in HH:MM format.')
-        return v
+        return validation.check_time(v)
 
-    @validator('species', 'location')
+    @field_validator('species', 'location')
+    @classmethod
     def capitalize(cls, v):
-        return v.strip().title()  # Capitalizes each word and removes extra spaces
+        return validation.normalize_name(v)
+
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
+
+class SightingPatch(BaseModel):
+    # One item of PATCH /sightings/batch; fields left out keep their value
+    id: int
+    version: Optional[int] = None   # like If-Match: apply only to this version
+    species: Optional[str] = Field(None, min_length=1)
+    location: Optional[str] = Field(None, min_length=1)
+    date: Optional[str] = Field(None, pattern=r'^\d{4}-\d{2}-\d{2}$')
+    time: Optional[str] = Field(None, pattern=r'^\d{2}:\d{2}$')
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    # Same checks as Sighting; None leaves the field unchanged
+    @field_validator('date')
+    @classmethod
+    def validate_date(cls, v):
+        return validation.check_date(v) if v is not None else None
+
+    @field_validator('time')
+    @classmethod
+    def validate_time(cls, v):
+        return validation.check_time(v) if v is not None else None
+
+    @field_validator('species', 'location')
+    @classmethod
+    def capitalize(cls, v):
+        return validation.normalize_name(v) if v is not None else None
+
+    @model_validator(mode='after')
+    def check_position(self):
+        validation.check_position(self.latitude, self.longitude, self.model_fields_set)
+        return self
+
+class SightingRef(BaseModel):
+    # One item of DELETE /sightings/batch
+    id: int
+    version: Optional[int] = None
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    profiler = None
+    if metrics.should_profile(request):
+        profiler = metrics.SamplingProfiler()
+        profiler.start()
+
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        # Label by route template so /sightings/1 and /sightings/2 share a series
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        metrics.REQUESTS.labels(request.method, route_path, status).inc()
+        metrics.REQUEST_SECONDS.labels(request.method, route_path, status).observe(elapsed)
+        if profiler is not None:
+            profiler.stop()
+            name = f"{request.method}{route_path}".replace("/", "_").strip("_")
+            logger.info("Wrote profile %s", profiler.dump(name))
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+PRIMARY_UNTIL_COOKIE = "read_primary_until"
+
+async def route_reads(request: Request, call_next):
+    # A client that wrote in the last READ_YOUR_WRITES_SECONDS reads from the
+    # primary, so it sees its own change even while the replicas lag behind
+    try:
+        primary_until = float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+    token = reads.begin_request(primary_only=request.method in WRITE_METHODS or primary_until > time.time())
+    try:
+        response = await call_next(request)
+    finally:
+        reads.end_request(token)
+    if request.method in WRITE_METHODS and response.status_code < 400:
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, str(time.time() + READ_YOUR_WRITES_SECONDS),
+                            max_age=max(1, round(READ_YOUR_WRITES_SECONDS)), httponly=True)
+    return response
+
+if reads.replicas:
+    app.middleware("http")(route_reads)
+
+@app.exception_handler(crud.DatabaseUnavailable)
+@app.exception_handler(PostgresConnectionError)
+@app.exception_handler(CannotConnectNowError)
+@app.exception_handler(TooManyConnectionsError)
+async def database_unavailable(request: Request, exc: Exception):
+    # The database is down, starting up or out of connections: 503, which
+    # clients and load balancers retry, instead of a 500
+    return ORJSONResponse({"detail": "Database unavailable"}, status_code=503, headers={"Retry-After": "1"})
 
 class SightingResponse(BaseModel):
     id: int
@@ -47,89 +189,330 @@ class SightingResponse(BaseModel):
     location: str
     date: str
     time: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    version: int
+
+async def queue_sighting(sighting: Sighting):
+    try:
+        ticket = await write_queue.submit(sighting)
+    except ingest.QueueUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "1"})
+    return ORJSONResponse({"ticket": ticket, "status": "queued"}, status_code=202,
+                          headers={"Location": f"/sightings/tickets/{ticket}"})
 
 @app.post("/sightings/", response_model=SightingResponse)
-async def add_sighting(sighting: Sighting, db: Session = Depends(get_db)):
-    db_sighting = SightingModel(**sighting.dict())
-    
-    # Check for existing sightings
-    existing = db.query(SightingModel).filter(
-        SightingModel.species.ilike(sighting.species),
-        SightingModel.location.ilike(sighting.location),
-        SightingModel.date == sighting.date,
-        SightingModel.time == sighting.time,
-    ).first()
-
-    if existing:
+async def add_sighting(sighting: Sighting, response: Response):
+    if write_queue is not None:
+        # Answered with 202 and a ticket; the sighting is written with the next batch
+        return await queue_sighting(sighting)
+
+    created = await crud.create_sighting(sighting)
+    if created is None:
         raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
 
-    db.add(db_sighting)
-    db.commit()
-    db.refresh(db_sighting)
-    return SightingResponse(id=db_sighting.id, **sighting.dict())
+    await response_cache.invalidate()
+    response.headers["ETag"] = etag(created["version"])
+    return SightingResponse(**created)
+
+@app.post("/sightings/bulk", response_model=BulkSightingResponse)
+async def add_sightings_bulk(request: Request):
+    # Accepts a JSON array, NDJSON (application/x-ndjson) or CSV (text/csv)
+    rows = parse_rows(await request.body(), request.headers.get("content-type"))
+    accepted, rejected = validate_rows(rows, Sighting)
+
+    inserted = await crud.bulk_insert_sightings(accepted) if accepted else {}
+    if inserted:
+        await response_cache.invalidate()
+    for index, _ in accepted:
+        if index not in inserted:
+            rejected.append(BulkRejection(index=index, detail="Sighting already exists with the same details."))
+
+    rejected.sort(key=lambda rejection: rejection.index)
+    return BulkSightingResponse(inserted=len(inserted), rejected=rejected)
+
+@app.get("/sightings/tickets/{ticket}")
+async def ticket_status(ticket: str):
+    # queued, inserted (with the new id), duplicate or failed, from whichever worker issued it
+    status = await write_queue.status(ticket) if write_queue is not None else None
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired ticket")
+    return ORJSONResponse({"ticket": ticket, **status})
+
+@app.patch("/sightings/batch", response_model=BatchResponse)
+async def patch_sightings_batch(request: Request):
+    # A JSON array of {"id", "version"?, ...fields to change}, applied in one
+    # transaction; each item gets the status PUT would have answered
+    accepted, results = validate_items(parse_items(await request.body()), SightingPatch)
+    applied, stale, duplicates = await crud.patch_sightings([change for _, change in accepted]) if accepted else ({}, {}, set())
+    if applied:
+        await response_cache.invalidate()
+
+    results.extend(batch_results(accepted, applied, stale, duplicates))
+    results.sort(key=lambda result: result.index)
+    return BatchResponse(applied=len(applied), results=results)
+
+@app.delete("/sightings/batch", response_model=BatchResponse)
+async def delete_sightings_batch(request: Request):
+    # A JSON array of {"id", "version"?}, deleted in one statement
+    accepted, results = validate_items(parse_items(await request.body()), SightingRef)
+    deleted, stale = await crud.delete_sightings([target for _, target in accepted]) if accepted else (set(), {})
+    if deleted:
+        await response_cache.invalidate()
+
+    results.extend(batch_results(accepted, dict.fromkeys(deleted), stale))
+    results.sort(key=lambda result: result.index)
+    return BatchResponse(applied=len(deleted), results=results)
+
+async def stream_sightings(after: int, limit: Optional[int]):
+    async for sighting in crud.iterate_sightings(after, limit):
+        yield orjson.dumps(sighting_record(sighting)) + b"\n"
+
+async def cache_response(key: str, content, headers: Optional[Dict[str, str]] = None):
+    response = ORJSONResponse(content, headers=headers)
+    await response_cache.set(key, CachedResponse(response.body, headers or {}))
+    return response
+
+def cached_response(cached: CachedResponse):
+    return Response(content=cached.body, media_type="application/json", headers=cached.headers)
 
 @app.get("/sightings/", response_model=Dict[int, str])
-async def view_sightings(db: Session = Depends(get_db)):
-    sightings = db.query(SightingModel).all()
+async def view_sightings(limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                         after: int = Query(0, ge=0),
+                         stream: bool = False,
+                         structured: bool = False):
+    if stream:
+        return StreamingResponse(stream_sightings(after, limit), media_type="application/x-ndjson")
+
+    # Keyed by the database read from too, so a client reading its own writes
+    # from the primary never gets a page cached from a lagging replica
+    key = await response_cache.key("view", source=reads.source_name(), limit=limit, after=after, structured=structured)
+    cached = await response_cache.get(key)
+    if cached is not None:
+        return cached_response(cached)
+
+    # Read before the page, so replaying the feed from here covers any change the page missed
+    _, change_seq = await crud.change_seq_bounds()
+    headers = {"X-Change-Seq": str(change_seq or 0)}
+    sightings = await crud.get_sightings(after, limit)
     if not sightings:
-        raise HTTPException(status_code=404, detail="No sightings recorded")
-    
-    return {sighting.id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}" for sighting in sightings}
+        raise HTTPException(status_code=404, detail="No sightings recorded", headers=headers)
+
+    if limit is not None and len(sightings) == limit:
+        # Pass the last id back as `after` to fetch the next page
+        headers["X-Next-Cursor"] = str(sightings[-1]["id"])
+
+    if structured:
+        # List of typed records, written by orjson without per-row model validation
+        return await cache_response(key, [sighting_record(sighting) for sighting in sightings], headers)
+
+    return await cache_response(key, {sighting["id"]: f"{sighting['species']} at {sighting['location']} on {sighting['date']} at {sighting['time']}" for sighting in sightings}, headers)
+
+def change_event(change) -> bytes:
+    sighting = change["sighting"]
+    if isinstance(sighting, (str, bytes)):
+        sighting = orjson.loads(sighting)
+    data = orjson.dumps({"seq": change["seq"], "op": change["op"], "id": change["sighting_id"], "sighting": sighting})
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (change["seq"], change["op"].encode(), data)
+
+async def stream_changes(request: Request, after: int, follow: bool):
+    oldest, _ = await crud.change_seq_bounds()
+    if oldest is not None and after + 1 < oldest:
+        # The changes after `after` were pruned; the client has to reload the listing
+        yield b"event: reset\ndata: {}\n\n"
+        return
+
+    while True:
+        generation = change_notifier.generation
+        changes = await crud.get_changes(after, CHANGE_BATCH_SIZE)
+        for change in changes:
+            after = change["seq"]
+            yield change_event(change)
+        if len(changes) == CHANGE_BATCH_SIZE:
+            continue
+        if not follow or await request.is_disconnected():
+            return
+        if not await change_notifier.wait(generation, CHANGE_HEARTBEAT_SECONDS):
+            yield b": keep-alive\n\n"
+
+@app.get("/sightings/changes")
+async def sighting_changes(request: Request, since: Optional[int] = Query(None, ge=0), follow: bool = True):
+    # Server-sent events, one per inserted, updated or deleted sighting, with the
+    # sequence number as the event id. Resume with `since` or the Last-Event-ID
+    # header; with neither, only new changes are sent. follow=false ends the
+    # stream once it has caught up.
+    if since is None:
+        last_event_id = request.headers.get("last-event-id", "")
+        since = int(last_event_id) if last_event_id.isdigit() else (await crud.change_seq_bounds())[1] or 0
+    return StreamingResponse(stream_changes(request, since, follow), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/sightings/search/")
-async def search_sightings(species: Optional[str] = None, location: Optional[str] = None, db: Session = Depends(get_db)):
-    found_sightings = db.query(SightingModel).filter(
-        (SightingModel.species.ilike(f"%{species}%") if species else True),
-        (SightingModel.location.ilike(f"%{location}%") if location else True)
-    ).all()
+async def search_sightings(species: Optional[str] = None, location: Optional[str] = None,
+                           date_from: Optional[date] = None, date_to: Optional[date] = None,
+                           time_from: Optional[dtime] = None, time_to: Optional[dtime] = None,
+                           structured: bool = False):
+    # Date bounds are inclusive; a time window whose start is after its end wraps past midnight
+    key = await response_cache.key("search", source=reads.source_name(), species=species, location=location,
+                                   date_from=date_from, date_to=date_to, time_from=time_from, time_to=time_to,
+                                   structured=structured)
+    cached = await response_cache.get(key)
+    if cached is not None:
+        return cached_response(cached)
+
+    found_sightings = await crud.search_sightings(species, location, date_from, date_to, time_from, time_to)
 
     if not found_sightings:
         raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
+
+    if structured:
+        return await cache_response(key, [sighting_record(sighting) for sighting in found_sightings])
     
-    return {sighting.id: f"{sighting.species} at {sighting.location} on {sighting.date} at {sighting.time}" for sighting in found_sightings}
+    return await cache_response(key, {sighting["id"]: f"{sighting['species']} at {sighting['location']} on {sighting['date']} at {sighting['time']}" for sighting in found_sightings})
+
+@app.get("/sightings/export")
+async def export_sightings(export_format: Literal["csv", "arrow", "parquet"] = Query("csv", alias="format"),
+                           compression: Optional[Literal["gzip", "zstd"]] = None,
+                           species: Optional[str] = None, location: Optional[str] = None,
+                           date_from: Optional[date] = None, date_to: Optional[date] = None,
+                           time_from: Optional[dtime] = None, time_to: Optional[dtime] = None):
+    # Same filters as search; streamed in bounded batches, never held in memory as a whole
+    try:
+        export.check_available(export_format, compression)
+    except export.ExportUnavailable as exc:
+        raise HTTPException(status_code=501, detail=str(exc))
+
+    rows = crud.iterate_search(species, location, date_from, date_to, time_from, time_to)
+    headers = {"Content-Disposition": f'attachment; filename="{export.filename(export_format, compression)}"'}
+    return StreamingResponse(export.encode_rows(rows, export_format, compression),
+                             media_type=export.content_type(export_format, compression), headers=headers)
+
+@app.get("/sightings/near")
+async def sightings_near(lat: Optional[float] = Query(None, ge=-90, le=90),
+                         lon: Optional[float] = Query(None, ge=-180, le=180),
+                         radius_km: Optional[float] = Query(None, gt=0),
+                         min_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         min_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         max_lat: Optional[float] = Query(None, ge=-90, le=90),
+                         max_lon: Optional[float] = Query(None, ge=-180, le=180),
+                         limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Either a radius around lat/lon or a min/max bounding box, served by the GiST index
+    if None not in (lat, lon, radius_km):
+        found_sightings = await crud.sightings_within_radius(lat, lon, radius_km, limit)
+    elif None not in (min_lat, min_lon, max_lat, max_lon):
+        if min_lat > max_lat:
+            raise HTTPException(status_code=400, detail="min_lat must not be greater than max_lat.")
+        # min_lon greater than max_lon is a box across the antimeridian
+        found_sightings = await crud.sightings_within_bbox(min_lat, min_lon, max_lat, max_lon, limit)
+    else:
+        raise HTTPException(status_code=400, detail="Give lat, lon and radius_km, or min_lat, min_lon, max_lat and max_lon.")
+
+    if not found_sightings:
+        raise HTTPException(status_code=404, detail="No sightings found for the given filters.")
+
+    return ORJSONResponse([sighting_record(sighting) for sighting in found_sightings])
+
+@app.get("/sightings/stats/species-daily")
+async def species_daily_stats(species: Optional[str] = None, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    # Reads the trigger-maintained rollup instead of aggregating the sightings table
+    groups = await crud.species_daily_counts(species.strip().title() if species else None, date_from, date_to)
+    return ORJSONResponse([{"species": group["species"], "date": group["day"], "count": group["count"]} for group in groups])
+
+@app.get("/sightings/stats/location-monthly")
+async def location_monthly_stats(location: Optional[str] = None, month_from: Optional[date] = None, month_to: Optional[date] = None):
+    # Months are identified by their first day, e.g. 2024-03-01
+    groups = await crud.location_monthly_counts(
+        location.strip().title() if location else None,
+        month_from.replace(day=1) if month_from else None,
+        month_to.replace(day=1) if month_to else None,
+    )
+    return ORJSONResponse([{"location": group["location"], "month": group["month"], "count": group["count"]} for group in groups])
+
+@app.get("/sightings/{sighting_id}")
+async def get_sighting(sighting_id: int):
+    # Declared after the fixed /sightings/... paths so they are matched first
+    sighting = await crud.get_sighting(sighting_id)
+    if sighting is None:
+        raise HTTPException(status_code=404, detail="Sighting not found")
+    return ORJSONResponse(sighting_record(sighting), headers={"ETag": etag(sighting["version"])})
+
+def stale_version(exc: crud.VersionMismatch):
+    return HTTPException(status_code=412, detail="Sighting has changed since it was read.",
+                         headers={"ETag": etag(exc.version)})
 
 @app.put("/sightings/{sighting_id}", response_model=SightingResponse)
-async def update_sighting(sighting_id: int, updated_sighting: Sighting, db: Session = Depends(get_db)):
+async def update_sighting(sighting_id: int, updated_sighting: Sighting, response: Response,
+                          if_match: Optional[str] = Header(None)):
+    # With If-Match, the update only applies if the sighting is still at that version
+    expected_version = if_match_version(if_match)
     try:
-        sighting_to_update = db.query(SightingModel).filter(SightingModel.id == sighting_id).first()
-        if not sighting_to_update:
+        updated = await crud.update_sighting(sighting_id, updated_sighting, expected_version)
+        if not updated:
             raise HTTPException(status_code=404, detail="Sighting not found")
 
-        sighting_to_update.species = updated_sighting.species.title()
-        sighting_to_update.location = updated_sighting.location.title()
-
-        sighting_date = datetime.strptime(updated_sighting.date, '%Y-%m-%d').date()
-        if sighting_date > date.today():
-            raise HTTPException(status_code=400, detail='Date cannot be in the future.')
-        sighting_to_update.date = sighting_date
-
-        datetime.strptime(updated_sighting.time, '%H:%M')
-        sighting_to_update.time = updated_sighting.time
-
-        db.commit()
-        db.refresh(sighting_to_update)
-
-        return SightingResponse(
-            id=sighting_to_update.id,
-            species=sighting_to_update.species,
-            location=sighting_to_update.location,
-            date=sighting_to_update.date,
-            time=sighting_to_update.time
-        )
-    except Exception as e:
-        print(f"Error updating sighting: {e}")  # Log the error for debugging
+        await response_cache.invalidate()
+        response.headers["ETag"] = etag(updated["version"])
+        return SightingResponse(**updated)
+    except (HTTPException, crud.DatabaseUnavailable):
+        raise
+    except crud.VersionMismatch as exc:
+        raise stale_version(exc)
+    except UniqueViolationError:
+        raise HTTPException(status_code=400, detail="Sighting already exists with the same details.")
+    except Exception:
+        metrics.ERRORS.labels("update_sighting").inc()
+        logger.exception("Error updating sighting %s", sighting_id)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @app.delete("/sightings/{sighting_id}")
-async def delete_sighting(sighting_id: int, db: Session = Depends(get_db)):
-    sighting_to_delete = db.query(SightingModel).filter(SightingModel.id == sighting_id).first()
-    if not sighting_to_delete:
+async def delete_sighting(sighting_id: int, if_match: Optional[str] = Header(None)):
+    try:
+        deleted = await crud.delete_sighting(sighting_id, if_match_version(if_match))
+    except crud.VersionMismatch as exc:
+        raise stale_version(exc)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Sighting not found")
 
-    db.delete(sighting_to_delete)
-    db.commit()
+    await response_cache.invalidate()
     return {"detail": "Sighting deleted successfully"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return await response_cache.stats()
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and serving requests; the database isn't checked
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: the primary answers within HEALTH_CHECK_TIMEOUT_SECONDS. Replicas
+    # are probed and reported, but one being down doesn't make the API unready,
+    # because reads then go to the primary.
+    try:
+        await asyncio.wait_for(database.fetch_val("SELECT 1"), HEALTH_CHECK_TIMEOUT_SECONDS)
+        ready = True
+    except crud.UNAVAILABLE_ERRORS:
+        ready = False
+
+    body = {"status": "ready" if ready else "unavailable", "database": "up" if ready else "down",
+            "pool": metrics.pool_stats(database)}
+    if reads.replicas:
+        body["replicas"] = await reads.check(HEALTH_CHECK_TIMEOUT_SECONDS)
+    if write_queue is not None:
+        body["write_queue"] = {"depth": write_queue.depth}
+    return ORJSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/pool/stats")
+async def database_pool_stats():
+    return {"primary": metrics.pool_stats(database),
+            "replicas": [metrics.pool_stats(replica) for replica in reads.replicas]}
+
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Sighting Tracker API! Use /docs for more information."}
@@ -137,8 +520,18 @@ async def read_root():
 # Start database connection
 @app.on_event("startup")
 async def startup():
+    # Opens DB_POOL_MIN_SIZE connections, so the pool is warm before the first request
     await database.connect()
+    await reads.connect()
+    await change_notifier.start()
+    if write_queue is not None:
+        write_queue.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    if write_queue is not None:
+        # Write out what is still queued while the pool is open
+        await write_queue.stop()
+    await change_notifier.stop()
+    await reads.disconnect()
     await database.disconnect()
@@ -0,0 +1,106 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics served at /metrics, plus an opt-in sampling profiler
+
+REQUESTS = Counter("http_requests_total", "HTTP requests handled", ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"])
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Database query latency", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+VALIDATOR_SECONDS = Histogram(
+    "sighting_validator_duration_seconds", "Time spent validating one Sighting record",
+    buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001),
+)
+ERRORS = Counter("sighting_errors_total", "Unexpected errors raised by handlers", ["handler"])
+POOL_CONNECTIONS = Gauge("db_pool_connections", "Connections in the async pool", ["state"])
+DB_READS = Counter("db_reads_total", "Routed reads by the database that served them", ["source"])
+REPLICA_FAILOVERS = Counter("db_replica_failovers_total", "Reads moved to the primary after a replica failed", ["replica"])
+WRITE_QUEUE_DEPTH = Gauge("write_queue_depth", "Sightings waiting in the write queue")
+WRITE_QUEUE_REJECTED = Counter("write_queue_rejected_total", "Sightings turned away because the write queue was full")
+WRITE_BATCH_ROWS = Histogram("write_batch_rows", "Sightings per batch written by the write queue",
+                             buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+
+@contextmanager
+def query_timer(operation: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_QUERY_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+def pool_stats(database) -> dict:
+    # The asyncpg pool only exists once the database is connected
+    pool = getattr(database._backend, "_pool", None)
+    if pool is None:
+        return {"open": 0, "in_use": 0, "idle": 0, "max": 0}
+    return {
+        "open": pool.get_size(),
+        "in_use": pool.get_size() - pool.get_idle_size(),
+        "idle": pool.get_idle_size(),
+        "max": pool.get_max_size(),
+    }
+
+def instrument_pool(database):
+    # Read at scrape time, so the gauges follow the pool as it connects and grows
+    for state in ("open", "in_use", "idle", "max"):
+        POOL_CONNECTIONS.labels(state).set_function(lambda state=state: pool_stats(database)[state])
+
+# Sampling profiler. Set PROFILE_REQUESTS=1 to profile every request, or
+# PROFILING_ENABLED=1 to allow profiling single requests sent with an
+# `X-Profile: 1` header. Output is folded stacks ("frame;frame;frame count"),
+# which flamegraph.pl and speedscope read directly.
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS") == "1"
+PROFILING_ENABLED = PROFILE_REQUESTS or os.getenv("PROFILING_ENABLED") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+
+def should_profile(request) -> bool:
+    return PROFILE_REQUESTS or (PROFILING_ENABLED and request.headers.get("x-profile") == "1")
+
+class SamplingProfiler:
+    """Samples the stack of one thread (the event loop) from a background thread.
+
+    Concurrent requests share the event loop, so their frames can show up in
+    each other's profiles.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = StackCounter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, name: str) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
@@ -0,0 +1,37 @@
+import orjson
+from typing import Optional
+from fastapi import HTTPException, Response
+
+class ORJSONResponse(Response):
+    # Serializes plain dicts/lists straight to bytes with orjson, which also
+    # handles date and time values natively (and integer keys, written as strings)
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def sighting_record(sighting):
+    # Typed record for structured responses; date and time stay native until orjson writes them
+    return {
+        "id": sighting["id"],
+        "species": sighting["species"],
+        "location": sighting["location"],
+        "date": sighting["date"],
+        "time": sighting["time"],
+        "latitude": sighting["latitude"],
+        "longitude": sighting["longitude"],
+    }
+
+def etag(version: int) -> str:
+    # A sighting's ETag is its version, which every update bumps
+    return f'"{version}"'
+
+def if_match_version(if_match: Optional[str]) -> Optional[int]:
+    # The version an If-Match header asks for; None without one, or for "*".
+    # Weak and foreign tags can never match, so they fail like a stale version.
+    if if_match is None or if_match.strip() == "*":
+        return None
+    value = if_match.strip()
+    if len(value) > 2 and value[0] == value[-1] == '"' and value[1:-1].isdigit():
+        return int(value[1:-1])
+    raise HTTPException(status_code=412, detail="If-Match does not name a version of this sighting.")
@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+
+from asyncpg.exceptions import CannotConnectNowError, InterfaceError, PostgresConnectionError
+
+import metrics
+
+# Read routing across a primary and its streaming replicas.
+#
+# Reads rotate over the replicas; writes always use the primary. A replica that
+# fails to connect or drops a connection is skipped for REPLICA_RETRY_SECONDS,
+# and the failed read is retried on the primary. Within a request every read
+# uses the same source, so e.g. a change sequence number and the page read
+# after it agree with each other.
+
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, PostgresConnectionError, CannotConnectNowError, InterfaceError)
+
+logger = logging.getLogger(__name__)
+
+class ReadRouter:
+    """Picks the database each read goes to.
+
+    `primary` and `replicas` are `databases.Database` instances, or anything
+    with the same connect/fetch_all/fetch_one/iterate methods, which is how an
+    in-process stand-in can take a replica's place.
+    """
+
+    def __init__(self, primary, replicas=(), retry_seconds: float = 5):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_seconds = retry_seconds
+        self._down_until = [0.0] * len(self.replicas)
+        self._connecting = [asyncio.Lock() for _ in self.replicas]
+        self._rotation = itertools.cycle(range(len(self.replicas)))
+        self._request = contextvars.ContextVar("read_source", default=None)
+
+    def begin_request(self, primary_only: bool = False):
+        # Returns a token for end_request; reads until then share one source
+        return self._request.set({"source": self.primary if primary_only else None})
+
+    def end_request(self, token):
+        self._request.reset(token)
+
+    def _choose(self):
+        now = time.monotonic()
+        for _ in self.replicas:
+            index = next(self._rotation)
+            if self._down_until[index] <= now:
+                return self.replicas[index]
+        return self.primary
+
+    def source(self):
+        state = self._request.get()
+        if state is None:
+            return self._choose()
+        if state["source"] is None:
+            state["source"] = self._choose()
+        return state["source"]
+
+    def source_name(self) -> str:
+        # "primary" or "replica", for cache keys: a page read from a lagging
+        # replica must not be served to a client that reads from the primary
+        return "primary" if self.source() is self.primary else "replica"
+
+    async def _connected(self, replica):
+        # Replicas connect lazily, so one that was down at startup joins once it's back
+        if not replica.is_connected:
+            async with self._connecting[self.replicas.index(replica)]:
+                if not replica.is_connected:
+                    await replica.connect()
+        return replica
+
+    def _failed(self, replica, exc):
+        index = self.replicas.index(replica)
+        self._down_until[index] = time.monotonic() + self.retry_seconds
+        metrics.REPLICA_FAILOVERS.labels(str(index)).inc()
+        logger.warning("Replica %d failed (%s); reading from the primary for %gs", index, exc, self.retry_seconds)
+        state = self._request.get()
+        if state is not None:
+            state["source"] = self.primary
+
+    async def _read(self, method: str, query):
+        source = self.source()
+        if source is not self.primary:
+            try:
+                result = await getattr(await self._connected(source), method)(query)
+                metrics.DB_READS.labels("replica").inc()
+                return result
+            except REPLICA_ERRORS as exc:
+                self._failed(source, exc)
+        metrics.DB_READS.labels("primary").inc()
+        return await getattr(self.primary, method)(query)
+
+    async def fetch_all(self, query):
+        return await self._read("fetch_all", query)
+
+    async def fetch_one(self, query):
+        return await self._read("fetch_one", query)
+
+    async def iterate(self, query):
+        source = self.source()
+        if source is not self.primary:
+            started = False
+            try:
+                async for row in (await self._connected(source)).iterate(query):
+                    started = True
+                    yield row
+                metrics.DB_READS.labels("replica").inc()
+                return
+            except REPLICA_ERRORS as exc:
+                if started:
+                    raise   # rows already sent can't be taken back
+                self._failed(source, exc)
+        metrics.DB_READS.labels("primary").inc()
+        async for row in self.primary.iterate(query):
+            yield row
+
+    async def check(self, timeout: float):
+        # Probes every replica, as the readiness check does. One that fails or
+        # doesn't answer within `timeout` is skipped as if a read had failed; one
+        # that answers is used again right away. Returns "up" or "down" per replica.
+        async def probe(index, replica):
+            try:
+                await asyncio.wait_for((await self._connected(replica)).fetch_val("SELECT 1"), timeout)
+            except REPLICA_ERRORS as exc:
+                self._failed(replica, exc)
+                return "down"
+            self._down_until[index] = 0.0
+            return "up"
+
+        return list(await asyncio.gather(*(probe(index, replica) for index, replica in enumerate(self.replicas))))
+
+    async def connect(self):
+        # A replica that is down now doesn't stop startup
+        for replica in self.replicas:
+            try:
+                await self._connected(replica)
+            except REPLICA_ERRORS as exc:
+                self._failed(replica, exc)
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.is_connected:
+                await replica.disconnect()
@@ -0,0 +1,63 @@
+import os
+from datetime import date
+
+import pytest
+
+# Plan checks against a real database: set DATABASE_URL to run them. The schema
+# is created (or brought up to date) first, as create_db.py does.
+if not os.getenv("DATABASE_URL"):
+    pytest.skip("DATABASE_URL is not set", allow_module_level=True)
+
+import psycopg2
+
+import create_db
+import partitions
+from database import DATABASE_URL
+
+@pytest.fixture(scope="module")
+def cursor():
+    create_db.create_tables()
+    connection = psycopg2.connect(DATABASE_URL)
+    cursor = connection.cursor()
+    # As in explain_indexes: on a small table the planner would rather scan it
+    cursor.execute("SET enable_seqscan = off;")
+    yield cursor
+    connection.rollback()
+    connection.close()
+
+def indexes_used(cursor, query):
+    return create_db.used_indexes(create_db.plan_nodes(cursor, query))
+
+def assert_uses(cursor, query, index_name):
+    assert indexes_used(cursor, query) & create_db.index_names(cursor, index_name)
+
+def test_insert_checks_natural_key(cursor):
+    assert_uses(cursor, "INSERT INTO sightings (species_id, location_id, date, time) "
+                        "VALUES (1, 1, '2024-01-01', '10:00') "
+                        "ON CONFLICT (species_id, location_id, date, time) DO NOTHING", "ux_sightings_natural_key")
+
+def test_species_filter_uses_natural_key(cursor):
+    assert_uses(cursor, "SELECT id FROM sightings WHERE species_id = 1", "ux_sightings_natural_key")
+
+def test_location_filter_uses_location_index(cursor):
+    assert_uses(cursor, "SELECT id FROM sightings WHERE location_id = 1", "ix_sightings_location_id")
+
+@pytest.mark.parametrize("table", ["species", "locations"])
+def test_name_search_uses_trigram_index(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm';")
+    if cursor.fetchone() is None:
+        pytest.skip("pg_trgm is not installed")
+    assert_uses(cursor, f"SELECT id FROM {table} WHERE name ILIKE '%lio%'", f"ix_{table}_name_trgm")
+
+def test_time_of_day_uses_date_time_index(cursor):
+    assert_uses(cursor, "SELECT id FROM sightings WHERE date = '2024-01-15' AND time BETWEEN '06:00' AND '09:00'",
+                "ix_sightings_date_time")
+
+def test_date_range_scans_one_partition(cursor):
+    nodes = create_db.plan_nodes(cursor, "SELECT id FROM sightings WHERE date >= '2024-01-01' AND date < '2024-02-01'")
+    scanned = create_db.scanned_relations(nodes) & {name for name, _, _ in partitions.list_partitions(cursor)}
+    assert scanned == {partitions.partition_name(date(2024, 1, 1))}
+
+def test_bounding_box_uses_gist_index(cursor):
+    assert_uses(cursor, "SELECT id FROM sightings WHERE latitude IS NOT NULL AND longitude IS NOT NULL "
+                        "AND point(longitude, latitude) <@ box(point(36, -2), point(37, -1))", "ix_sightings_position")
@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+
+import main
+
+SIGHTING = {"species": "Lion", "location": "Serengeti", "date": "2024-01-01", "time": "10:00"}
+
+# The models reject these before any query runs, so no database is needed
+client = TestClient(main.app)
+
+def test_add_rejects_lone_coordinate():
+    assert client.post("/sightings/", json={**SIGHTING, "latitude": 5}).status_code == 422
+    assert client.post("/sightings/", json={**SIGHTING, "latitude": 5, "longitude": None}).status_code == 422
+
+def test_update_rejects_lone_coordinate():
+    assert client.put("/sightings/1", json={**SIGHTING, "longitude": 5}).status_code == 422
+
+def test_patch_rejects_lone_coordinate():
+    response = client.patch("/sightings/batch", json=[{"id": 1, "latitude": 5}, {"id": 2, "longitude": 5, "latitude": None}])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == [422, 422]
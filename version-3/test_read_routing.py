@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import crud
+import main
+
+OLD = {"id": 1, "species": "Lion", "location": "Serengeti", "date": "2024-01-01", "time": "10:00", "version": 1}
+NEW = {"id": 2, "species": "Zebra", "location": "Serengeti", "date": "2024-01-02", "time": "11:00", "version": 1}
+
+@pytest.fixture
+def lagging_replica(monkeypatch):
+    # The replica hasn't caught up with NEW yet; the primary has it
+    async def get_sightings(after, limit):
+        return [OLD, NEW] if main.reads.source() is main.reads.primary else [OLD]
+
+    async def change_seq_bounds():
+        return None, 0
+
+    monkeypatch.setattr(crud, "get_sightings", get_sightings)
+    monkeypatch.setattr(crud, "change_seq_bounds", change_seq_bounds)
+
+def test_writer_does_not_get_page_cached_from_replica(lagging_replica):
+    assert main.reads.replicas
+    # The write that added NEW bumped the cache generation
+    asyncio.run(main.response_cache.invalidate())
+
+    other = TestClient(main.app)
+    assert list(other.get("/sightings/").json()) == ["1"]
+
+    writer = TestClient(main.app)
+    writer.cookies.set(main.PRIMARY_UNTIL_COOKIE, str(time.time() + 5))
+    assert list(writer.get("/sightings/").json()) == ["1", "2"]
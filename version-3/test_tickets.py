@@ -0,0 +1,29 @@
+import asyncio
+
+import ingest
+
+def test_ticket_is_answered_by_another_worker():
+    shared = {}
+
+    async def write_batch(accepted):
+        return {index: 100 + index for index, _ in accepted}
+
+    async def save_tickets(statuses):
+        shared.update(statuses)
+
+    async def load_ticket(ticket):
+        return shared.get(ticket)
+
+    async def run():
+        issuer = ingest.WriteQueue(write_batch, save_tickets, load_ticket, batch_wait=0)
+        other = ingest.WriteQueue(write_batch, save_tickets, load_ticket)
+        issuer.start()
+        ticket = ingest.new_ticket()
+        assert await other.status(ticket) == {"status": "queued"}   # issued, not written yet
+        ticket = await issuer.submit({"species": "Lion"})
+        await issuer.stop()
+        return ticket, await other.status(ticket), await other.status("unknown")
+
+    ticket, status, unknown = asyncio.run(run())
+    assert status == {"status": "inserted", "id": 100}
+    assert unknown is None